@@ -3,24 +3,14 @@
 from dnsproxy.website import WebServer
 from dnsproxy.server import Server
 from dnsproxy.config import Config
+from dnsproxy.configstore import ConfigStore
+from dnsproxy.logqueue import LogShipper, DEFAULT_FILENAME
 from threading import Thread
 from sys import argv
 import logging
 
 logger = logging.getLogger('dnsproxy')
-logger.setLevel(logging.DEBUG)
-
-formatter = logging.Formatter("%(asctime)-15s %(levelname)-8s %(name)s.%(funcName)s @ %(threadName)s : %(message)s")
-
-consoleHandler = logging.StreamHandler()
-consoleHandler.setLevel(logging.DEBUG)
-consoleHandler.setFormatter(formatter)
-
-hdlr = logging.FileHandler('dnsapp.log')
-hdlr.setFormatter(formatter)
-
-logger.addHandler(hdlr)
-logger.addHandler(consoleHandler)
+log_shipper = LogShipper(logger, DEFAULT_FILENAME)
 
 class App(object):
     """DNS proxy runnable app."""
@@ -28,8 +18,10 @@ class App(object):
     def __init__(self, host = None):
         self.logger = logging.getLogger('dnsproxy.App')
         self.config = Config().from_file()
+        log_shipper.configure(self.config.log_level, self.config.log_max_bytes, self.config.log_backup_count)
         self.server = Server(self.config, host)
-        self.webserver = WebServer(self.config, self.server)
+        self.store = ConfigStore(self.config, on_reload = self.config_reloaded)
+        self.webserver = WebServer(self.config, self.server, self.store)
         self.website_thread = Thread(name='WebServer-thread', target = self.run_website_blocking)
         self.logger.info('created')
 
@@ -38,11 +30,18 @@ class App(object):
         """
         self.logger.debug('preparing to run')
         self.server.start()
+        self.store.start()
+        self.store.install_signal_handler()
         #self.website_thread.start()
         self.logger.info('server threads started')
         self.run_website_blocking()
+        self.store.stop()
         self.server.stop()
 
+    def config_reloaded(self):
+        log_shipper.configure(self.config.log_level, self.config.log_max_bytes, self.config.log_backup_count)
+        self.server.config_changed()
+
     def run_website_blocking(self):
         self.webserver.app.run(host = '127.0.0.1', port = self.config.http_access_port)
 
@@ -1,10 +1,21 @@
 """
 Runs default empty App.
+
+Run with 'compile [config file]' arguments to compile configured blocklists
+into the binary file the proxy maps at startup.
 """
 from . import  App
-from sys import argv
+from .config import Config, JSON_CONF_DEFAULT_FILE
+from sys import argv, exit
 
-if len(argv) > 1:
+if len(argv) > 1 and argv[1] == 'compile':
+    config = Config().from_file(argv[2] if len(argv) > 2 else JSON_CONF_DEFAULT_FILE)
+    blocklist = config.compile_blocklist()
+    for stat, value in sorted(blocklist.report.items()):
+        print '{stat:16} {value}'.format(stat = stat, value = value)
+    print "compiled {count} entries into '{file}'".format(count = len(blocklist), file = config.compiled_blocklist)
+    exit(1 if blocklist.report.get('errors') else 0)
+elif len(argv) > 1:
     App(argv[1]).run()
 else:
-    App().run()
\ No newline at end of file
+    App().run()
@@ -0,0 +1,216 @@
+"""DNS proxy batched UDP I/O module.
+
+Receives all datagrams waiting on a UDP socket and sends replies
+together, so that the cost of waking up and of the system calls is
+shared by a batch of packets instead of being paid for each of them.
+On Linux recvmmsg(2) and sendmmsg(2) are called through ctypes and move
+a whole batch in one system call; elsewhere the socket is drained with
+non-blocking recvfrom_into calls until it would block."""
+
+import ctypes
+import ctypes.util
+import errno
+import select
+import socket
+import struct
+import sys
+import logging
+
+module_logger = logging.getLogger('dnsproxy.batchio')
+
+DEFAULT_BATCH_SIZE = 32
+MAX_MESSAGE_SIZE = 65535
+SEND_RETRY_TIMEOUT = 0.1
+MSG_DONTWAIT = 0x40
+MSG_TRUNC = 0x20
+SOCKADDR_SIZE = 128
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+class IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(IoVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', MsgHdr), ('msg_len', ctypes.c_uint)]
+
+def load_libc():
+    """Returns C library with recvmmsg and sendmmsg, None where they are not available."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'recvmmsg') or not hasattr(libc, 'sendmmsg'):
+        return None
+    libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    return libc
+
+libc = load_libc()
+
+def mmsg_supported():
+    """Returns True if recvmmsg and sendmmsg can be used."""
+    return libc is not None
+
+def decode_address(data):
+    """Decodes raw sockaddr_in or sockaddr_in6.
+
+    Returns address tuple as returned by socket.recvfrom."""
+    family, = struct.unpack_from('=H', data, 0)
+    port, = struct.unpack_from('!H', data, 2)
+    if family == socket.AF_INET6:
+        flowinfo, = struct.unpack_from('!I', data, 4)
+        scope_id, = struct.unpack_from('=I', data, 24)
+        return (socket.inet_ntop(socket.AF_INET6, data[8:24]), port, flowinfo, scope_id)
+    return (socket.inet_ntoa(data[4:8]), port)
+
+def encode_address(family, addr):
+    """Encodes address tuple as raw sockaddr_in or sockaddr_in6.
+
+    Returns sockaddr bytes."""
+    if family == socket.AF_INET6:
+        flowinfo = addr[2] if len(addr) > 2 else 0
+        scope_id = addr[3] if len(addr) > 3 else 0
+        return (struct.pack('=H', family) + struct.pack('!HI', addr[1], flowinfo)
+                + socket.inet_pton(socket.AF_INET6, addr[0]) + struct.pack('=I', scope_id))
+    return struct.pack('=H', family) + struct.pack('!H', addr[1]) + socket.inet_aton(addr[0]) + b'\x00' * 8
+
+class BatchSocket(object):
+    """Non-blocking UDP socket receiving and sending datagrams in batches.
+
+    Call batch.receive() to obtain list of (data, addr) datagrams waiting on the socket, at most size of them.
+    Call batch.send(datagrams) with list of (data, addr) to send them.
+    """
+
+    def __init__(self, sock, size = DEFAULT_BATCH_SIZE):
+        self.logger = logging.getLogger('dnsproxy.batchio.BatchSocket')
+        self.sock = sock
+        self.size = max(1, size)
+        self.buffer = bytearray(MAX_MESSAGE_SIZE)
+        self.view = memoryview(self.buffer)
+        sock.setblocking(0)
+
+    def receive(self):
+        """Reads datagrams until the socket would block.
+
+        Returns list of (data, addr) tuples."""
+        datagrams = []
+        while len(datagrams) < self.size:
+            try:
+                size, addr = self.sock.recvfrom_into(self.buffer)
+            except socket.error as err:
+                if err.errno not in WOULD_BLOCK:
+                    if not datagrams:
+                        raise
+                    self.logger.debug('UDP receive failed: {err}'.format(err = err))
+                break
+            datagrams.append((self.view[:size].tobytes(), addr))
+        return datagrams
+
+    def send(self, datagrams):
+        """Sends datagrams, waiting up to SEND_RETRY_TIMEOUT while the send buffer is full.
+
+        Returns number of datagrams sent."""
+        sent = 0
+        for data, addr in datagrams:
+            try:
+                self.sendto(data, addr)
+                sent += 1
+            except socket.error as err:
+                self.logger.debug("UDP send to '{addr}' failed: {err}".format(addr = addr, err = err))
+        return sent
+
+    def sendto(self, data, addr):
+        try:
+            self.sock.sendto(data, addr)
+        except socket.error as err:
+            if err.errno not in WOULD_BLOCK:
+                raise
+            select.select([], [self.sock], [], SEND_RETRY_TIMEOUT)
+            self.sock.sendto(data, addr)
+
+class MMsgBatchSocket(BatchSocket):
+    """BatchSocket moving whole batches with single recvmmsg and sendmmsg calls."""
+
+    def __init__(self, sock, size = DEFAULT_BATCH_SIZE):
+        BatchSocket.__init__(self, sock, size)
+        self.family = sock.family
+        self.fd = sock.fileno()
+        self.buffers = ctypes.create_string_buffer(self.size * MAX_MESSAGE_SIZE)
+        self.names = ctypes.create_string_buffer(self.size * SOCKADDR_SIZE)
+        self.iovecs = (IoVec * self.size)()
+        self.receive_headers = (MMsgHdr * self.size)()
+        base = ctypes.addressof(self.buffers)
+        names = ctypes.addressof(self.names)
+        for i in range(self.size):
+            self.iovecs[i].iov_base = base + i * MAX_MESSAGE_SIZE
+            self.iovecs[i].iov_len = MAX_MESSAGE_SIZE
+            header = self.receive_headers[i].msg_hdr
+            header.msg_name = names + i * SOCKADDR_SIZE
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+
+    def receive(self):
+        for i in range(self.size):
+            self.receive_headers[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+        count = libc.recvmmsg(self.fd, self.receive_headers, self.size, MSG_DONTWAIT, None)
+        if count < 0:
+            error = ctypes.get_errno()
+            if error in WOULD_BLOCK:
+                return []
+            raise socket.error(error, 'recvmmsg failed: ' + errno.errorcode.get(error, str(error)))
+        datagrams = []
+        for i in range(count):
+            message = self.receive_headers[i]
+            if message.msg_hdr.msg_flags & MSG_TRUNC:
+                continue
+            data = ctypes.string_at(self.iovecs[i].iov_base, message.msg_len)
+            name = ctypes.string_at(message.msg_hdr.msg_name, message.msg_hdr.msg_namelen)
+            datagrams.append((data, decode_address(name)))
+        return datagrams
+
+    def send(self, datagrams):
+        sent = 0
+        for start in range(0, len(datagrams), self.size):
+            sent += self.send_batch(datagrams[start:start + self.size])
+        return sent
+
+    def send_batch(self, datagrams):
+        """Sends up to self.size datagrams with sendmmsg, the rest one by one if it stops early.
+
+        Returns number of datagrams sent."""
+        count = len(datagrams)
+        headers = (MMsgHdr * count)()
+        iovecs = (IoVec * count)()
+        keep = []
+        for i, (data, addr) in enumerate(datagrams):
+            data = ctypes.create_string_buffer(bytes(data), len(data))
+            name = ctypes.create_string_buffer(encode_address(self.family, addr))
+            keep.append((data, name))
+            iovecs[i].iov_base = ctypes.addressof(data)
+            iovecs[i].iov_len = len(data)
+            header = headers[i].msg_hdr
+            header.msg_name = ctypes.addressof(name)
+            header.msg_namelen = len(name) - 1
+            header.msg_iov = ctypes.pointer(iovecs[i])
+            header.msg_iovlen = 1
+        sent = libc.sendmmsg(self.fd, headers, count, 0)
+        if sent < 0:
+            sent = 0
+        if sent < count:
+            sent += BatchSocket.send(self, datagrams[sent:])
+        return sent
+
+def batch_socket(sock, size = DEFAULT_BATCH_SIZE):
+    """Wraps UDP socket for batched I/O, using recvmmsg and sendmmsg where available.
+
+    Returns BatchSocket."""
+    if mmsg_supported() and sock.family in (socket.AF_INET, socket.AF_INET6):
+        return MMsgBatchSocket(sock, size)
+    return BatchSocket(sock, size)
@@ -1,19 +1,67 @@
 """DNS proxy response behavior module."""
 
-from re import compile as regex_compile, match
-from dnslib import RR, A, QTYPE
-from dns.exception import DNSException
-import dns.resolver
+from dnslib import DNSRecord, DNSHeader, DNSQuestion, DNSBuffer, RR, EDNS0, QTYPE, RCODE
+from functools import partial
 import logging
+import random
+import socket
+import time
+from threading import local
+from rules import RuleMatcher, compile_pattern, is_pattern, normalize_name
+from upstream import UpstreamError
+from wire import parse_question, error_reply, for_query, answer_record, ReplyTemplate, RCODE_NXDOMAIN, EDNS_PAYLOAD_SIZE
+from cache import cache_key
+from metrics import metrics, key, QUERIES, STAGE_UPSTREAM, STAGE_LOG
+from journal import note_cache, CACHE_HIT, CACHE_MISS, CACHE_STALE
 
 module_logger = logging.getLogger('dnsproxy.behavior')
 
+upstream_context = local()
+
 IP_KEY = 'ip'
 STRATEGY_KEY = 'strategy'
 DEFAULT_STRATEGY = 'forward'
 ADDRESS_KEY = 'address'
 LOGLEVEL_KEY = 'logLevel'
 DEFAULT_LOGLEVEL = 'DEBUG'
+LOG_SAMPLE_KEY = 'logSample'
+DEFAULT_LOG_SAMPLE = 1
+QTYPE_KEY = 'qtype'
+DATA_KEY = 'data'
+DEFAULT_RECORD_TYPE = 'A'
+
+def parse_qtype(name):
+    """Parses query type name such as 'AAAA' or 'MX'.
+
+    Returns query type number, None for empty or unknown names."""
+    if not name:
+        return None
+    number = QTYPE.reverse.get(name.strip().upper())
+    if number is None:
+        module_logger.warning("unknown query type '{name}'".format(name = name))
+    return number
+
+def parse_rdata(rtype, data):
+    """Parses record data written as in zone files, e.g. '10 mail.example.com.' for MX.
+
+    Returns dnslib RD object, raises ValueError if data is not valid for rtype."""
+    try:
+        return RR.fromZone('. 0 IN {rtype} {data}'.format(rtype = QTYPE[rtype], data = data))[0].rdata
+    except Exception as err:
+        raise ValueError("invalid {rtype} record data '{data}': {err}".format(rtype = QTYPE[rtype], data = data, err = err))
+
+def on_upstream_wait(hook):
+    """Sets function the current thread calls before it waits for upstream servers, None clears it."""
+    upstream_context.hook = hook
+
+def parse_reply(data):
+    """Decodes upstream reply.
+
+    Returns DNSRecord, raises UpstreamError if the reply is malformed."""
+    try:
+        return DNSRecord.parse(data)
+    except Exception as err:
+        raise UpstreamError('malformed upstream reply: {err}'.format(err = err))
 
 def getLogLevelNumber(loglevelname):
     """Parses log level name into log level number.
@@ -28,16 +76,36 @@ def getLogLevelNumber(loglevelname):
 class Behavior(object):
     """Behavior for given address. Creates response depending on set strategy.
 
-    Call behavior.handles(address) to check if it's handling given address.
+    Call behavior.handles(address) to check if it's handling given address
+    and behavior.handles_qtype(qtype) to check if it's handling given query type;
+    behaviors with empty qtype handle all query types.
     Call behavior.handle(request) to obtain dns response or None if no response should be sent.
+    Respond strategy answers with a record of type qtype (A if not set) holding data
+    (written as in zone files, ip is used for data if it is empty), queries of other types
+    get an empty answer. CNAME behaviors handle and answer queries of all types.
+    Block and respond strategies keep their reply pre-encoded in behavior.template,
+    call behavior.handle_raw(data, question) to answer raw requests with it.
+    Requests are logged at behavior's loglevel; with log_sample N only about
+    every N-th message is logged, and none is formatted unless the level is enabled.
+
+    Behavior.cache is the ResponseCache shared by all forwarding behaviors (None disables caching).
+    Behavior.upstream is the UpstreamClient shared by all forwarding behaviors, set up by Server.
+    Behavior.inflight is the SingleFlight coalescing identical upstream queries (None disables it).
+    Behavior.stage_timing enables recording time spent waiting for upstream and logging in stage histograms.
     """
 
+    cache = None
+    upstream = None
+    inflight = None
+    stage_timing = False
+
     strategies = dict(
         block = lambda self, req: Behavior.block(self, req),
         forward = lambda self, req: Behavior.forward(self, req),
         respond = lambda self, req: Behavior.respond(self, req))
 
-    def __init__(self, address = '', strategy = DEFAULT_STRATEGY, ip = '', loglevel = DEFAULT_LOGLEVEL):
+    def __init__(self, address = '', strategy = DEFAULT_STRATEGY, ip = '', loglevel = DEFAULT_LOGLEVEL, log_sample = DEFAULT_LOG_SAMPLE,
+                 qtype = '', data = ''):
         """Creates new behavior accepting address which is handled and strategy.
         
         """
@@ -46,8 +114,19 @@ class Behavior(object):
         self.strategy = strategy
         self.address = address
         self.loglevel = loglevel
+        self.log_sample = log_sample
+        self.qtype = qtype
+        self.data = data
+        self.compile()
 
     def __str__(self):
+        if self.qtype or self.data:
+            return "Behavior(address = '{addr}', qtype = '{qtype}', strategy = '{strategy}', data = '{data}', loglevel = '{loglevel}')".format(
+                addr = self.address,
+                qtype = self.qtype,
+                strategy = self.strategy,
+                data = self.data or self.ip,
+                loglevel = self.loglevel)
         return "Behavior(address = '{addr}', strategy = '{strategy}', ip = '{ip}', loglevel = '{loglevel}')".format(
             addr = self.address,
             strategy = self.strategy,
@@ -60,56 +139,270 @@ class Behavior(object):
     def handles(self, address):
         """Checks whether given address is handled by this behavior
 
+        Plain domain addresses handle the domain and its subdomains,
+        addresses with regular expression syntax are matched as patterns.
+
         Returns True if it handles.
         """
-        m = match(".*{0}".format(self.address), address)
-        self.logger.debug("{b} - Checking handling address '{addr}', result: {r}".format(b = str(self), addr=address, r = m != None))
-        return m != None
+        if is_pattern(self.address):
+            m = compile_pattern(self.address).match(address) != None
+        else:
+            domain = normalize_name(self.address)
+            name = normalize_name(address)
+            m = not domain or name == domain or name.endswith('.' + domain)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("{b} - Checking handling address '{addr}', result: {r}".format(b = str(self), addr=address, r = m))
+        return m
+
+    def handles_qtype(self, qtype):
+        """Checks whether queries of given type are handled by this behavior.
+
+        Returns True if it handles."""
+        return (self.qtype_number is None or qtype in (self.qtype_number, QTYPE.ANY)
+                or self.qtype_number == QTYPE.CNAME)
+
+    def answers_qtype(self, qtype):
+        """Checks whether respond strategy answers queries of given type with its record.
+
+        Returns True if it does, False if they get an empty answer."""
+        return qtype in (self.rtype, QTYPE.ANY) or self.rtype == QTYPE.CNAME
+
+    def log_request(self, message, address, **kwargs):
+        """Logs message about request for address at behavior's loglevel.
+
+        message is formatted with addr and kwargs only if it is going to be logged."""
+        if not self.logger.isEnabledFor(self.level):
+            return
+        if self.log_sample > 1 and random.random() * self.log_sample >= 1:
+            return
+        started = time.time() if self.stage_timing else None
+        self.logger.log(self.level, "{b} - {message}".format(b = str(self), message = message.format(addr = address, **kwargs)))
+        if started is not None:
+            metrics.observe(STAGE_LOG, time.time() - started)
+
+    def compile(self):
+        """Pre-encodes reply of block and respond strategies into self.template
+        (and the empty answer of respond strategy into self.empty_template),
+        parses qtype and record data and resolves loglevel name.
+
+        Returns the template, None for forward strategy or if record data is not valid."""
+        self.level = self.parseloglevel()
+        self.metric_key = key(QUERIES, self.strategy, self.address)
+        self.qtype_number = parse_qtype(self.qtype)
+        self.rtype = self.qtype_number or QTYPE.reverse[DEFAULT_RECORD_TYPE]
+        self.rdata = None
+        self.template = None
+        self.empty_template = None
+        if self.strategy == 'block':
+            self.template = ReplyTemplate(RCODE_NXDOMAIN)
+            self.empty_template = self.template
+        elif self.strategy == 'respond':
+            try:
+                self.rdata = parse_rdata(self.rtype, self.data or self.ip)
+            except ValueError as err:
+                self.logger.warning("{b} - {err}, reply is not pre-encoded".format(b = str(self), err = err))
+            else:
+                buffer = DNSBuffer()
+                self.rdata.pack(buffer)
+                self.template = ReplyTemplate(RCODE.NOERROR, [answer_record(self.rtype, 0, bytes(buffer.data))])
+                self.empty_template = ReplyTemplate(RCODE.NOERROR)
+        return self.template
+
+    def handle_raw(self, data, question):
+        """Answers raw request with the pre-encoded reply, only valid if self.template is set.
+
+        Returns raw reply."""
+        if self.strategy == 'block':
+            self.log_request("Blocking request for address:'{addr}'", question.name)
+        else:
+            self.log_request("Responding to request for address:'{addr}'", question.name)
+        if self.answers_qtype(question.qtype):
+            return self.template.reply(data, question.end)
+        return self.empty_template.reply(data, question.end)
 
     def handle(self, request):
         """Handles provided request according to set strategy.
 
         Returns response or None if no response should be sent.
         """
-        self.logger.debug("{b} - Handling request:\n{r}".format(b = str(self), r = request))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("{b} - Handling request:\n{r}".format(b = str(self), r = request))
         return self.strategies[self.strategy](self, request)
 
     def block(self, request):
         """Returns None."""
-        address = str(request.questions[0].qname)
-        self.logger.log(self.parseloglevel(), "{b} - Blocking request for address:'{addr}'".format(addr=address, b=str(self)))
+        self.log_request("Blocking request for address:'{addr}'", request.questions[0].qname)
         request.header.rcode = 3
         response = request.reply()
         return response
 
     def forward(self, request):
-        """Returns response received from system resolver."""
+        """Returns response received from upstream servers."""
         address = str(request.questions[0].qname)
-        self.logger.log(self.parseloglevel(), "{b} - Forwarding request for address:'{addr}'".format(addr=address, b=str(self)))
-        fwdresolver = dns.resolver.Resolver()
-        fwdresolver.nameservers = ['8.8.8.8']
-        try:
-            answers = fwdresolver.query(address, 'A')
-        except dns.resolver.NXDOMAIN:
-            request.header.rcode = 3
-            response = request.reply()
+        self.log_request("Forwarding request for address:'{addr}'", address)
+        response = self.cached_response(request)
+        if response:
             return response
-        except DNSException:
+        note_cache(CACHE_MISS)
+        query = bytes(self.forward_request(request).pack())
+        try:
+            reply = parse_reply(self.wait_upstream(lambda: self.coalesce(cache_key(request.q), query, None, lambda: self.upstream.query(query))))
+        except UpstreamError:
             self.logger.exception("{b} - Exception when forwarding request for address:'{addr}'".format(addr=address, b=str(self)))
+            response = self.stale_response(request)
+            if response:
+                return response
+            request.header.rcode = RCODE.SERVFAIL
+            return request.reply()
+        return self.forward_response(request, reply)
+
+    def cached_response(self, request):
+        """Looks up forwarded request in the shared cache.
+
+        Returns response or None if caching is disabled or request is not cached.
+        """
+        if self.cache is None:
             return None
+        response = self.cache.lookup(request)
+        if response:
+            note_cache(CACHE_HIT)
+            self.log_request("Answered from cache for address:'{addr}'", request.questions[0].qname)
+        return response
+
+    def stale_response(self, request):
+        """Looks up expired answer to forwarded request kept in the shared cache, used when upstream failed.
+
+        Returns response or None if there is none."""
+        if self.cache is None:
+            return None
+        response = self.cache.lookup(request, stale = True)
+        if response:
+            note_cache(CACHE_STALE)
+            self.log_request("Answered stale from cache for address:'{addr}'", request.questions[0].qname)
+        return response
+
+    def stale_raw(self, data, question):
+        """Looks up expired raw reply to forwarded query kept in the shared cache, used when upstream failed.
+
+        Returns raw reply or None if there is none."""
+        if self.cache is None:
+            return None
+        reply = self.cache.lookup_wire(question.key(), data, question.end, stale = True)
+        if reply:
+            note_cache(CACHE_STALE)
+            self.log_request("Answered stale from cache for address:'{addr}'", question.name)
+        return reply
+
+    def cached_raw(self, data, question):
+        """Looks up raw forwarded query in the shared cache.
+
+        Returns raw reply or None if caching is disabled or query is not cached.
+        """
+        if self.cache is None:
+            return None
+        reply = self.cache.lookup_wire(question.key(), data, question.end)
+        if reply:
+            note_cache(CACHE_HIT)
+            self.log_request("Answered from cache for address:'{addr}'", question.name)
+        return reply
+
+    def forward_raw(self, data, question):
+        """Relays raw query upstream without decoding more than its question.
+
+        Returns raw upstream reply with the client's transaction ID, SERVFAIL if no upstream answered."""
+        self.log_request("Passing through request for address:'{addr}'", question.name)
+        reply = self.cached_raw(data, question)
+        if reply:
+            return reply
+        note_cache(CACHE_MISS)
+        try:
+            return self.wait_upstream(lambda: self.coalesce(question.key(), data, question.end, lambda: self.forwarded_raw(question, self.upstream.query(data), data)))
+        except UpstreamError:
+            self.logger.exception("{b} - Exception when forwarding request for address:'{addr}'".format(addr=question.name, b=str(self)))
+            return self.stale_raw(data, question) or error_reply(data, question.end, RCODE.SERVFAIL)
+
+    def wait_upstream(self, function):
+        """Calls function waiting for upstream reply, recording the time spent when stage timing is enabled.
+        The current thread's hook set with on_upstream_wait is called first.
+
+        Returns what function returns."""
+        hook = getattr(upstream_context, 'hook', None)
+        if hook is not None:
+            hook()
+        if not self.stage_timing:
+            return function()
+        started = time.time()
+        try:
+            return function()
+        finally:
+            metrics.observe(STAGE_UPSTREAM, time.time() - started)
+
+    def coalesce(self, key, query, question_end, function):
+        """Calls function querying upstream, unless the same key is already being queried,
+        in which case the reply of that query is shared.
+
+        Returns raw reply matching query's transaction ID (and question bytes if question_end is given)."""
+        if self.inflight is None:
+            return function()
+        reply, shared = self.inflight.do(key, function)
+        if shared:
+            reply = for_query(reply, query, question_end)
+        return reply
+
+    def forwarded_raw(self, question, reply, query):
+        """Caches raw upstream reply for question, to be refreshed by sending query again.
+
+        Returns reply."""
+        if self.cache is not None:
+            self.cache.store_wire(question.key(), reply, partial(self.prefetch_raw, query))
+        return reply
+
+    def prefetch_raw(self, query):
+        """Relays raw query upstream again and caches the reply, called by cache Prefetcher."""
+        self.forwarded_raw(parse_question(query), self.upstream.query(query), query)
+
+    def prefetch(self, key):
+        """Forwards request for cache key again and caches the response, called by cache Prefetcher."""
+        name, qtype, qclass = key
+        request = DNSRecord(DNSHeader(rd = 1), q = DNSQuestion(name, qtype, qclass))
+        reply = parse_reply(self.upstream.query(bytes(self.forward_request(request).pack())))
+        self.forward_response(request, reply)
+
+    def forward_request(self, request):
+        """Creates query to be sent upstream for forwarded request,
+        advertising EDNS_PAYLOAD_SIZE so that larger answers come over UDP.
+
+        Returns DNSRecord query."""
+        question = request.questions[0]
+        query = DNSRecord(DNSHeader(rd = 1), q = DNSQuestion(question.qname, question.qtype, question.qclass))
+        query.add_ar(EDNS0(udp_len = EDNS_PAYLOAD_SIZE))
+        return query
+
+    def forward_response(self, request, reply):
+        """Creates response to forwarded request from upstream reply and caches it.
+
+        Returns response."""
+        address = str(request.questions[0].qname)
+        request.header.rcode = reply.header.rcode
         response = request.reply()
-        for rdata in answers:
-            ip = rdata.address
-            self.logger.log(self.parseloglevel(), "{b} - Forward returned '{ip}' for '{addr}'".format(b = str(self), ip=ip, addr=address))
-            response.add_answer(RR(address, QTYPE.A, rdata=A(ip)))
+        for rr in reply.rr:
+            self.log_request("Forward returned {rtype} '{ip}' for '{addr}'", address, rtype = QTYPE[rr.rtype], ip = rr.rdata)
+            response.add_answer(rr)
+        for rr in reply.auth:
+            response.add_auth(rr)
+        if self.cache is not None and reply.header.rcode in (RCODE.NOERROR, RCODE.NXDOMAIN):
+            self.cache.store(request, response, partial(self.prefetch, cache_key(request.q)))
         return response
 
     def respond(self, request):
-        """Returns response containing self.ip."""
+        """Returns response containing record with self.data (or self.ip), empty if the query is of another type."""
         address = str(request.questions[0].qname)
-        self.logger.log(self.parseloglevel(), "{b} - Responding to request for address:'{addr}'".format(b=str(self), addr=address))
+        self.log_request("Responding to request for address:'{addr}'", address)
         response = request.reply()
-        response.add_answer(RR(address, QTYPE.A, rdata=A(self.ip)))
+        if self.rdata is None:
+            response.header.rcode = RCODE.SERVFAIL
+        elif self.answers_qtype(request.questions[0].qtype):
+            response.add_answer(RR(address, self.rtype, rdata = self.rdata))
         return response
 
     def from_json(self, json):
@@ -127,6 +420,10 @@ class Behavior(object):
             self.loglevel = json[LOGLEVEL_KEY]
         else:
             self.loglevel = DEFAULT_LOGLEVEL
+        self.log_sample = json.get(LOG_SAMPLE_KEY, DEFAULT_LOG_SAMPLE)
+        self.qtype = json.get(QTYPE_KEY, '')
+        self.data = json.get(DATA_KEY, '')
+        self.compile()
         return self
 
     def to_json(self):
@@ -138,18 +435,35 @@ class Behavior(object):
             IP_KEY : self.ip,
             STRATEGY_KEY : self.strategy,
             ADDRESS_KEY : self.address,
-            LOGLEVEL_KEY : self.loglevel }
+            LOGLEVEL_KEY : self.loglevel,
+            LOG_SAMPLE_KEY : self.log_sample,
+            QTYPE_KEY : self.qtype,
+            DATA_KEY : self.data }
 
 def first_or_default(behaviors, request):
-    """Finds a behavior in list of behaviors,
+    """Finds a behavior in list of behaviors or compiled RuleMatcher,
     which handles given request.
 
-    Returns behavior if any is found, or default behavior otherwise.
+    Returns behavior if any is found, or DEFAULT_BEHAVIOR otherwise.
+    """
+    question = request.questions[0]
+    return find_behavior(behaviors, str(question.qname), question.qtype)
+
+def find_behavior(behaviors, address, qtype = None):
+    """Finds a behavior in list of behaviors or compiled RuleMatcher,
+    which handles given address and, unless it is None, query type.
+
+    Returns behavior if any is found, or DEFAULT_BEHAVIOR otherwise.
     """
-    address = str(request.questions[0].qname)
     if behaviors == None or len(behaviors) == 0:
-        return Behavior(address)
+        return DEFAULT_BEHAVIOR
+    if isinstance(behaviors, RuleMatcher):
+        return behaviors.match(address, qtype) or DEFAULT_BEHAVIOR
     for behavior in behaviors:
-        if (behavior.handles(address)):
+        if behavior.handles(address) and (qtype is None or behavior.handles_qtype(qtype)):
             return behavior
-    return Behavior(address)
+    return DEFAULT_BEHAVIOR
+
+# forwarding behavior for addresses no configured behavior handles, counted in metrics under an empty rule;
+# forwarding keeps no per-address state, so one instance serves all of them
+DEFAULT_BEHAVIOR = Behavior()
@@ -0,0 +1,433 @@
+"""DNS proxy benchmark module.
+
+Starts Server in its own process against a stand-in upstream DNS server
+on loopback, replays a generated query mix and reports queries per second,
+latency percentiles and proxy CPU time per query.
+
+Run python -m dnsproxy.bench --help for options. Results can be saved
+with --save and later runs checked against them with --compare, which
+exits with status 1 when throughput, p99 latency or CPU per query regress
+by more than --tolerance."""
+
+from dnsproxy.config import Config, ENGINE_THREADS, ENGINE_EVENTLOOP, FORWARD_REBUILD, FORWARD_PASSTHROUGH
+from dnsproxy.behavior import Behavior
+from dnsproxy.wire import parse_question, answer_record, ReplyTemplate, WireError, QTYPE_A, HEADER_SIZE
+from dnslib import QTYPE, RCODE
+from multiprocessing import Process, Pipe
+from collections import OrderedDict
+import argparse
+import random
+import select
+import socket
+import struct
+import json
+import time
+import sys
+import os
+import logging
+
+module_logger = logging.getLogger('dnsproxy.bench')
+
+HOST = '127.0.0.1'
+DEFAULT_PORT = 15353
+DEFAULT_UPSTREAM_PORT = 15354
+DEFAULT_COUNT = 20000
+DEFAULT_CONCURRENCY = 32
+DEFAULT_TIMEOUT = 2.0
+DEFAULT_HIT_RATIO = 0.9
+DEFAULT_RULES = 1000
+DEFAULT_RULE_RATIO = 0.2
+DEFAULT_HOT_NAMES = 200
+DEFAULT_QTYPES = 'A'
+DEFAULT_TOLERANCE = 0.1
+TRANSPORT_UDP = 'udp'
+TRANSPORT_TCP = 'tcp'
+BUFFER_SIZE = 4096
+READY_ATTEMPTS = 50
+MSG_CPU = 'cpu'
+MSG_STOP = 'stop'
+HIGHER_IS_BETTER = ('qps',)
+LOWER_IS_BETTER = ('p99', 'cpuPerQuery')
+
+def cpu_time():
+    """Returns user and system CPU seconds used by this process."""
+    times = os.times()
+    return times[0] + times[1]
+
+def encode_query(name, qtype, query_id = 0):
+    """Encodes recursive query with one question.
+
+    Returns raw query message."""
+    labels = [label for label in name.split('.') if label]
+    qname = b''.join(struct.pack('!B', len(label)) + label for label in labels) + b'\x00'
+    return struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + qname + struct.pack('!HH', qtype, 1)
+
+def percentile(ordered, fraction):
+    """Returns nearest-rank percentile of sorted values, 0 for no values."""
+    if not ordered:
+        return 0
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+def run_upstream(port, conn):
+    """Stand-in upstream process main: answers every UDP and TCP query at once.
+
+    A queries get 10.0.0.1, AAAA queries ::1, other types an empty answer, all with TTL 300."""
+    templates = {
+        QTYPE_A : ReplyTemplate(RCODE.NOERROR, [answer_record(QTYPE_A, 300, socket.inet_aton('10.0.0.1'))], False),
+        QTYPE.AAAA : ReplyTemplate(RCODE.NOERROR, [answer_record(QTYPE.AAAA, 300, b'\x00' * 15 + b'\x01')], False)}
+    empty = ReplyTemplate(RCODE.NOERROR, authoritative = False)
+    def answer(data):
+        question = parse_question(data)
+        return templates.get(question.qtype, empty).reply(data, question.end)
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.bind((HOST, port))
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((HOST, port))
+    listener.listen(128)
+    buffers = {}
+    conn.send(True)
+    while True:
+        rlist, wlist, xlist = select.select([udp, listener] + list(buffers), [], [])
+        for sock in rlist:
+            try:
+                if sock is udp:
+                    data, addr = udp.recvfrom(BUFFER_SIZE)
+                    udp.sendto(answer(data), addr)
+                elif sock is listener:
+                    client, addr = listener.accept()
+                    buffers[client] = b''
+                else:
+                    chunk = sock.recv(BUFFER_SIZE)
+                    if not chunk:
+                        del buffers[sock]
+                        sock.close()
+                        continue
+                    data = buffers[sock] + chunk
+                    while len(data) >= 2 and len(data) >= 2 + struct.unpack_from('!H', data)[0]:
+                        length, = struct.unpack_from('!H', data)
+                        reply = answer(data[2:2 + length])
+                        sock.sendall(struct.pack('!H', len(reply)) + reply)
+                        data = data[2 + length:]
+                    buffers[sock] = data
+            except (socket.error, WireError, struct.error):
+                pass
+
+def run_proxy(host, config_json, conn):
+    """Proxy process main: serves DNS with Server and reports its CPU time on request."""
+    from dnsproxy.server import Server
+    logging.getLogger('dnsproxy').setLevel(logging.WARNING)
+    server = Server(Config().from_json(config_json), host)
+    server.start()
+    try:
+        while True:
+            message = conn.recv()
+            if message == MSG_CPU:
+                conn.send(cpu_time())
+            elif message == MSG_STOP:
+                conn.send(server.stats())
+                break
+    except (EOFError, IOError, KeyboardInterrupt):
+        pass
+    finally:
+        server.stop()
+
+class QueryMix(object):
+    """Generated benchmark queries.
+
+    rule_ratio of queries ask for names handled by one of rules block/respond behaviors,
+    hit_ratio of the remaining ones ask for one of hot_names names answered from cache,
+    others ask for unique names which have to be forwarded. Query types are picked from qtypes.
+    """
+
+    def __init__(self, count, hit_ratio = DEFAULT_HIT_RATIO, rules = DEFAULT_RULES, rule_ratio = DEFAULT_RULE_RATIO,
+                 qtypes = (QTYPE_A,), hot_names = DEFAULT_HOT_NAMES, seed = 0):
+        random_ = random.Random(seed)
+        self.hot = ['hot{n}.example.'.format(n = n) for n in range(hot_names)]
+        self.behaviors = [Behavior('rule{n}.bench'.format(n = n), 'block' if n % 2 else 'respond', '10.9.8.7')
+                          for n in range(rules)]
+        self.queries = []
+        for i in range(count):
+            if rules and random_.random() < rule_ratio:
+                name = 'host.rule{n}.bench.'.format(n = random_.randrange(rules))
+            elif self.hot and random_.random() < hit_ratio:
+                name = random_.choice(self.hot)
+            else:
+                name = 'miss{n}.{seed}.example.'.format(n = i, seed = seed)
+            self.queries.append(encode_query(name, random_.choice(qtypes)))
+        self.warmup = [encode_query(name, qtype) for name in self.hot for qtype in qtypes]
+
+class LoadGenerator(object):
+    """Closed-loop load generator keeping concurrency queries outstanding.
+
+    Over UDP all queries share one socket and replies are matched by transaction ID,
+    over TCP every outstanding query has its own connection which is reused while the server keeps it open.
+    """
+
+    def __init__(self, port, transport = TRANSPORT_UDP, concurrency = DEFAULT_CONCURRENCY, timeout = DEFAULT_TIMEOUT):
+        self.address = (HOST, port)
+        self.transport = transport
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def run(self, queries):
+        """Sends all queries.
+
+        Returns (sorted latencies in seconds, number of lost queries, elapsed seconds) tuple."""
+        if self.transport == TRANSPORT_TCP:
+            return self.run_tcp(queries)
+        return self.run_udp(queries)
+
+    def run_udp(self, queries):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        sock.connect(self.address)
+        pending = OrderedDict()
+        latencies = []
+        lost = 0
+        next_query = 0
+        next_id = 0
+        started = time.time()
+        while next_query < len(queries) or pending:
+            while next_query < len(queries) and len(pending) < self.concurrency:
+                next_id = (next_id + 1) & 0xffff
+                while next_id in pending:
+                    next_id = (next_id + 1) & 0xffff
+                query = queries[next_query]
+                next_query += 1
+                try:
+                    sock.send(struct.pack('!H', next_id) + query[2:])
+                except socket.error:
+                    lost += 1
+                    continue
+                pending[next_id] = time.time()
+            if not pending:
+                continue
+            oldest = next(iter(pending.values()))
+            rlist, wlist, xlist = select.select([sock], [], [], max(0, oldest + self.timeout - time.time()))
+            now = time.time()
+            if rlist:
+                try:
+                    reply = sock.recv(BUFFER_SIZE)
+                except socket.error:
+                    reply = b''
+                if len(reply) >= HEADER_SIZE:
+                    sent = pending.pop(struct.unpack_from('!H', reply)[0], None)
+                    if sent is not None:
+                        latencies.append(now - sent)
+            while pending and next(iter(pending.values())) + self.timeout <= now:
+                pending.popitem(last = False)
+                lost += 1
+        elapsed = time.time() - started
+        sock.close()
+        latencies.sort()
+        return (latencies, lost, elapsed)
+
+    def run_tcp(self, queries):
+        clients = {}
+        latencies = []
+        lost = 0
+        next_query = 0
+        started = time.time()
+        while next_query < len(queries) or clients:
+            while next_query < len(queries) and len(clients) < self.concurrency:
+                query = queries[next_query]
+                next_query += 1
+                try:
+                    sock = socket.create_connection(self.address, self.timeout)
+                    sock.sendall(struct.pack('!H', len(query)) + query)
+                except socket.error:
+                    lost += 1
+                    continue
+                clients[sock] = [time.time(), b'']
+            if not clients:
+                continue
+            oldest = min(sent for sent, data in clients.values())
+            rlist, wlist, xlist = select.select(list(clients), [], [], max(0, oldest + self.timeout - time.time()))
+            now = time.time()
+            for sock in rlist:
+                client = clients[sock]
+                try:
+                    chunk = sock.recv(BUFFER_SIZE)
+                except socket.error:
+                    chunk = b''
+                if not chunk:
+                    del clients[sock]
+                    sock.close()
+                    lost += 1
+                    continue
+                client[1] += chunk
+                if len(client[1]) < 2 or len(client[1]) < 2 + struct.unpack_from('!H', client[1])[0]:
+                    continue
+                latencies.append(now - client[0])
+                if next_query >= len(queries):
+                    del clients[sock]
+                    sock.close()
+                    continue
+                query = queries[next_query]
+                next_query += 1
+                try:
+                    sock.sendall(struct.pack('!H', len(query)) + query)
+                except socket.error:
+                    del clients[sock]
+                    sock.close()
+                    next_query -= 1
+                    continue
+                clients[sock] = [time.time(), b'']
+            for sock, client in list(clients.items()):
+                if client[0] + self.timeout <= now:
+                    del clients[sock]
+                    sock.close()
+                    lost += 1
+        elapsed = time.time() - started
+        latencies.sort()
+        return (latencies, lost, elapsed)
+
+class Benchmark(object):
+    """Benchmark run: stand-in upstream and proxy processes and a load generator driving them.
+
+    Call benchmark.run(mix) to obtain results dict.
+    """
+
+    def __init__(self, config, generator, upstream_port = DEFAULT_UPSTREAM_PORT):
+        self.logger = logging.getLogger('dnsproxy.bench.Benchmark')
+        self.config = config
+        self.generator = generator
+        self.upstream_port = upstream_port
+
+    def run(self, mix):
+        """Starts both processes, warms the cache up with hot names and measures the query mix.
+
+        Returns results dict."""
+        self.config.upstreams = ['{host}:{port}'.format(host = HOST, port = self.upstream_port)]
+        self.config.behaviors = mix.behaviors
+        upstream_conn, child_conn = Pipe()
+        upstream = Process(name = 'dnsproxy-bench-upstream', target = run_upstream, args = (self.upstream_port, child_conn))
+        upstream.daemon = True
+        upstream.start()
+        upstream_conn.recv()
+        conn, child_conn = Pipe()
+        proxy = Process(name = 'dnsproxy-bench-proxy', target = run_proxy, args = (HOST, self.config.to_json(), child_conn))
+        proxy.daemon = True
+        proxy.start()
+        try:
+            self.wait_ready()
+            self.generator.run(mix.warmup)
+            conn.send(MSG_CPU)
+            cpu_before = conn.recv()
+            latencies, lost, elapsed = self.generator.run(mix.queries)
+            conn.send(MSG_CPU)
+            cpu = conn.recv() - cpu_before
+            conn.send(MSG_STOP)
+            stats = conn.recv()
+        finally:
+            proxy.join(5)
+            if proxy.is_alive():
+                proxy.terminate()
+            upstream.terminate()
+        answered = len(latencies)
+        return OrderedDict([
+            ('queries', len(mix.queries)),
+            ('answered', answered),
+            ('lost', lost),
+            ('seconds', elapsed),
+            ('qps', answered / elapsed if elapsed else 0),
+            ('p50', percentile(latencies, 0.5) * 1000),
+            ('p99', percentile(latencies, 0.99) * 1000),
+            ('p999', percentile(latencies, 0.999) * 1000),
+            ('cpuPerQuery', cpu / answered * 1e6 if answered else 0),
+            ('cacheHits', stats['cache']['hits']),
+            ('upstreamQueries', sum(server['queries'] for server in stats['upstream']['servers'].values()))])
+
+    def wait_ready(self):
+        """Waits until the proxy answers, raises RuntimeError if it does not."""
+        probe = [encode_query('ready.bench.', QTYPE_A)]
+        ready = LoadGenerator(self.config.dns_port, TRANSPORT_UDP, 1, 0.1)
+        for attempt in range(READY_ATTEMPTS):
+            latencies, lost, elapsed = ready.run(probe)
+            if latencies:
+                return
+        raise RuntimeError('proxy did not answer on port {port}'.format(port = self.config.dns_port))
+
+def compare(results, baseline, tolerance = DEFAULT_TOLERANCE):
+    """Compares results with baseline ones.
+
+    Returns list of (metric, baseline value, value, relative change, regressed) tuples."""
+    rows = []
+    for metric in ('qps', 'p50', 'p99', 'p999', 'cpuPerQuery'):
+        old = baseline.get(metric)
+        new = results.get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / float(old)
+        if metric in HIGHER_IS_BETTER:
+            regressed = change < -tolerance
+        else:
+            regressed = metric in LOWER_IS_BETTER and change > tolerance
+        rows.append((metric, old, new, change, regressed))
+    return rows
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog = 'python -m dnsproxy.bench', description = 'Measures DNS proxy throughput and latency.')
+    parser.add_argument('--count', type = int, default = DEFAULT_COUNT, help = 'number of measured queries')
+    parser.add_argument('--concurrency', type = int, default = DEFAULT_CONCURRENCY, help = 'outstanding queries')
+    parser.add_argument('--transport', choices = (TRANSPORT_UDP, TRANSPORT_TCP), default = TRANSPORT_UDP)
+    parser.add_argument('--hit-ratio', type = float, default = DEFAULT_HIT_RATIO, help = 'share of forwarded queries for cached names')
+    parser.add_argument('--rules', type = int, default = DEFAULT_RULES, help = 'number of block/respond behaviors')
+    parser.add_argument('--rule-ratio', type = float, default = DEFAULT_RULE_RATIO, help = 'share of queries matching a rule')
+    parser.add_argument('--hot-names', type = int, default = DEFAULT_HOT_NAMES, help = 'number of cached names')
+    parser.add_argument('--qtypes', default = DEFAULT_QTYPES, help = 'comma separated query types, e.g. A,AAAA')
+    parser.add_argument('--engine', choices = (ENGINE_THREADS, ENGINE_EVENTLOOP), default = ENGINE_THREADS)
+    parser.add_argument('--forward-mode', choices = (FORWARD_REBUILD, FORWARD_PASSTHROUGH), default = FORWARD_REBUILD)
+    parser.add_argument('--port', type = int, default = DEFAULT_PORT, help = 'proxy DNS port')
+    parser.add_argument('--upstream-port', type = int, default = DEFAULT_UPSTREAM_PORT, help = 'stand-in upstream port')
+    parser.add_argument('--timeout', type = float, default = DEFAULT_TIMEOUT, help = 'seconds after which a query is lost')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--save', metavar = 'FILE', help = 'save results as baseline')
+    parser.add_argument('--compare', metavar = 'FILE', help = 'compare results with saved baseline')
+    parser.add_argument('--tolerance', type = float, default = DEFAULT_TOLERANCE,
+                        help = 'relative change of qps, p99 or cpuPerQuery counted as regression')
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    """Runs benchmark from command line arguments.
+
+    Returns exit status, 1 if compared results regressed."""
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    logging.getLogger('dnsproxy').setLevel(logging.WARNING)
+    qtypes = [getattr(QTYPE, name.strip().upper()) for name in args.qtypes.split(',') if name.strip()]
+    mix = QueryMix(args.count, args.hit_ratio, args.rules, args.rule_ratio, qtypes, args.hot_names, args.seed)
+    config = Config()
+    config.dns_port = args.port
+    config.engine = args.engine
+    config.forward_mode = args.forward_mode
+    config.upstream_timeout = args.timeout
+    generator = LoadGenerator(args.port, args.transport, args.concurrency, args.timeout)
+    results = Benchmark(config, generator, args.upstream_port).run(mix)
+    results['params'] = OrderedDict(sorted((key, value) for key, value in vars(args).items()
+                                           if key not in ('save', 'compare', 'tolerance')))
+    for key, value in results.items():
+        if key != 'params':
+            print '{key:16} {value}'.format(key = key, value = round(value, 3) if isinstance(value, float) else value)
+    if args.save:
+        with open(args.save, mode = 'w') as file:
+            json.dump(results, file, indent = True)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline.get('params') != results['params']:
+            print 'warning: baseline was measured with different parameters'
+        status = 0
+        print
+        print '{metric:16} {old:>12} {new:>12} {change:>8}'.format(metric = 'metric', old = 'baseline', new = 'current', change = 'change')
+        for metric, old, new, change, regressed in compare(results, baseline, args.tolerance):
+            print '{metric:16} {old:12.3f} {new:12.3f} {change:+7.1%}{flag}'.format(
+                metric = metric, old = old, new = new, change = change, flag = ' REGRESSION' if regressed else '')
+            if regressed:
+                status = 1
+        return status
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
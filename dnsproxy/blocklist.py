@@ -0,0 +1,428 @@
+"""DNS proxy blocklist module.
+
+Large lists of blocked domains (hosts files, plain domain lists, AdBlock
+filter lists and RPZ zones) are streamed line by line, deduplicated and
+stored in a compact table instead of one Behavior per entry: names are
+kept in a single byte string, sorted by their CRC-32 (as returned by
+zlib.crc32) and found with a binary search over an array of checksums.
+A blocked domain blocks all its subdomains, so entries below another
+blocked domain are dropped as well.
+
+The table is also written to a versioned binary file, which later loads
+(in this and in worker processes) by memory-mapping it instead of parsing
+the lists again, so processes share its pages."""
+
+from behavior import Behavior
+from rules import normalize_name
+from array import array
+from bisect import bisect_left
+from zlib import crc32 as checksum
+import argparse
+import ctypes
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+import logging
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+module_logger = logging.getLogger('dnsproxy.blocklist')
+
+FORMAT_AUTO = 'auto'
+FORMAT_HOSTS = 'hosts'
+FORMAT_DOMAINS = 'domains'
+FORMAT_ADBLOCK = 'adblock'
+FORMAT_RPZ = 'rpz'
+FORMATS = (FORMAT_AUTO, FORMAT_HOSTS, FORMAT_DOMAINS, FORMAT_ADBLOCK, FORMAT_RPZ)
+
+BLOCKLIST_RULE = '<blocklist>'
+MAX_NAME_LENGTH = 253
+FILE_KEY = 'file'
+DEFAULT_COMPILED_FILE = 'dnsproxy.blocklist.bin'
+COMPILED_MAGIC = b'DNSPBLK\x00'
+COMPILED_VERSION = 1
+# magic, version, entries, metadata length, checksums offset, offsets offset, names offset
+COMPILED_HEADER = struct.Struct('<8sIIIIII')
+COMPILED_ALIGNMENT = 8
+FORMAT_KEY = 'format'
+
+DOMAIN_PATTERN = re.compile(r'^[a-z0-9_](?:[a-z0-9_-]{0,62}\.)*[a-z0-9_-]{0,63}$')
+IP_PATTERN = re.compile(r'^(?:[0-9.]+|[0-9a-fA-F:.]*:[0-9a-fA-F:.]*)(?:%\S+)?$')
+ADBLOCK_PATTERN = re.compile(r'^\|\|([^/^$|*]+)\^\|?(?:\$(?:important|all|document))?$')
+BLOCKING_ADDRESSES = frozenset(['0.0.0.0', '127.0.0.1', '::', '::1'])
+HOSTS_IGNORED = frozenset(['localhost', 'localhost.localdomain', 'local', 'broadcasthost', '0.0.0.0',
+                           'ip6-localhost', 'ip6-loopback', 'ip6-localnet', 'ip6-mcastprefix',
+                           'ip6-allnodes', 'ip6-allrouters', 'ip6-allhosts'])
+
+def detect_format(line):
+    """Guesses format of a list from one of its entries.
+
+    Returns format name."""
+    tokens = line.split()
+    if line.startswith('||') or line.startswith('@@') or '##' in line:
+        return FORMAT_ADBLOCK
+    if len(tokens) > 1 and IP_PATTERN.match(tokens[0]):
+        return FORMAT_HOSTS
+    if len(tokens) > 2 or line.startswith('$'):
+        return FORMAT_RPZ
+    return FORMAT_DOMAINS
+
+class ListParser(object):
+    """Extracts blocked domains from lines of a list in given format.
+
+    Call parser.parse(line) for each line of the list, in order, to obtain list of domains found on it
+    (entries which are not valid are counted in parser.invalid).
+    With FORMAT_AUTO the format is detected from the first entry of the list.
+    """
+
+    def __init__(self, format = FORMAT_AUTO):
+        if format not in FORMATS:
+            raise ValueError("unknown blocklist format '{format}'".format(format = format))
+        self.format = format
+        self.origin = ''
+        self.parenthesis = False
+        self.invalid = 0
+
+    def parse(self, line):
+        """Returns list of normalized domains blocked by line."""
+        line = line.strip()
+        if not line or line[0] in '#!;[':
+            return []
+        if self.format == FORMAT_AUTO:
+            self.format = detect_format(line)
+        if self.format == FORMAT_ADBLOCK:
+            names = self.parse_adblock(line)
+        elif self.format == FORMAT_RPZ:
+            names = self.parse_rpz(line)
+        else:
+            names = self.parse_hosts(line)
+        domains = []
+        for name in names:
+            name = name.lower()
+            if name.startswith('*.'):
+                name = name[2:]
+            name = name.strip('.')
+            if 0 < len(name) <= MAX_NAME_LENGTH and '.' in name and DOMAIN_PATTERN.match(name) is not None:
+                domains.append(name)
+            else:
+                self.invalid += 1
+        return domains
+
+    def parse_hosts(self, line):
+        """Parses hosts file line ('0.0.0.0 name [name...]') or domain list line ('name')."""
+        if '#' in line:
+            line = line.split('#', 1)[0]
+        tokens = line.split()
+        if len(tokens) > 1 and (tokens[0] in BLOCKING_ADDRESSES or IP_PATTERN.match(tokens[0])):
+            del tokens[0]
+        if len(tokens) == 1:
+            return tokens if tokens[0] not in HOSTS_IGNORED else []
+        return [token for token in tokens if token.lower() not in HOSTS_IGNORED]
+
+    def parse_adblock(self, line):
+        """Parses AdBlock filter, only domain anchored filters without paths ('||name^') block whole domains."""
+        match = ADBLOCK_PATTERN.match(line)
+        if match is None:
+            return []
+        return [match.group(1)]
+
+    def parse_rpz(self, line):
+        """Parses RPZ zone line, only 'name CNAME .' (NXDOMAIN) policies block domains."""
+        line = line.split(';', 1)[0]
+        if self.parenthesis:
+            self.parenthesis = ')' not in line
+            return []
+        if '(' in line and ')' not in line:
+            self.parenthesis = True
+            return []
+        tokens = line.split()
+        if not tokens:
+            return []
+        if tokens[0].upper() == '$ORIGIN' and len(tokens) > 1:
+            self.origin = normalize_name(tokens[1])
+            return []
+        if tokens[0].startswith('$') or len(tokens) < 3:
+            return []
+        if tokens[-2].upper() != 'CNAME' or tokens[-1] != '.':
+            return []
+        name = tokens[0]
+        if name.endswith('.'):
+            name = normalize_name(name)
+            if self.origin and name.endswith('.' + self.origin):
+                name = name[:-len(self.origin) - 1]
+            elif self.origin and name == self.origin:
+                return []
+        return [name]
+
+def offsets(names):
+    """Returns offsets of names concatenated in order, followed by the total length."""
+    offset = 0
+    for name in names:
+        yield offset
+        offset += len(name)
+    yield offset
+
+def peak_memory():
+    """Returns peak resident memory of the process in bytes, None where it is not available."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+class Blocklist(object):
+    """Sorted table of blocked domains.
+
+    Call blocklist.match(name) with a normalized query name to obtain the blocking behavior
+    if the name or any of its parent domains is on the list, None otherwise.
+    blocklist.report holds statistics of loading the list.
+    """
+
+    def __init__(self, checksums = None, offsets = None, names = ''):
+        self.checksums = checksums if checksums is not None else array('i')
+        self.offsets = offsets if offsets is not None else array('I', [0])
+        self.names = names
+        self.sources = ()
+        self.report = {}
+        self.behavior = Behavior(BLOCKLIST_RULE, 'block')
+
+    def __len__(self):
+        return len(self.checksums)
+
+    def __iter__(self):
+        for position in xrange(len(self.checksums)):
+            yield self.names[self.offsets[position]:self.offsets[position + 1]]
+
+    def size(self):
+        """Returns size of the table in bytes, of the whole file for a mapped table."""
+        if not isinstance(self.checksums, array):
+            return len(self.names)
+        return (len(self.checksums) * self.checksums.itemsize + len(self.offsets) * self.offsets.itemsize
+                + len(self.names))
+
+    def contains(self, name):
+        """Checks whether normalized name itself is on the list.
+
+        Returns True if it is."""
+        value = checksum(name)
+        checksums = self.checksums
+        position = bisect_left(checksums, value)
+        while position < len(checksums) and checksums[position] == value:
+            if self.names[self.offsets[position]:self.offsets[position + 1]] == name:
+                return True
+            position += 1
+        return False
+
+    def match(self, name):
+        """Finds whether normalized name or one of its parent domains is blocked.
+
+        Returns blocking behavior or None."""
+        if not self.checksums:
+            return None
+        while '.' in name:
+            if self.contains(name):
+                return self.behavior
+            name = name[name.index('.') + 1:]
+        return None
+
+class BlocklistLoader(object):
+    """Collects domains of one or more lists.
+
+    Call loader.load(lines, format) or loader.load_file(filename, format) for each list,
+    then loader.build() to obtain Blocklist.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('dnsproxy.blocklist.BlocklistLoader')
+        self.names = set()
+        self.started = time.time()
+        self.files = 0
+        self.lines = 0
+        self.found = 0
+        self.invalid = 0
+        self.errors = 0
+
+    def load(self, lines, format = FORMAT_AUTO):
+        """Adds domains from iterable of lines (e.g. open file) in given format.
+
+        Returns self."""
+        parser = ListParser(format)
+        add = self.names.add
+        for line in lines:
+            self.lines += 1
+            for name in parser.parse(line):
+                self.found += 1
+                add(name)
+        self.files += 1
+        self.invalid += parser.invalid
+        return self
+
+    def load_file(self, filename, format = FORMAT_AUTO):
+        """Adds domains from list file in given format, errors reading it are logged and counted.
+
+        Returns self."""
+        try:
+            with open(filename, 'rb') as file:
+                return self.load(file, format)
+        except (IOError, ValueError):
+            self.errors += 1
+            self.logger.exception("failed to load blocklist '{file}'".format(file = filename))
+            return self
+
+    def build(self):
+        """Drops entries below other blocked domains and stores the rest in a table.
+
+        Returns Blocklist, with statistics of loading it in blocklist.report."""
+        names = self.names
+        self.names = set()
+        unique = len(names)
+        kept = []
+        for name in names:
+            parent = name
+            while True:
+                parent = parent[parent.find('.') + 1:]
+                if '.' not in parent:
+                    kept.append(name)
+                    break
+                if parent in names:
+                    break
+        del names
+        kept.sort(key = checksum)
+        blocklist = Blocklist(array('i', map(checksum, kept)), array('I', offsets(kept)), ''.join(kept))
+        blocklist.report = dict(
+            files = self.files,
+            errors = self.errors,
+            lines = self.lines,
+            entries = len(blocklist),
+            duplicates = self.found - unique,
+            redundant = unique - len(blocklist),
+            invalid = self.invalid,
+            seconds = round(time.time() - self.started, 3),
+            tableBytes = blocklist.size(),
+            peakMemoryBytes = peak_memory())
+        self.logger.info('blocklist built: {report}'.format(report = blocklist.report))
+        return blocklist
+
+def source_signature(source):
+    """Returns (file, format, modification time, size) of blocklist source from configuration."""
+    filename = source[FILE_KEY]
+    try:
+        stat = os.stat(filename)
+        changed = (stat.st_mtime, stat.st_size)
+    except OSError:
+        changed = (None, None)
+    return (filename, source.get(FORMAT_KEY, FORMAT_AUTO)) + changed
+
+def align(offset):
+    """Returns offset rounded up to COMPILED_ALIGNMENT."""
+    return (offset + COMPILED_ALIGNMENT - 1) // COMPILED_ALIGNMENT * COMPILED_ALIGNMENT
+
+def write_compiled(blocklist, filename):
+    """Writes table built by BlocklistLoader, with its sources and report, to binary file replacing it atomically.
+
+    Offsets of names are stored relative to the start of the file, so that the mapped file is the table."""
+    metadata = json.dumps(dict(sources = blocklist.sources, report = blocklist.report, byteorder = sys.byteorder))
+    count = len(blocklist)
+    checksums_offset = align(COMPILED_HEADER.size + len(metadata))
+    offsets_offset = checksums_offset + count * 4
+    names_offset = offsets_offset + (count + 1) * 4
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(COMPILED_HEADER.pack(COMPILED_MAGIC, COMPILED_VERSION, count, len(metadata),
+                                        checksums_offset, offsets_offset, names_offset))
+        file.write(metadata)
+        file.write(b'\x00' * (checksums_offset - COMPILED_HEADER.size - len(metadata)))
+        file.write(array('i', blocklist.checksums).tostring())
+        file.write(array('I', (offset + names_offset for offset in blocklist.offsets)).tostring())
+        file.write(blocklist.names)
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(temporary, filename)
+
+def map_compiled(filename):
+    """Memory-maps binary file written by write_compiled.
+
+    Returns Blocklist backed by the mapping, None if the file does not exist or is not valid."""
+    try:
+        with open(filename, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_COPY)
+        magic, version, count, metadata_length, checksums_offset, offsets_offset, names_offset = COMPILED_HEADER.unpack_from(data)
+        if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+            raise ValueError('unsupported format or version {version}'.format(version = version))
+        metadata = json.loads(data[COMPILED_HEADER.size:COMPILED_HEADER.size + metadata_length])
+        if metadata['byteorder'] != sys.byteorder:
+            raise ValueError('written on a {byteorder} endian machine'.format(byteorder = metadata['byteorder']))
+        checksums = (ctypes.c_int32 * count).from_buffer(data, checksums_offset)
+        offsets = (ctypes.c_uint32 * (count + 1)).from_buffer(data, offsets_offset)
+    except (EnvironmentError, ValueError, KeyError, struct.error) as error:
+        if os.path.exists(filename):
+            module_logger.warning("ignoring compiled blocklist '{file}': {error}".format(file = filename, error = error))
+        return None
+    blocklist = Blocklist(checksums, offsets, data)
+    blocklist.sources = tuple(tuple(source) for source in metadata['sources'])
+    blocklist.report = metadata['report']
+    return blocklist
+
+def load_blocklists(sources, previous = None, compiled = None, force = False):
+    """Loads blocklist sources from configuration ({"file": ..., "format": ...} dicts) into one table.
+
+    If compiled file name is given, the table is mapped from that file when it was compiled
+    from the same sources, otherwise it is built and the file is written (always with force).
+
+    Returns previous Blocklist if none of the sources changed since it was loaded, new Blocklist otherwise."""
+    signature = tuple(source_signature(source) for source in sources)
+    if not force and previous is not None and previous.sources == signature:
+        return previous
+    if not sources:
+        blocklist = Blocklist()
+        blocklist.sources = signature
+        return blocklist
+    started = time.time()
+    if compiled and not force:
+        blocklist = map_compiled(compiled)
+        if blocklist is not None and blocklist.sources == signature:
+            module_logger.info("mapped compiled blocklist '{file}' with {count} entries in {seconds:.3f} s".format(
+                file = compiled, count = len(blocklist), seconds = time.time() - started))
+            return blocklist
+    loader = BlocklistLoader()
+    for filename, format, mtime, size in signature:
+        loader.load_file(filename, format)
+    blocklist = loader.build()
+    blocklist.sources = signature
+    if not compiled:
+        return blocklist
+    try:
+        write_compiled(blocklist, compiled)
+    except EnvironmentError:
+        module_logger.exception("failed to write compiled blocklist '{file}'".format(file = compiled))
+        return blocklist
+    return map_compiled(compiled) or blocklist
+
+def main(argv = None):
+    """Loads lists given on command line and prints loading statistics.
+
+    Returns exit status, 1 if a list could not be read."""
+    parser = argparse.ArgumentParser(prog = 'python -m dnsproxy.blocklist', description = 'Loads blocklists and reports their size.')
+    parser.add_argument('files', nargs = '+', metavar = 'FILE')
+    parser.add_argument('--format', choices = FORMATS, default = FORMAT_AUTO)
+    parser.add_argument('--check', metavar = 'NAME', action = 'append', default = [], help = 'report whether NAME is blocked')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    logging.getLogger('dnsproxy').setLevel(logging.WARNING)
+    loader = BlocklistLoader()
+    for filename in args.files:
+        loader.load_file(filename, args.format)
+    blocklist = loader.build()
+    for stat, value in sorted(blocklist.report.items()):
+        print '{stat:16} {value}'.format(stat = stat, value = value)
+    for name in args.check:
+        print '{name} {result}'.format(name = name, result = 'blocked' if blocklist.match(normalize_name(name)) else 'not blocked')
+    return 1 if blocklist.report['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
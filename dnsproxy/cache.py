@@ -0,0 +1,294 @@
+"""DNS proxy response cache module."""
+
+from collections import OrderedDict
+from threading import Thread, Lock
+from Queue import Queue, Full
+from dnslib import DNSRecord, RCODE
+import wire
+import struct
+import time
+import logging
+
+module_logger = logging.getLogger('dnsproxy.cache')
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_NEGATIVE_TTL = 60
+DEFAULT_MAX_TTL = 86400
+DEFAULT_PREFETCH_HITS = 3
+DEFAULT_STALE_TTL = 0
+PREFETCH_FRACTION = 0.1
+PREFETCH_THREADS = 2
+PREFETCH_QUEUE_SIZE = 1000
+STALE_ANSWER_TTL = 30
+
+def cache_key(question):
+    """Creates cache key for given question.
+
+    Returns (qname, qtype, qclass) tuple, qname is lowercased."""
+    return (str(question.qname).lower(), question.qtype, question.qclass)
+
+class CacheEntry(object):
+    """Cached reply message with positions and original values of its record TTLs.
+
+    refresh is the function querying upstream again and storing the new reply, hits counts lookups
+    answered by this entry and refreshing is set while a refresh is queued or running."""
+
+    __slots__ = ('reply', 'question_end', 'ttls', 'ttl', 'stored', 'expires', 'refresh', 'hits', 'refreshing')
+
+    def __init__(self, reply, question_end, ttls, ttl, now, refresh = None):
+        self.reply = reply
+        self.question_end = question_end
+        self.ttls = ttls
+        self.ttl = ttl
+        self.stored = now
+        self.expires = now + ttl
+        self.refresh = refresh
+        self.hits = 0
+        self.refreshing = False
+
+def refresh_entry(entry):
+    """Calls refresh of cache entry, clearing its refreshing flag once done.
+
+    A refresh that failed or whose reply was not cached can then be retried by a later hit."""
+    try:
+        entry.refresh()
+    finally:
+        entry.refreshing = False
+
+class Prefetcher(object):
+    """Pool of threads running refreshes of cache entries in background.
+
+    Call prefetcher.submit(refresh) to have refresh called by one of the threads;
+    when the queue is full the refresh is dropped. Threads are started on first use,
+    so that a prefetcher created before fork works in the child process.
+    """
+
+    def __init__(self, threads = PREFETCH_THREADS, queue_size = PREFETCH_QUEUE_SIZE):
+        self.logger = logging.getLogger('dnsproxy.cache.Prefetcher')
+        self.size = threads
+        self.queue = Queue(queue_size)
+        self.lock = Lock()
+        self.threads = []
+        self.submitted = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def submit(self, refresh):
+        """Queues refresh to be called in background.
+
+        Returns False if it was dropped."""
+        self.start()
+        try:
+            self.queue.put_nowait(refresh)
+        except Full:
+            self.dropped += 1
+            return False
+        self.submitted += 1
+        return True
+
+    def start(self):
+        if len(self.threads) == self.size and all(thread.isAlive() for thread in self.threads):
+            return
+        with self.lock:
+            self.threads = [thread for thread in self.threads if thread.isAlive()]
+            while len(self.threads) < self.size:
+                thread = Thread(name = 'dnsproxy-prefetch', target = self.run)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def run(self):
+        while True:
+            refresh = self.queue.get()
+            try:
+                refresh()
+            except Exception as err:
+                self.failed += 1
+                self.logger.debug('prefetch failed: {err}'.format(err = err))
+
+    def stats(self):
+        """Returns dict with numbers of submitted, dropped and failed refreshes."""
+        return dict(
+            submitted = self.submitted,
+            dropped = self.dropped,
+            failed = self.failed)
+
+class ResponseCache(object):
+    """Bounded, LRU-evicted cache of upstream answers keyed by (qname, qtype, qclass).
+
+    Replies are kept in wire format. Entries live as long as the lowest TTL of their
+    answer records. NXDOMAIN and empty answers are cached for negative_ttl seconds
+    (or the SOA minimum if upstream sent one).
+
+    Entries stored with a refresh function and hit at least prefetch_hits times are refreshed
+    by prefetcher in background once they enter the last PREFETCH_FRACTION of their TTL,
+    while the current answer is still served. Expired entries are kept stale_ttl seconds more
+    to answer with when upstream servers do not (RFC 8767).
+
+    Call cache.lookup(request) / cache.lookup_wire(key, query, question_end)
+    to obtain a reply with rewritten TTLs or None on miss, pass stale = True to accept expired entries.
+    Call cache.store(request, response, refresh) / cache.store_wire(key, reply, refresh)
+    to remember the upstream response.
+    """
+
+    def __init__(self, max_size = DEFAULT_MAX_SIZE, negative_ttl = DEFAULT_NEGATIVE_TTL, max_ttl = DEFAULT_MAX_TTL,
+                 prefetch_hits = DEFAULT_PREFETCH_HITS, stale_ttl = DEFAULT_STALE_TTL, prefetcher = None):
+        self.logger = logging.getLogger('dnsproxy.cache.ResponseCache')
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self.prefetch_hits = prefetch_hits
+        self.stale_ttl = stale_ttl
+        self.prefetcher = prefetcher
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.prefetches = 0
+        self.stale_hits = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, request, stale = False):
+        """Looks up the answer for the request's first question.
+
+        Returns reply to the request, with its ID and question as asked (0x20 letter case)
+        and TTLs reduced by the time spent in cache, or None on miss.
+        """
+        reply = self.lookup_wire(cache_key(request.q), stale = stale)
+        if reply is None:
+            return None
+        response = DNSRecord.parse(reply)
+        response.header.id = request.header.id
+        response.questions = list(request.questions)
+        return response
+
+    def lookup_wire(self, key, query = None, question_end = None, stale = False):
+        """Looks up raw reply for given key, submitting refresh of hot entries about to expire.
+
+        If raw query is given, reply gets its transaction ID and question bytes.
+        If stale is True, an expired entry kept for serving stale answers is returned with TTLs of STALE_ANSWER_TTL.
+        Returns reply message with TTLs reduced by the time spent in cache, or None on miss.
+        """
+        now = time.time()
+        prefetch = False
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                if not stale:
+                    self.misses += 1
+                return None
+            if entry.expires <= now:
+                kept = entry.expires + self.stale_ttl > now
+                if kept:
+                    self.entries[key] = entry
+                else:
+                    self.expirations += 1
+                if not stale:
+                    self.misses += 1
+                if not (stale and kept):
+                    return None
+                self.stale_hits += 1
+            else:
+                self.entries[key] = entry
+                self.hits += 1
+                entry.hits += 1
+                if (self.prefetcher is not None and entry.refresh is not None and not entry.refreshing
+                        and self.prefetch_hits and entry.hits >= self.prefetch_hits
+                        and entry.expires - now < entry.ttl * PREFETCH_FRACTION):
+                    entry.refreshing = True
+                    prefetch = True
+                    self.prefetches += 1
+        if prefetch and not self.prefetcher.submit(lambda: refresh_entry(entry)):
+            entry.refreshing = False
+        elapsed = int(now - entry.stored)
+        reply = bytearray(entry.reply)
+        if query is not None:
+            reply[0:2] = query[0:2]
+            if question_end == entry.question_end:
+                reply[wire.HEADER_SIZE:question_end] = query[wire.HEADER_SIZE:question_end]
+        for offset, ttl in entry.ttls:
+            struct.pack_into('!I', reply, offset, STALE_ANSWER_TTL if entry.expires <= now else max(ttl - elapsed, 0))
+        return bytes(reply)
+
+    def store(self, request, response, refresh = None):
+        """Remembers the response to the request's first question."""
+        self.store_wire(cache_key(request.q), bytes(response.pack()), refresh)
+
+    def store_wire(self, key, reply, refresh = None):
+        """Remembers raw reply under given key, refresh is called to prefetch it again.
+
+        Only NOERROR and NXDOMAIN replies with positive TTL which are not truncated are stored.
+        """
+        view = memoryview(reply)
+        try:
+            flags, ancount = struct.unpack_from('!HxxH', view, 2)
+            question_end = wire.skip_name(view, wire.HEADER_SIZE) + 4
+            rcode = flags & wire.RCODE_MASK
+            ttls = []
+            answer_ttl = None
+            soa_ttl = None
+            for section, rtype, ttl_offset, ttl, rdata_offset, rdlength in wire.records(view):
+                if rtype == wire.QTYPE_OPT:
+                    continue
+                ttls.append((ttl_offset, ttl))
+                if section == wire.SECTION_ANSWER:
+                    answer_ttl = ttl if answer_ttl is None else min(answer_ttl, ttl)
+                elif section == wire.SECTION_AUTHORITY and rtype == wire.QTYPE_SOA:
+                    minimum, = struct.unpack_from('!I', view, rdata_offset + rdlength - 4)
+                    soa_ttl = min(ttl, minimum)
+        except (wire.WireError, struct.error):
+            self.logger.debug('not caching malformed reply for {key}'.format(key = key))
+            return
+        if flags & wire.TC_FLAG:
+            return
+        if rcode == RCODE.NXDOMAIN or (rcode == RCODE.NOERROR and ancount == 0):
+            ttl = soa_ttl if soa_ttl is not None else self.negative_ttl
+        elif rcode == RCODE.NOERROR:
+            ttl = answer_ttl
+        else:
+            return
+        ttl = min(ttl, self.max_ttl)
+        if ttl <= 0:
+            return
+        entry = CacheEntry(bytes(reply), question_end, ttls, ttl, time.time(), refresh)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+
+    def configure(self, max_size, negative_ttl, prefetch_hits, stale_ttl):
+        """Applies changed settings, keeping cached entries.
+
+        Least recently used entries above the new max_size are evicted, the new negative_ttl
+        applies to replies stored from now on."""
+        with self.lock:
+            self.max_size = max_size
+            self.negative_ttl = negative_ttl
+            self.prefetch_hits = prefetch_hits
+            self.stale_ttl = stale_ttl
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+
+    def clear(self):
+        """Removes all entries, counters are kept."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Returns dict with cache size and hit/miss/eviction counters."""
+        return dict(
+            size = len(self.entries),
+            maxSize = self.max_size,
+            hits = self.hits,
+            misses = self.misses,
+            evictions = self.evictions,
+            expirations = self.expirations,
+            prefetches = self.prefetches,
+            staleHits = self.stale_hits)
@@ -1,6 +1,16 @@
 """DNS proxy configuration management module."""
 
 from behavior import Behavior
+from cache import DEFAULT_MAX_SIZE, DEFAULT_NEGATIVE_TTL, DEFAULT_PREFETCH_HITS, DEFAULT_STALE_TTL
+from rules import RuleMatcher
+from blocklist import load_blocklists, FILE_KEY, DEFAULT_COMPILED_FILE
+from logqueue import DEFAULT_LEVEL, DEFAULT_MAX_BYTES, DEFAULT_BACKUP_COUNT
+from upstream import DEFAULT_UPSTREAM, DEFAULT_HEDGE_DELAY, TRANSPORT_UDP
+from batchio import DEFAULT_BATCH_SIZE
+from ratelimit import DEFAULT_SLIP, DEFAULT_TABLE_SIZE
+from journal import DEFAULT_DIRECTORY, DEFAULT_SEGMENT_BYTES, DEFAULT_SEGMENTS
+from zones import load_zones
+from threading import RLock
 import json
 import logging
 
@@ -12,14 +22,141 @@ CONF_KEY = 'config'
 HTTP_ACCESS_PORT_KEY = 'httpAccessPort'
 DNS_PORT_KEY = 'dnsPort'
 BEHAVIORS_KEY = 'behaviors'
+CACHE_SIZE_KEY = 'cacheSize'
+NEGATIVE_CACHE_TTL_KEY = 'negativeCacheTtl'
+ENGINE_KEY = 'engine'
+UPSTREAM_TIMEOUT_KEY = 'upstreamTimeout'
+WORKERS_KEY = 'workers'
+UPSTREAMS_KEY = 'upstreams'
+UPSTREAM_TRANSPORT_KEY = 'upstreamTransport'
+FORWARD_MODE_KEY = 'forwardMode'
+UPSTREAM_HEDGE_DELAY_KEY = 'upstreamHedgeDelay'
+LOG_LEVEL_KEY = 'logLevel'
+LOG_MAX_BYTES_KEY = 'logMaxBytes'
+LOG_BACKUP_COUNT_KEY = 'logBackupCount'
+BLOCKLISTS_KEY = 'blocklists'
+COMPILED_BLOCKLIST_KEY = 'compiledBlocklist'
+UDP_BATCH_SIZE_KEY = 'udpBatchSize'
+PREFETCH_HITS_KEY = 'prefetchHits'
+SERVE_STALE_KEY = 'serveStale'
+RATE_LIMIT_QUERIES_KEY = 'rateLimitQueries'
+RATE_LIMIT_RESPONSES_KEY = 'rateLimitResponses'
+RATE_LIMIT_SLIP_KEY = 'rateLimitSlip'
+RATE_LIMIT_TABLE_SIZE_KEY = 'rateLimitTableSize'
+JOURNAL_DIRECTORY_KEY = 'journalDirectory'
+JOURNAL_SEGMENT_BYTES_KEY = 'journalSegmentBytes'
+JOURNAL_SEGMENTS_KEY = 'journalSegments'
+STAGE_TIMING_KEY = 'stageTiming'
+ZONES_KEY = 'zones'
+
+ENGINE_THREADS = 'threads'
+ENGINE_EVENTLOOP = 'eventloop'
+DEFAULT_ENGINE = ENGINE_THREADS
+FORWARD_REBUILD = 'rebuild'
+FORWARD_PASSTHROUGH = 'passthrough'
+DEFAULT_FORWARD_MODE = FORWARD_REBUILD
+DEFAULT_UPSTREAM_TIMEOUT = 5.0
+
+class ConfigSnapshot(object):
+    """Immutable, versioned view of the configuration used for serving requests.
+
+    Holds local zones, behaviors (with their pre-encoded replies) and the blocklist compiled
+    into a RuleMatcher, upstream and cache settings and rate limits. Snapshots are built with config.snapshot() and never
+    changed afterwards, Server publishes a new one by swapping a single reference.
+    """
+
+    __slots__ = ('version', 'behaviors', 'matcher', 'forward_mode',
+                 'upstreams', 'upstream_timeout', 'upstream_transport', 'upstream_hedge_delay', 'cache_settings', 'rate_limits', 'zones')
+
+    def __init__(self, version, behaviors, blocklist, forward_mode, upstreams, upstream_timeout, upstream_transport, upstream_hedge_delay, cache_settings,
+                 rate_limits, zones = None):
+        self.version = version
+        self.zones = zones
+        self.behaviors = tuple(behaviors)
+        self.matcher = RuleMatcher(self.behaviors, blocklist)
+        self.forward_mode = forward_mode
+        self.upstreams = tuple(upstreams)
+        self.upstream_timeout = upstream_timeout
+        self.upstream_transport = upstream_transport
+        self.upstream_hedge_delay = upstream_hedge_delay
+        self.cache_settings = tuple(cache_settings)
+        self.rate_limits = tuple(rate_limits)
+
+    def upstream_settings(self):
+        """Returns tuple of settings UpstreamClient is created with."""
+        return (self.upstreams, self.upstream_timeout, self.upstream_transport, self.upstream_hedge_delay)
 
 class Config(object):
-    """DNS proxy configuration class"""
+    """DNS proxy configuration class
+
+    Config is the editable configuration. Changes made through its methods
+    are done under config.lock; call config.snapshot() to compile them
+    into a ConfigSnapshot for serving requests.
+    """
 
     def __init__(self):
         self.logger = logging.getLogger('dnsproxy.config.Config')
+        self.lock = RLock()
+        self.version = 0
+        self.blocklist = None
+        self.zone_store = None
         self.default()
 
+    def add_behavior(self, behavior):
+        """Appends behavior to the end of behaviors list.
+
+        Returns index of added behavior."""
+        with self.lock:
+            self.behaviors = self.behaviors + [behavior]
+            return len(self.behaviors) - 1
+
+    def remove_behavior(self, index):
+        """Removes behavior at given index.
+
+        Returns removed behavior."""
+        with self.lock:
+            behaviors = list(self.behaviors)
+            removed = behaviors.pop(index)
+            self.behaviors = behaviors
+            return removed
+
+    def add_blocklist(self, source):
+        """Adds blocklist source ({"file": ..., "format": ...}), replacing one with the same file."""
+        with self.lock:
+            self.blocklists = [entry for entry in self.blocklists if entry[FILE_KEY] != source[FILE_KEY]] + [source]
+
+    def remove_blocklist(self, filename):
+        """Removes blocklist source with given file.
+
+        Returns True if it was configured."""
+        with self.lock:
+            blocklists = [entry for entry in self.blocklists if entry[FILE_KEY] != filename]
+            removed = len(blocklists) != len(self.blocklists)
+            self.blocklists = blocklists
+            return removed
+
+    def compile_blocklist(self):
+        """Loads blocklists from their files and writes them to the compiled blocklist file.
+
+        Returns the loaded Blocklist."""
+        with self.lock:
+            self.blocklist = load_blocklists(self.blocklists, None, self.compiled_blocklist, force = True)
+            return self.blocklist
+
+    def snapshot(self):
+        """Compiles current configuration, loading blocklists and zones again if their files changed.
+
+        Returns new ConfigSnapshot with next version number."""
+        with self.lock:
+            self.version += 1
+            self.blocklist = load_blocklists(self.blocklists, self.blocklist, self.compiled_blocklist)
+            self.zone_store = load_zones(self.zones, self.zone_store)
+            return ConfigSnapshot(self.version, self.behaviors, self.blocklist, self.forward_mode, self.upstreams,
+                                  self.upstream_timeout, self.upstream_transport, self.upstream_hedge_delay,
+                                  (self.cache_size, self.negative_cache_ttl, self.prefetch_hits, self.serve_stale),
+                                  (self.rate_limit_queries, self.rate_limit_responses, self.rate_limit_slip, self.rate_limit_table_size),
+                                  self.zone_store)
+
     def default(self):
         """Sets default values.
 
@@ -28,6 +165,32 @@ class Config(object):
         self.http_access_port = 8080
         self.dns_port = 53
         self.behaviors = []
+        self.cache_size = DEFAULT_MAX_SIZE
+        self.negative_cache_ttl = DEFAULT_NEGATIVE_TTL
+        self.engine = DEFAULT_ENGINE
+        self.upstream_timeout = DEFAULT_UPSTREAM_TIMEOUT
+        self.workers = 0
+        self.upstreams = [DEFAULT_UPSTREAM]
+        self.upstream_transport = TRANSPORT_UDP
+        self.forward_mode = DEFAULT_FORWARD_MODE
+        self.upstream_hedge_delay = DEFAULT_HEDGE_DELAY
+        self.log_level = DEFAULT_LEVEL
+        self.log_max_bytes = DEFAULT_MAX_BYTES
+        self.log_backup_count = DEFAULT_BACKUP_COUNT
+        self.blocklists = []
+        self.compiled_blocklist = DEFAULT_COMPILED_FILE
+        self.udp_batch_size = DEFAULT_BATCH_SIZE
+        self.prefetch_hits = DEFAULT_PREFETCH_HITS
+        self.serve_stale = DEFAULT_STALE_TTL
+        self.rate_limit_queries = 0
+        self.rate_limit_responses = 0
+        self.rate_limit_slip = DEFAULT_SLIP
+        self.rate_limit_table_size = DEFAULT_TABLE_SIZE
+        self.journal_directory = DEFAULT_DIRECTORY
+        self.journal_segment_bytes = DEFAULT_SEGMENT_BYTES
+        self.journal_segments = DEFAULT_SEGMENTS
+        self.stage_timing = False
+        self.zones = []
         return self
 
     def from_json(self, json):
@@ -35,10 +198,37 @@ class Config(object):
 
         Returns self.
         """
-        config_json = json[ROOT_KEY][CONF_KEY]
-        self.http_access_port = config_json[HTTP_ACCESS_PORT_KEY]
-        self.dns_port = config_json[DNS_PORT_KEY]
-        self.behaviors = [Behavior().from_json(jsonBehavior) for jsonBehavior in config_json[BEHAVIORS_KEY]]
+        with self.lock:
+            config_json = json[ROOT_KEY][CONF_KEY]
+            self.http_access_port = config_json[HTTP_ACCESS_PORT_KEY]
+            self.dns_port = config_json[DNS_PORT_KEY]
+            self.behaviors = [Behavior().from_json(jsonBehavior) for jsonBehavior in config_json[BEHAVIORS_KEY]]
+            self.cache_size = config_json.get(CACHE_SIZE_KEY, DEFAULT_MAX_SIZE)
+            self.negative_cache_ttl = config_json.get(NEGATIVE_CACHE_TTL_KEY, DEFAULT_NEGATIVE_TTL)
+            self.engine = config_json.get(ENGINE_KEY, DEFAULT_ENGINE)
+            self.upstream_timeout = config_json.get(UPSTREAM_TIMEOUT_KEY, DEFAULT_UPSTREAM_TIMEOUT)
+            self.workers = config_json.get(WORKERS_KEY, 0)
+            self.upstreams = config_json.get(UPSTREAMS_KEY, [DEFAULT_UPSTREAM])
+            self.upstream_transport = config_json.get(UPSTREAM_TRANSPORT_KEY, TRANSPORT_UDP)
+            self.forward_mode = config_json.get(FORWARD_MODE_KEY, DEFAULT_FORWARD_MODE)
+            self.upstream_hedge_delay = config_json.get(UPSTREAM_HEDGE_DELAY_KEY, DEFAULT_HEDGE_DELAY)
+            self.log_level = config_json.get(LOG_LEVEL_KEY, DEFAULT_LEVEL)
+            self.log_max_bytes = config_json.get(LOG_MAX_BYTES_KEY, DEFAULT_MAX_BYTES)
+            self.log_backup_count = config_json.get(LOG_BACKUP_COUNT_KEY, DEFAULT_BACKUP_COUNT)
+            self.blocklists = config_json.get(BLOCKLISTS_KEY, [])
+            self.compiled_blocklist = config_json.get(COMPILED_BLOCKLIST_KEY, DEFAULT_COMPILED_FILE)
+            self.udp_batch_size = config_json.get(UDP_BATCH_SIZE_KEY, DEFAULT_BATCH_SIZE)
+            self.prefetch_hits = config_json.get(PREFETCH_HITS_KEY, DEFAULT_PREFETCH_HITS)
+            self.serve_stale = config_json.get(SERVE_STALE_KEY, DEFAULT_STALE_TTL)
+            self.rate_limit_queries = config_json.get(RATE_LIMIT_QUERIES_KEY, 0)
+            self.rate_limit_responses = config_json.get(RATE_LIMIT_RESPONSES_KEY, 0)
+            self.rate_limit_slip = config_json.get(RATE_LIMIT_SLIP_KEY, DEFAULT_SLIP)
+            self.rate_limit_table_size = config_json.get(RATE_LIMIT_TABLE_SIZE_KEY, DEFAULT_TABLE_SIZE)
+            self.journal_directory = config_json.get(JOURNAL_DIRECTORY_KEY, DEFAULT_DIRECTORY)
+            self.journal_segment_bytes = config_json.get(JOURNAL_SEGMENT_BYTES_KEY, DEFAULT_SEGMENT_BYTES)
+            self.journal_segments = config_json.get(JOURNAL_SEGMENTS_KEY, DEFAULT_SEGMENTS)
+            self.stage_timing = config_json.get(STAGE_TIMING_KEY, False)
+            self.zones = config_json.get(ZONES_KEY, [])
         return self
 
     def from_file(self, filename = JSON_CONF_DEFAULT_FILE):
@@ -57,10 +247,37 @@ class Config(object):
 
         Returns JSON object.
         """
-        conf_dict = {
-            HTTP_ACCESS_PORT_KEY : self.http_access_port,
-            DNS_PORT_KEY : self.dns_port,
-            BEHAVIORS_KEY : [behavior.to_json() for behavior in self.behaviors] }
+        with self.lock:
+            conf_dict = {
+                HTTP_ACCESS_PORT_KEY : self.http_access_port,
+                DNS_PORT_KEY : self.dns_port,
+                CACHE_SIZE_KEY : self.cache_size,
+                NEGATIVE_CACHE_TTL_KEY : self.negative_cache_ttl,
+                ENGINE_KEY : self.engine,
+                UPSTREAM_TIMEOUT_KEY : self.upstream_timeout,
+                WORKERS_KEY : self.workers,
+                UPSTREAMS_KEY : self.upstreams,
+                UPSTREAM_TRANSPORT_KEY : self.upstream_transport,
+                FORWARD_MODE_KEY : self.forward_mode,
+                UPSTREAM_HEDGE_DELAY_KEY : self.upstream_hedge_delay,
+                LOG_LEVEL_KEY : self.log_level,
+                LOG_MAX_BYTES_KEY : self.log_max_bytes,
+                LOG_BACKUP_COUNT_KEY : self.log_backup_count,
+                BLOCKLISTS_KEY : self.blocklists,
+                COMPILED_BLOCKLIST_KEY : self.compiled_blocklist,
+                UDP_BATCH_SIZE_KEY : self.udp_batch_size,
+                PREFETCH_HITS_KEY : self.prefetch_hits,
+                SERVE_STALE_KEY : self.serve_stale,
+                RATE_LIMIT_QUERIES_KEY : self.rate_limit_queries,
+                RATE_LIMIT_RESPONSES_KEY : self.rate_limit_responses,
+                RATE_LIMIT_SLIP_KEY : self.rate_limit_slip,
+                RATE_LIMIT_TABLE_SIZE_KEY : self.rate_limit_table_size,
+                JOURNAL_DIRECTORY_KEY : self.journal_directory,
+                JOURNAL_SEGMENT_BYTES_KEY : self.journal_segment_bytes,
+                JOURNAL_SEGMENTS_KEY : self.journal_segments,
+                STAGE_TIMING_KEY : self.stage_timing,
+                ZONES_KEY : self.zones,
+                BEHAVIORS_KEY : [behavior.to_json() for behavior in self.behaviors] }
         return {ROOT_KEY : {CONF_KEY : conf_dict}}
 
 
@@ -0,0 +1,139 @@
+"""DNS proxy configuration file store module.
+
+ConfigStore keeps the configuration file in sync with Config without
+touching the serving path: changes are written by a background thread
+(atomically, through a temporary file) and external edits of the file,
+noticed by polling its modification time or signalled with SIGHUP,
+are loaded back and published through a callback."""
+
+from dnsproxy.config import Config, JSON_CONF_DEFAULT_FILE
+from threading import Thread, Event, Lock
+import json
+import os
+import signal
+import logging
+
+module_logger = logging.getLogger('dnsproxy.configstore')
+
+WATCH_INTERVAL = 2.0
+
+class ConfigStore(object):
+    """Persists Config to its file and reloads it when the file changes.
+
+    Call store.save() after changing config to have it written in background.
+    Call store.start() to run the writer/watcher thread, store.stop() to stop it
+    after pending changes are written. on_reload is called after config was reloaded.
+    """
+
+    def __init__(self, config, filename = JSON_CONF_DEFAULT_FILE, on_reload = None, watch_interval = WATCH_INTERVAL):
+        self.logger = logging.getLogger('dnsproxy.configstore.ConfigStore')
+        self.config = config
+        self.filename = filename
+        self.on_reload = on_reload
+        self.watch_interval = watch_interval
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.pending = None
+        self.reload_requested = False
+        self.active = False
+        self.thread = None
+        self.signature = self.file_signature()
+
+    def file_signature(self):
+        """Returns (modification time, size) of the config file or None if it does not exist."""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def save(self):
+        """Schedules writing current config to the file, returns immediately.
+
+        Only the newest of several changes saved in quick succession is written."""
+        config_json = self.config.to_json()
+        with self.lock:
+            self.pending = config_json
+        self.wakeup.set()
+        if not self.active:
+            self.write_pending()
+
+    def request_reload(self):
+        """Schedules reloading the file, safe to call from a signal handler."""
+        self.reload_requested = True
+        self.wakeup.set()
+
+    def install_signal_handler(self):
+        """Reloads config on SIGHUP where the platform has it. Must be called from the main thread.
+
+        Returns True if the handler was installed."""
+        if not hasattr(signal, 'SIGHUP'):
+            return False
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.request_reload())
+        return True
+
+    def start(self):
+        if self.thread is not None and self.thread.isAlive():
+            return
+        self.active = True
+        self.thread = Thread(name = 'dnsproxy-config', target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.active = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(self.watch_interval * 2)
+        self.write_pending()
+
+    def run(self):
+        self.logger.info('thread started')
+        while self.active:
+            self.wakeup.wait(self.watch_interval)
+            self.wakeup.clear()
+            self.write_pending()
+            if self.reload_requested or self.file_signature() != self.signature:
+                self.reload_requested = False
+                self.reload()
+        self.logger.info('thread stopped')
+
+    def write_pending(self):
+        """Writes the newest saved config, if any, replacing the file atomically."""
+        with self.lock:
+            config_json = self.pending
+            self.pending = None
+            if config_json is None:
+                return
+            temporary = self.filename + '.tmp'
+            try:
+                with open(temporary, mode = 'w') as file:
+                    json.dump(config_json, file, indent = True)
+                if os.name == 'nt' and os.path.exists(self.filename):
+                    os.remove(self.filename)
+                os.rename(temporary, self.filename)
+            except (IOError, OSError):
+                self.logger.exception("failed to write config file '{file}'".format(file = self.filename))
+                return
+            self.signature = self.file_signature()
+        self.logger.debug("config written to '{file}'".format(file = self.filename))
+
+    def reload(self):
+        """Loads the config file into config and calls on_reload.
+
+        Returns True on success; on error the current config is kept."""
+        signature = self.file_signature()
+        try:
+            with open(self.filename) as file:
+                config_json = json.load(file)
+            Config().from_json(config_json)
+        except Exception:
+            self.logger.exception("failed to reload config file '{file}', keeping current config".format(file = self.filename))
+            self.signature = signature
+            return False
+        self.signature = signature
+        self.config.from_json(config_json)
+        self.logger.info("config reloaded from '{file}'".format(file = self.filename))
+        if self.on_reload is not None:
+            self.on_reload()
+        return True
@@ -0,0 +1,521 @@
+"""DNS proxy event loop serving module.
+
+EventLoopThread serves UDP and TCP clients from a single thread.
+All sockets are non-blocking and multiplexed with select, client
+datagrams are received and replies sent in batches. Forwarded queries
+are sent upstream without waiting for the answer, so a slow upstream lookup
+does not hold other clients; each of them has its own timeout."""
+
+from dnslib import DNSRecord, RCODE
+from threading import Thread
+from Queue import Queue
+from dnsproxy.behavior import first_or_default, find_behavior
+from dnsproxy.config import FORWARD_PASSTHROUGH
+from dnsproxy.wire import parse_question, error_reply, for_query, udp_reply, WireError
+from dnsproxy.cache import cache_key
+from dnsproxy.upstream import UpstreamError, RCODE_MASK, RCODE_SERVFAIL, RCODE_REFUSED, TC_FLAG
+from dnsproxy.batchio import batch_socket
+from dnsproxy.metrics import metrics, DROPPED_MALFORMED, DROPPED_SEND_ERROR, DROPPED_TCP_LIMIT, REPLY_LATENCY
+import errno
+import heapq
+import itertools
+import random
+import select
+import socket
+import struct
+import time
+import logging
+
+module_logger = logging.getLogger('dnsproxy.eventloop')
+
+MAX_MESSAGE_SIZE = 65535
+POLL_INTERVAL = 1.0
+UDP_DRAIN_LIMIT = 64
+TCP_BACKLOG = 64
+TCP_MAX_CONNECTIONS = 256
+TCP_IDLE_TIMEOUT = 10.0
+TCP_MAX_PIPELINE = 16
+TIMER_HEDGE = 0
+TIMER_EXPIRE = 1
+
+class PendingQuery(object):
+    """Forwarded request waiting for upstream reply.
+
+    Passed through queries keep raw query and its question instead of parsed request.
+    Identical queries arriving while this one is pending wait as its followers."""
+
+    __slots__ = ('request', 'query', 'question', 'behavior', 'reply', 'key', 'wire', 'candidates', 'sent', 'fallback', 'followers')
+
+    def __init__(self, request, query, question, behavior, reply):
+        self.request = request
+        self.query = query
+        self.question = question
+        self.behavior = behavior
+        self.reply = reply
+        self.key = None
+        self.wire = None
+        self.candidates = []
+        self.sent = {}
+        self.fallback = None
+        self.followers = []
+
+    def name(self):
+        if self.request is None:
+            return self.question.name
+        return str(self.request.q.qname)
+
+class TcpConnection(object):
+    """Client TCP connection with length-prefixed (RFC 1035 4.2.2) message buffers.
+
+    Connections with queries still being resolved (outstanding) are not closed as idle;
+    no more queries are read from connections with TCP_MAX_PIPELINE of them outstanding
+    or with a full output buffer until replies are written."""
+
+    def __init__(self, sock, addr, now):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = b''
+        self.outbuf = b''
+        self.last_active = now
+        self.outstanding = 0
+        self.closed = False
+
+    def messages(self):
+        """Extracts complete messages from received data.
+
+        Returns list of message payloads without length prefixes."""
+        messages = []
+        while len(self.inbuf) >= 2:
+            length, = struct.unpack('!H', self.inbuf[:2])
+            if len(self.inbuf) < 2 + length:
+                break
+            messages.append(self.inbuf[2:2 + length])
+            self.inbuf = self.inbuf[2 + length:]
+        return messages
+
+    def send_message(self, data):
+        """Queues length-prefixed message to be written."""
+        if not self.closed:
+            self.outbuf += struct.pack('!H', len(data)) + data
+
+class EventLoopThread(Thread):
+    def __init__(self, server):
+        Thread.__init__(self)
+        self.logger = logging.getLogger('dnsproxy.eventloop.EventLoopThread')
+        self.active = False
+        self.server = server
+        self.name = 'dnsproxy-EventLoop'
+        self.pending = {}
+        self.inflight = {}
+        self.deadlines = []
+        self.sequence = itertools.count()
+        self.connections = {}
+        self.completed = Queue()
+        self.outgoing = []
+        self.buffer = bytearray(MAX_MESSAGE_SIZE)
+        self.view = memoryview(self.buffer)
+        self.logger.debug('created')
+
+    def run(self):
+        self.active = True
+        self.logger.info('thread started')
+        self.udpSocket = self.server.createUdpSocket()
+        self.batch = batch_socket(self.udpSocket, self.server.config.udp_batch_size)
+        self.tcpSocket = self.server.createTcpSocket()
+        self.tcpSocket.listen(TCP_BACKLOG)
+        self.tcpSocket.setblocking(0)
+        self.wakeup = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.wakeup.bind(('127.0.0.1', 0))
+        self.wakeup.setblocking(0)
+        self.upstreamSockets = {}
+        for server in self.server.upstream.servers:
+            self.upstream_socket(server.udp.family)
+        try:
+            while self.active:
+                self.poll()
+        except Exception:
+            self.logger.exception('event loop threw exception')
+            raise
+        finally:
+            self.server.stopEventLoop()
+            for conn in list(self.connections.values()):
+                self.close_connection(conn)
+            for sock in self.upstreamSockets.values():
+                sock.close()
+            self.wakeup.close()
+            self.tcpSocket.close()
+            self.udpSocket.close()
+            self.logger.info('thread stopped')
+
+    def stop(self):
+        self.active = False
+
+    def upstream_socket(self, family):
+        """Returns non-blocking UDP socket sending queries to upstream servers of given address family."""
+        sock = self.upstreamSockets.get(family)
+        if sock is None:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(0)
+            self.upstreamSockets[family] = sock
+        return sock
+
+    def poll(self):
+        """Waits for socket readiness or nearest query deadline and handles what is ready."""
+        timeout = POLL_INTERVAL
+        if self.deadlines:
+            timeout = max(0, min(timeout, self.deadlines[0][0] - time.time()))
+        readers = [self.udpSocket, self.tcpSocket, self.wakeup]
+        readers.extend(self.upstreamSockets.values())
+        readers.extend(sock for sock, conn in self.connections.items()
+                       if conn.outstanding < TCP_MAX_PIPELINE and len(conn.outbuf) < MAX_MESSAGE_SIZE)
+        writers = [sock for sock, conn in self.connections.items() if conn.outbuf]
+        rlist, wlist, xlist = select.select(readers, writers, [], timeout)
+        for sock in rlist:
+            if sock is self.udpSocket:
+                self.read_udp()
+            elif sock is self.tcpSocket:
+                self.accept_tcp()
+            elif sock is self.wakeup:
+                self.read_completed()
+            elif sock in self.connections:
+                self.read_tcp(self.connections[sock])
+            else:
+                self.read_upstream(sock)
+        for sock in wlist:
+            if sock in self.connections:
+                self.write_tcp(self.connections[sock])
+        self.expire(time.time())
+        self.flush_udp()
+
+    def receive(self, sock):
+        """Receives datagram into the reused receive buffer.
+
+        Returns (data, addr) tuple like sock.recvfrom."""
+        size, addr = sock.recvfrom_into(self.buffer)
+        return (self.view[:size].tobytes(), addr)
+
+    def read_udp(self):
+        received = 0
+        while received < UDP_DRAIN_LIMIT:
+            try:
+                datagrams = self.batch.receive()
+            except socket.error as err:
+                self.logger.debug('UDP receive failed: {err}'.format(err = err))
+                return
+            if not datagrams:
+                return
+            received += len(datagrams)
+            limiter = self.server.limiter
+            for data, addr in datagrams:
+                if not limiter.allow_query(addr):
+                    continue
+                self.handle_request(data, addr, lambda response, query = data, addr = addr, started = time.time(): self.send_udp(response, query, addr, started))
+
+    def send_udp(self, data, query, addr, started):
+        """Queues UDP reply, replies are sent together by flush_udp at the end of each poll."""
+        reply = self.server.limiter.filter_reply(udp_reply(data, query), query, addr)
+        if reply:
+            self.outgoing.append((reply, addr, started))
+
+    def flush_udp(self):
+        if not self.outgoing:
+            return
+        replies = self.outgoing
+        self.outgoing = []
+        sent = self.batch.send([(reply, addr) for reply, addr, started in replies])
+        now = time.time()
+        for reply, addr, started in replies:
+            metrics.observe(REPLY_LATENCY, now - started)
+        for i in range(len(replies) - sent):
+            metrics.count(DROPPED_SEND_ERROR)
+
+    def accept_tcp(self):
+        try:
+            sock, addr = self.tcpSocket.accept()
+        except socket.error:
+            return
+        if len(self.connections) >= TCP_MAX_CONNECTIONS:
+            metrics.count(DROPPED_TCP_LIMIT)
+            self.logger.debug("refusing TCP connection from '{addr}', limit reached".format(addr = addr))
+            sock.close()
+            return
+        sock.setblocking(0)
+        self.connections[sock] = TcpConnection(sock, addr, time.time())
+
+    def read_tcp(self, conn):
+        try:
+            data = conn.sock.recv(MAX_MESSAGE_SIZE)
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b''
+        if not data:
+            self.close_connection(conn)
+            return
+        conn.last_active = time.time()
+        conn.inbuf += data
+        for message in conn.messages():
+            conn.outstanding += 1
+            if not self.handle_request(message, conn.addr, lambda response, started = conn.last_active: self.send_tcp(conn, response, started)):
+                conn.outstanding -= 1
+
+    def send_tcp(self, conn, data, started):
+        conn.outstanding -= 1
+        conn.send_message(data)
+        metrics.observe(REPLY_LATENCY, time.time() - started)
+
+    def write_tcp(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except socket.error as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.close_connection(conn)
+            return
+        conn.outbuf = conn.outbuf[sent:]
+        conn.last_active = time.time()
+
+    def close_connection(self, conn):
+        conn.closed = True
+        self.connections.pop(conn.sock, None)
+        conn.sock.close()
+
+    def handle_request(self, data, addr, reply):
+        """Answers request directly or sends it upstream when it is forwarded.
+
+        reply is called with packed response when it is ready.
+        Returns False if the request was dropped and reply will not be called."""
+        snapshot = self.server.snapshot
+        passthrough = snapshot.forward_mode == FORWARD_PASSTHROUGH
+        behavior = None
+        try:
+            question = parse_question(data)
+        except WireError:
+            question = None
+        if question is not None and snapshot.zones:
+            answered = snapshot.zones.answer_raw(data, question)
+            if answered is not None:
+                zone, response = answered
+                metrics.count(zone.metric_key)
+                reply(response)
+                return True
+        if question is not None:
+            behavior = find_behavior(snapshot.matcher, question.name, question.qtype)
+            metrics.count(behavior.metric_key)
+            if behavior.template is not None:
+                reply(behavior.handle_raw(data, question))
+                return True
+            if behavior.strategy == 'forward' and passthrough:
+                cached = behavior.cached_raw(data, question)
+                if cached:
+                    reply(cached)
+                    return True
+                self.send_upstream(question.key(), data, PendingQuery(None, data, question, behavior, reply))
+                return True
+        elif passthrough:
+            metrics.count(DROPPED_MALFORMED)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("dropping malformed request from '{addr}'".format(addr = addr))
+            return False
+        try:
+            request = DNSRecord.parse(data)
+        except Exception:
+            metrics.count(DROPPED_MALFORMED)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("dropping malformed request from '{addr}'".format(addr = addr))
+            return False
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("handling request from '{addr}'".format(addr = addr))
+        if behavior is None:
+            behavior = first_or_default(snapshot.matcher, request)
+            metrics.count(behavior.metric_key)
+        if behavior.strategy != 'forward':
+            response = behavior.handle(request)
+            if response:
+                reply(response.pack())
+                return True
+            return False
+        response = behavior.cached_response(request)
+        if response:
+            reply(response.pack())
+            return True
+        query = bytes(behavior.forward_request(request).pack())
+        self.send_upstream(cache_key(request.q), query, PendingQuery(request, query, None, behavior, reply))
+        return True
+
+    def send_upstream(self, key, query, pending):
+        """Sends query to the best upstream server under new transaction ID and registers it as pending.
+
+        If a query with the same key is already pending, waits for its reply instead."""
+        leader = self.inflight.get(key)
+        if leader is not None:
+            leader.followers.append(pending)
+            self.server.inflight.coalesced += 1
+            return
+        self.server.inflight.leaders += 1
+        query_id = self.new_query_id()
+        pending.key = key
+        self.inflight[key] = pending
+        pending.wire = struct.pack('!H', query_id) + query[2:]
+        pending.candidates = self.server.upstream.ranked()
+        self.pending[query_id] = pending
+        self.schedule(time.time() + self.server.snapshot.upstream_timeout, TIMER_EXPIRE, query_id, pending)
+        self.send_next(query_id, pending)
+
+    def send_next(self, query_id, pending):
+        """Sends pending query to the next candidate server, scheduling hedge to the one after it."""
+        while pending.candidates:
+            server = pending.candidates.pop(0)
+            now = time.time()
+            try:
+                self.upstream_socket(server.udp.family).sendto(pending.wire, server.udp.sockaddr)
+            except socket.error:
+                self.logger.exception("sending query upstream to {server} for '{addr}' failed".format(server = server, addr = pending.name()))
+                server.failure()
+                continue
+            server.queries += 1
+            pending.sent[server.udp.sockaddr[:2]] = (server, now)
+            if pending.candidates and self.server.upstream.hedge_delay:
+                self.schedule(now + self.server.upstream.hedge_delay, TIMER_HEDGE, query_id, pending)
+            return True
+        return False
+
+    def schedule(self, when, kind, query_id, pending):
+        heapq.heappush(self.deadlines, (when, next(self.sequence), kind, query_id, pending))
+
+    def new_query_id(self):
+        query_id = random.randint(0, 0xffff)
+        while query_id in self.pending:
+            query_id = random.randint(0, 0xffff)
+        return query_id
+
+    def read_upstream(self, sock):
+        for i in range(UDP_DRAIN_LIMIT):
+            try:
+                data, addr = self.receive(sock)
+            except socket.error:
+                return
+            if len(data) < 4:
+                continue
+            query_id, flags = struct.unpack('!HH', data[:4])
+            pending = self.pending.get(query_id)
+            if pending is None or addr[:2] not in pending.sent:
+                continue
+            server, sent = pending.sent.pop(addr[:2])
+            if flags & RCODE_MASK in (RCODE_SERVFAIL, RCODE_REFUSED):
+                server.failure()
+                pending.fallback = data
+                if not pending.sent and not self.send_next(query_id, pending):
+                    self.finish(query_id, pending)
+                    self.deliver(pending, data)
+                continue
+            if flags & TC_FLAG:
+                self.retry_tcp(query_id, pending, server, sent)
+                continue
+            server.success(time.time() - sent)
+            self.server.upstream.penalize_late(pending.sent.values())
+            self.finish(query_id, pending)
+            self.deliver(pending, data)
+
+    def retry_tcp(self, query_id, pending, server, sent):
+        """Repeats query truncated over UDP to the same server over TCP from a helper thread,
+        which hands the reply back through self.completed."""
+        pending.candidates = []
+        def query():
+            try:
+                reply = server.tcp.query(pending.wire, self.server.upstream.timeout)
+            except UpstreamError as err:
+                self.logger.debug('upstream TCP retry failed: {err}'.format(err = err))
+                reply = None
+            self.completed.put((query_id, pending, server, sent, reply))
+            self.wakeup.sendto(b'\x00', self.wakeup.getsockname())
+        thread = Thread(name = 'dnsproxy-EventLoop-TCP-retry', target = query)
+        thread.daemon = True
+        thread.start()
+
+    def read_completed(self):
+        """Delivers replies of queries retried over TCP."""
+        try:
+            while True:
+                self.wakeup.recv(1)
+        except socket.error:
+            pass
+        while not self.completed.empty():
+            query_id, pending, server, sent, reply = self.completed.get()
+            if self.pending.get(query_id) is not pending:
+                continue
+            if reply is None:
+                server.failure()
+                if pending.sent:
+                    continue
+                self.finish(query_id, pending)
+                if pending.fallback is not None:
+                    self.deliver(pending, pending.fallback)
+                else:
+                    self.fail(pending)
+                continue
+            server.success(time.time() - sent)
+            self.finish(query_id, pending)
+            self.deliver(pending, reply)
+
+    def finish(self, query_id, pending):
+        """Unregisters pending query, so that new identical queries are sent upstream again."""
+        del self.pending[query_id]
+        if self.inflight.get(pending.key) is pending:
+            del self.inflight[pending.key]
+
+    def deliver(self, pending, data):
+        """Answers clients of pending query and its followers with upstream reply."""
+        if pending.request is None:
+            reply = pending.behavior.forwarded_raw(pending.question, pending.query[:2] + data[2:], pending.query)
+            pending.reply(reply)
+            for follower in pending.followers:
+                follower.reply(for_query(reply, follower.query, follower.question.end))
+            return
+        try:
+            upstream_reply = DNSRecord.parse(data)
+        except Exception:
+            self.logger.debug('malformed upstream reply, answering SERVFAIL')
+            self.fail(pending)
+            return
+        for waiting in [pending] + pending.followers:
+            waiting.reply(waiting.behavior.forward_response(waiting.request, upstream_reply).pack())
+
+    def fail(self, pending):
+        """Answers clients of pending query and its followers with stale cached answers or SERVFAIL."""
+        for waiting in [pending] + pending.followers:
+            if waiting.request is None:
+                stale = waiting.behavior.stale_raw(waiting.query, waiting.question)
+                if stale:
+                    waiting.reply(stale)
+                    continue
+                waiting.reply(error_reply(waiting.query, waiting.question.end, RCODE.SERVFAIL))
+                continue
+            request = waiting.request
+            stale = waiting.behavior.stale_response(request)
+            if stale:
+                waiting.reply(stale.pack())
+                continue
+            request.header.rcode = RCODE.SERVFAIL
+            waiting.reply(request.reply().pack())
+
+    def expire(self, now):
+        """Hedges slow queries, answers with SERVFAIL queries past their deadline and closes idle connections."""
+        while self.deadlines and self.deadlines[0][0] <= now:
+            when, sequence, kind, query_id, pending = heapq.heappop(self.deadlines)
+            if self.pending.get(query_id) is not pending:
+                continue
+            if kind == TIMER_HEDGE:
+                self.server.upstream.hedges += 1
+                self.send_next(query_id, pending)
+                continue
+            self.finish(query_id, pending)
+            for server, sent in pending.sent.values():
+                server.failure()
+            if pending.fallback is not None:
+                self.deliver(pending, pending.fallback)
+                continue
+            self.logger.debug("upstream timeout for address:'{addr}'".format(addr = pending.name()))
+            self.fail(pending)
+        for conn in list(self.connections.values()):
+            if conn.last_active + TCP_IDLE_TIMEOUT < now and not conn.outbuf and not conn.outstanding:
+                self.close_connection(conn)
@@ -0,0 +1,66 @@
+"""DNS proxy in-flight query coalescing module."""
+
+from threading import Lock, Event
+import logging
+
+module_logger = logging.getLogger('dnsproxy.inflight')
+
+class Call(object):
+    """Call in progress with its outcome, shared by all callers of the same key."""
+
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """Runs at most one call per key at a time.
+
+    Call flight.do(key, function) to run function, or to wait for the result of
+    the same key's function started by another thread. Errors are shared as well.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('dnsproxy.inflight.SingleFlight')
+        self.lock = Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, function):
+        """Runs function unless a call for key is already in flight.
+
+        Returns (result, shared) tuple, shared is True if result came from another caller's call."""
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = Call()
+                self.calls[key] = call
+                self.leaders += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return (call.result, True)
+        try:
+            call.result = function()
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return (call.result, False)
+
+    def stats(self):
+        """Returns dict with numbers of calls made and calls coalesced into them."""
+        return dict(
+            calls = self.leaders,
+            coalesced = self.coalesced)
@@ -0,0 +1,434 @@
+"""DNS proxy query journal module.
+
+JournalWriter records every query answered by the threads engine into
+compact binary segment files: time, client, name, type, the behavior which
+handled it, cache outcome, response code and latency. Serving threads only
+put raw data on a bounded queue; a background thread matches behaviors,
+encodes entries and rotates segments, keeping at most a configured number
+of them. Journals can be read back, replayed against a running proxy and
+used to simulate cache hit ratios for different cache sizes:
+
+    python -m dnsproxy.journal dump journal/*.jrnl
+    python -m dnsproxy.journal simulate --sizes 1000,10000,100000 journal/*.jrnl
+    python -m dnsproxy.journal replay --port 53 --speed 10 journal/*.jrnl"""
+
+from Queue import Queue, Full
+from threading import Thread, local
+from collections import OrderedDict
+from dnslib import QTYPE
+from wire import parse_question, WireError, RCODE_MASK
+from zones import zone_name
+import argparse
+import glob
+import os
+import select
+import socket
+import struct
+import sys
+import time
+import logging
+
+module_logger = logging.getLogger('dnsproxy.journal')
+
+DEFAULT_DIRECTORY = ''
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_SEGMENTS = 8
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_SIZES = '1000,10000,100000'
+DEFAULT_SPEED = 1.0
+DEFAULT_TIMEOUT = 2.0
+STOP_TIMEOUT = 5.0
+SEGMENT_PREFIX = 'queries'
+SEGMENT_SUFFIX = '.jrnl'
+MAGIC = b'DNSJRNL1'
+# length, time, client port, client address (IPv4 mapped into IPv6), qtype, strategy, cache outcome, rcode, transport, latency
+ENTRY = struct.Struct('<HdH16sHBBBBf')
+MAX_FIELD_LENGTH = 255
+IPV4_MAPPED = b'\x00' * 10 + b'\xff\xff'
+CACHE_NONE = 0
+CACHE_HIT = 1
+CACHE_MISS = 2
+CACHE_STALE = 3
+CACHE_OUTCOMES = ('none', 'hit', 'miss', 'stale')
+TRANSPORT_UDP = 0
+TRANSPORT_TCP = 1
+TRANSPORTS = ('udp', 'tcp')
+STRATEGIES = ('forward', 'block', 'respond', 'zone')
+UNKNOWN_STRATEGY = 255
+
+context = local()
+
+def begin():
+    """Marks start of handling a query in the current thread."""
+    context.cache = CACHE_NONE
+
+def note_cache(outcome):
+    """Remembers cache outcome of the query handled by the current thread."""
+    context.cache = outcome
+
+def cache_outcome():
+    """Returns cache outcome noted since begin() in the current thread."""
+    return getattr(context, 'cache', CACHE_NONE)
+
+def pack_address(host):
+    """Returns 16 byte packed IPv6 address, IPv4 addresses mapped into IPv6."""
+    if ':' in host:
+        return socket.inet_pton(socket.AF_INET6, host)
+    return IPV4_MAPPED + socket.inet_aton(host)
+
+def unpack_address(packed):
+    """Returns address string of 16 byte packed address."""
+    if packed[:12] == IPV4_MAPPED:
+        return socket.inet_ntoa(packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+class JournalEntry(object):
+    """Journaled query."""
+
+    __slots__ = ('time', 'client', 'port', 'qname', 'qtype', 'strategy', 'rule', 'cache', 'rcode', 'transport', 'latency')
+
+    def __init__(self, time, client, port, qname, qtype, strategy, rule, cache, rcode, transport, latency):
+        self.time = time
+        self.client = client
+        self.port = port
+        self.qname = qname
+        self.qtype = qtype
+        self.strategy = strategy
+        self.rule = rule
+        self.cache = cache
+        self.rcode = rcode
+        self.transport = transport
+        self.latency = latency
+
+    def __str__(self):
+        return '{time:.6f} {transport} {client}#{port} {qname} {qtype} {strategy} {rule} cache={cache} rcode={rcode} {latency:.3f}ms'.format(
+            time = self.time,
+            transport = TRANSPORTS[self.transport] if self.transport < len(TRANSPORTS) else self.transport,
+            client = self.client,
+            port = self.port,
+            qname = self.qname,
+            qtype = QTYPE.get(self.qtype, self.qtype),
+            strategy = self.strategy,
+            rule = self.rule.encode('utf-8') or '-',
+            cache = CACHE_OUTCOMES[self.cache] if self.cache < len(CACHE_OUTCOMES) else self.cache,
+            rcode = self.rcode,
+            latency = self.latency * 1000)
+
+def encode_entry(entry):
+    """Returns binary journal entry."""
+    qname = entry.qname[:MAX_FIELD_LENGTH]
+    rule = entry.rule.encode('utf-8')[:MAX_FIELD_LENGTH]
+    strategy = STRATEGIES.index(entry.strategy) if entry.strategy in STRATEGIES else UNKNOWN_STRATEGY
+    length = ENTRY.size + 2 + len(qname) + len(rule)
+    return b''.join((
+        ENTRY.pack(length, entry.time, entry.port, pack_address(entry.client), entry.qtype,
+                   strategy, entry.cache, entry.rcode, entry.transport, entry.latency),
+        struct.pack('!B', len(qname)), qname, struct.pack('!B', len(rule)), rule))
+
+def decode_entry(data, offset):
+    """Decodes journal entry starting at offset.
+
+    Returns (JournalEntry, offset after it) tuple."""
+    length, when, port, client, qtype, strategy, cache, rcode, transport, latency = ENTRY.unpack_from(data, offset)
+    position = offset + ENTRY.size
+    qname_length, = struct.unpack_from('!B', data, position)
+    qname = bytes(data[position + 1:position + 1 + qname_length])
+    position += 1 + qname_length
+    rule_length, = struct.unpack_from('!B', data, position)
+    rule = bytes(data[position + 1:position + 1 + rule_length]).decode('utf-8', 'replace')
+    return (JournalEntry(when, unpack_address(client), port, qname, qtype,
+                         STRATEGIES[strategy] if strategy < len(STRATEGIES) else 'unknown', rule,
+                         cache, rcode, transport, latency), offset + length)
+
+def read_segment(filename):
+    """Reads entries of one segment file, stopping at an incomplete entry written last.
+
+    Returns generator of JournalEntry."""
+    with open(filename, 'rb') as file:
+        data = file.read()
+    if data[:len(MAGIC)] != MAGIC:
+        module_logger.warning("'{file}' is not a query journal".format(file = filename))
+        return
+    offset = len(MAGIC)
+    while offset + ENTRY.size <= len(data):
+        length, = struct.unpack_from('<H', data, offset)
+        if offset + length > len(data):
+            break
+        entry, offset = decode_entry(data, offset)
+        yield entry
+
+def read_journal(filenames):
+    """Reads entries of segment files in the given order, directories are expanded to their segments.
+
+    Returns generator of JournalEntry."""
+    for filename in filenames:
+        if os.path.isdir(filename):
+            segments = sorted(glob.glob(os.path.join(filename, SEGMENT_PREFIX + '-*' + SEGMENT_SUFFIX)))
+        else:
+            segments = [filename]
+        for segment in segments:
+            for entry in read_segment(segment):
+                yield entry
+
+class JournalWriter(object):
+    """Writes queries to journal segments in directory from a background thread.
+
+    Call journal.record(...) from serving threads after replying to a query, it never blocks;
+    when the queue is full the entry is dropped and counted. Segments are named
+    queries-<pid>-<number>.jrnl, so worker processes can share the directory;
+    a new segment is started when the current one reaches segment_bytes
+    and only the newest segments of this process are kept.
+    Call journal.stop() to write out queued entries.
+    """
+
+    def __init__(self, directory, segment_bytes = DEFAULT_SEGMENT_BYTES, segments = DEFAULT_SEGMENTS, queue_size = DEFAULT_QUEUE_SIZE):
+        self.logger = logging.getLogger('dnsproxy.journal.JournalWriter')
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segments = max(1, segments)
+        self.queue = Queue(queue_size)
+        self.file = None
+        self.written = []
+        self.number = 0
+        self.size = 0
+        self.recorded = 0
+        self.dropped = 0
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        if self.thread is not None and self.thread.isAlive() and self.pid == os.getpid():
+            return
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.file = None
+            self.written = []
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.thread = Thread(name = 'dnsproxy-journal', target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Writes out queued entries and stops the thread."""
+        if self.thread is None:
+            return
+        try:
+            self.queue.put(None, timeout = STOP_TIMEOUT)
+        except Full:
+            pass
+        self.thread.join(STOP_TIMEOUT)
+        self.thread = None
+
+    def record(self, query, reply, addr, transport, started, latency, snapshot, cache):
+        """Queues query answered with reply (None if it was not answered) to be journaled."""
+        try:
+            self.queue.put_nowait((query, reply, addr, transport, started, latency, snapshot, cache))
+        except Full:
+            self.dropped += 1
+
+    def run(self):
+        self.logger.info('thread started')
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self.write(self.entry(*item))
+            except Exception:
+                self.logger.exception('failed to journal query')
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.logger.info('thread stopped')
+
+    def entry(self, query, reply, addr, transport, started, latency, snapshot, cache):
+        """Decodes recorded query and matches its behavior.
+
+        Returns JournalEntry."""
+        try:
+            question = parse_question(query)
+            qname, qtype = question.name, question.qtype
+        except WireError:
+            question = None
+            qname, qtype = '', 0
+        strategy, rule = 'unknown', u''
+        if question is not None and snapshot is not None:
+            zone = snapshot.zones.find_zone(zone_name(qname)) if snapshot.zones else None
+            if zone is not None:
+                strategy, rule = 'zone', zone.origin
+            else:
+                behavior = snapshot.matcher.match(qname, qtype)
+                if behavior is None:
+                    strategy, rule = 'forward', u''
+                else:
+                    strategy, rule = behavior.strategy, behavior.metric_key[1][1]
+        rcode = struct.unpack_from('!H', reply, 2)[0] & RCODE_MASK if reply and len(reply) >= 4 else 255
+        if not isinstance(rule, unicode):
+            rule = rule.decode('utf-8', 'replace')
+        return JournalEntry(started, addr[0], addr[1], qname, qtype, strategy, rule, cache, rcode, transport, latency)
+
+    def write(self, entry):
+        data = encode_entry(entry)
+        if self.file is None or self.size + len(data) > self.segment_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        self.recorded += 1
+
+    def rotate(self):
+        """Starts a new segment, removing the oldest ones above the limit."""
+        if self.file is not None:
+            self.file.close()
+        self.number += 1
+        filename = os.path.join(self.directory, '{prefix}-{pid}-{number:06d}{suffix}'.format(
+            prefix = SEGMENT_PREFIX, pid = self.pid, number = self.number, suffix = SEGMENT_SUFFIX))
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC)
+        self.size = len(MAGIC)
+        self.written.append(filename)
+        while len(self.written) > self.segments:
+            try:
+                os.remove(self.written.pop(0))
+            except OSError:
+                self.logger.exception('failed to remove old journal segment')
+
+    def stats(self):
+        """Returns dict with numbers of recorded, queued and dropped entries."""
+        return dict(
+            recorded = self.recorded,
+            queued = self.queue.qsize(),
+            dropped = self.dropped)
+
+class CacheSimulator(object):
+    """LRU caches of several sizes fed with the forwarded queries of a journal.
+
+    Entries expire ttl seconds of journal time after they were stored (0 never expires).
+    Call simulator.feed(entry) for each entry and simulator.results() for hit ratios.
+    """
+
+    def __init__(self, sizes, ttl = 0):
+        self.sizes = sorted(sizes)
+        self.ttl = ttl
+        self.caches = [OrderedDict() for size in self.sizes]
+        self.hits = [0] * len(self.sizes)
+        self.queries = 0
+        self.names = set()
+
+    def feed(self, entry):
+        if entry.strategy != 'forward':
+            return
+        key = (entry.qname.lower(), entry.qtype)
+        self.queries += 1
+        self.names.add(key)
+        for index, cache in enumerate(self.caches):
+            stored = cache.pop(key, None)
+            if stored is not None and (not self.ttl or entry.time < stored + self.ttl):
+                self.hits[index] += 1
+                cache[key] = stored
+                continue
+            cache[key] = entry.time
+            if len(cache) > self.sizes[index]:
+                cache.popitem(last = False)
+
+    def results(self):
+        """Returns list of (cache size, hits, hit ratio) tuples."""
+        return [(size, hits, hits / float(self.queries) if self.queries else 0)
+                for size, hits in zip(self.sizes, self.hits)]
+
+def replay(entries, port, host = '127.0.0.1', speed = DEFAULT_SPEED, timeout = DEFAULT_TIMEOUT):
+    """Sends journaled queries over UDP keeping their spacing, speed times faster (0 sends them all at once).
+
+    Returns dict with numbers of queries, answers and lost queries, seconds and latency percentiles."""
+    from dnsproxy.bench import encode_query, percentile
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    sock.connect((host, port))
+    pending = OrderedDict()
+    latencies = []
+    sent = 0
+    next_id = 0
+    first = None
+    started = time.time()
+    def receive(wait):
+        while True:
+            rlist, wlist, xlist = select.select([sock], [], [], max(0, wait))
+            if not rlist:
+                return
+            wait = 0
+            try:
+                reply = sock.recv(65535)
+            except socket.error:
+                continue
+            if len(reply) >= 2:
+                query_sent = pending.pop(struct.unpack_from('!H', reply)[0], None)
+                if query_sent is not None:
+                    latencies.append(time.time() - query_sent)
+    for entry in entries:
+        if first is None:
+            first = entry.time
+        if speed:
+            receive(started + (entry.time - first) / speed - time.time())
+        else:
+            receive(0)
+        next_id = (next_id + 1) & 0xffff
+        try:
+            sock.send(encode_query(entry.qname, entry.qtype, next_id))
+        except socket.error:
+            continue
+        pending[next_id] = time.time()
+        sent += 1
+    deadline = time.time() + timeout
+    while pending and time.time() < deadline:
+        receive(deadline - time.time())
+    elapsed = time.time() - started
+    sock.close()
+    latencies.sort()
+    return OrderedDict([
+        ('queries', sent),
+        ('answered', len(latencies)),
+        ('lost', sent - len(latencies)),
+        ('seconds', elapsed),
+        ('qps', len(latencies) / elapsed if elapsed else 0),
+        ('p50', percentile(latencies, 0.5) * 1000),
+        ('p99', percentile(latencies, 0.99) * 1000)])
+
+def main(argv = None):
+    """Dumps, simulates caching of or replays journals given on command line.
+
+    Returns exit status."""
+    parser = argparse.ArgumentParser(prog = 'python -m dnsproxy.journal', description = 'Reads DNS proxy query journals.')
+    commands = parser.add_subparsers(dest = 'command')
+    dump = commands.add_parser('dump', help = 'print journal entries')
+    simulate = commands.add_parser('simulate', help = 'report cache hit ratios of forwarded queries for several cache sizes')
+    simulate.add_argument('--sizes', default = DEFAULT_SIZES, help = 'comma separated cache sizes')
+    simulate.add_argument('--ttl', type = float, default = 0, help = 'seconds cached answers live, 0 never expire')
+    replayer = commands.add_parser('replay', help = 'send journaled queries to a proxy over UDP')
+    replayer.add_argument('--host', default = '127.0.0.1')
+    replayer.add_argument('--port', type = int, default = 53)
+    replayer.add_argument('--speed', type = float, default = DEFAULT_SPEED, help = 'replay speed factor, 0 sends as fast as possible')
+    replayer.add_argument('--timeout', type = float, default = DEFAULT_TIMEOUT, help = 'seconds to wait for last answers')
+    for command in (dump, simulate, replayer):
+        command.add_argument('files', nargs = '+', metavar = 'FILE', help = 'journal segment or directory')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    logging.getLogger('dnsproxy').setLevel(logging.WARNING)
+    entries = read_journal(args.files)
+    if args.command == 'dump':
+        for entry in entries:
+            print str(entry)
+    elif args.command == 'simulate':
+        simulator = CacheSimulator([int(size) for size in args.sizes.split(',') if size.strip()], args.ttl)
+        for entry in entries:
+            simulator.feed(entry)
+        print 'forwarded queries {queries}, distinct names {names}'.format(queries = simulator.queries, names = len(simulator.names))
+        for size, hits, ratio in simulator.results():
+            print '{size:>10} {hits:>10} {ratio:.3f}'.format(size = size, hits = hits, ratio = ratio)
+    else:
+        results = replay(entries, args.port, args.host, args.speed, args.timeout)
+        for key, value in results.items():
+            print '{key:16} {value}'.format(key = key, value = round(value, 3) if isinstance(value, float) else value)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""DNS proxy log file index module.
+
+LogIndex keeps byte offsets, timestamps and levels of the entries of the
+log file written by LogShipper, so that the latest entries, or a page of
+entries around a cursor, can be read by seeking straight to them instead
+of parsing the whole file. The index is extended incrementally as the file
+grows and rebuilt when the file is rotated."""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from threading import Lock
+import os
+import time
+import logging
+
+module_logger = logging.getLogger('dnsproxy.logindex')
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_ENTRY_SIZE = 64 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+DATE_LENGTH = 19
+LEVEL_START = 24
+LEVEL_END = 32
+MESSAGE_START = 33
+
+def parse_level(name):
+    """Returns level number for level name, 0 for unknown names."""
+    number = logging.getLevelName(name.strip().upper())
+    return number if isinstance(number, int) else 0
+
+class LogIndex(object):
+    """Index of entries of a log file formatted with logqueue.LOG_FORMAT.
+
+    Entries are identified by sequence numbers which keep growing across log rotations.
+    Call index.page(...) to obtain entries, newest page first, optionally filtered by level and time.
+    Call index.after(id, ...) to obtain entries newer than given one, oldest first.
+    """
+
+    def __init__(self, filename):
+        self.logger = logging.getLogger('dnsproxy.logindex.LogIndex')
+        self.filename = filename
+        self.lock = Lock()
+        self.days = {}
+        self.reset(0)
+
+    def reset(self, base):
+        """Forgets indexed entries, following entries are numbered from base."""
+        self.base = base
+        self.offsets = array('l')
+        self.times = array('l')
+        self.levels = array('B')
+        self.size = 0
+        self.inode = None
+
+    def parse_time(self, date):
+        """Parses entry date.
+
+        Returns seconds since epoch or None if date is not valid."""
+        day = date[:10]
+        midnight = self.days.get(day)
+        try:
+            if midnight is None:
+                midnight = int(time.mktime(time.strptime(day, '%Y-%m-%d')))
+                self.days[day] = midnight
+            return midnight + int(date[11:13]) * 3600 + int(date[14:16]) * 60 + int(date[17:19])
+        except ValueError:
+            return None
+
+    def refresh(self):
+        """Indexes entries appended since the previous refresh, starts over if the file was rotated."""
+        with self.lock:
+            try:
+                stat = os.stat(self.filename)
+            except OSError:
+                self.reset(self.base + len(self.offsets))
+                return
+            if (self.inode is not None and stat.st_ino != self.inode) or stat.st_size < self.size:
+                self.reset(self.base + len(self.offsets))
+            self.inode = stat.st_ino
+            if stat.st_size == self.size:
+                return
+            with open(self.filename, 'rb') as file:
+                file.seek(self.size)
+                offset = self.size
+                pending = b''
+                while True:
+                    chunk = file.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    lines = (pending + chunk).split(b'\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        self.index_line(line, offset)
+                        offset += len(line) + 1
+                self.size = offset
+
+    def index_line(self, line, offset):
+        """Adds line starting at offset to the index if it starts a new entry."""
+        if len(line) < MESSAGE_START or not line[:1].isdigit():
+            return
+        seconds = self.parse_time(line[:DATE_LENGTH])
+        if seconds is None:
+            return
+        self.offsets.append(offset)
+        self.times.append(seconds)
+        self.levels.append(min(parse_level(line[LEVEL_START:LEVEL_END]), 255))
+
+    def read(self, file, position):
+        """Reads entry at index position.
+
+        Returns entry dict with id, date, logLevel and message."""
+        start = self.offsets[position]
+        end = self.offsets[position + 1] if position + 1 < len(self.offsets) else self.size
+        file.seek(start)
+        text = file.read(min(end - start, MAX_ENTRY_SIZE)).rstrip(b'\n').decode('utf-8', 'replace')
+        return dict(
+            id = self.base + position,
+            date = text[:DATE_LENGTH],
+            logLevel = text[LEVEL_START:LEVEL_END].strip(),
+            message = text[MESSAGE_START:])
+
+    def positions(self, since, until):
+        """Returns range of index positions with entries logged between since and until (seconds, inclusive)."""
+        first = 0 if since is None else bisect_left(self.times, since)
+        last = len(self.times) if until is None else bisect_right(self.times, until)
+        return (first, last)
+
+    def page(self, before = None, limit = DEFAULT_PAGE_SIZE, level = 0, since = None, until = None):
+        """Finds newest entries older than entry before (or the newest ones) with at least given level.
+
+        Returns (entries in file order, more) tuple, more is True if older matching entries exist."""
+        self.refresh()
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        with self.lock:
+            first, last = self.positions(since, until)
+            if before is not None:
+                last = min(last, before - self.base)
+            found = []
+            position = last - 1
+            while position >= first and len(found) <= limit:
+                if self.levels[position] >= level:
+                    found.append(position)
+                position -= 1
+            more = len(found) > limit
+            found = found[:limit]
+            found.reverse()
+            return (self.read_entries(found), more)
+
+    def after(self, after, limit = MAX_PAGE_SIZE, level = 0):
+        """Finds entries newer than entry after with at least given level.
+
+        Returns (entries in file order, id of the last entry looked at) tuple,
+        the id is where the next call should continue from."""
+        self.refresh()
+        with self.lock:
+            position = max(0, after + 1 - self.base)
+            found = []
+            while position < len(self.offsets) and len(found) < limit:
+                if self.levels[position] >= level:
+                    found.append(position)
+                position += 1
+            return (self.read_entries(found), max(after, self.base + position - 1))
+
+    def last_id(self):
+        """Returns id of the newest indexed entry, base - 1 if there is none."""
+        self.refresh()
+        with self.lock:
+            return self.base + len(self.offsets) - 1
+
+    def read_entries(self, positions):
+        if not positions:
+            return []
+        with open(self.filename, 'rb') as file:
+            return [self.read(file, position) for position in positions]
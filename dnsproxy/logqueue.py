@@ -0,0 +1,151 @@
+"""DNS proxy asynchronous logging module.
+
+Serving threads only put log records on a bounded queue. A background
+thread formats them and writes them to the rotating log file and console,
+so disk and console I/O do not delay DNS replies. When the queue is full
+records are dropped and counted rather than blocking a serving thread."""
+
+from Queue import Queue, Full
+from threading import Thread
+from behavior import getLogLevelNumber
+import logging
+import logging.handlers
+import atexit
+
+module_logger = logging.getLogger('dnsproxy.logqueue')
+
+DEFAULT_FILENAME = 'dnsapp.log'
+DEFAULT_LEVEL = 'DEBUG'
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+DEFAULT_QUEUE_SIZE = 10000
+STOP_TIMEOUT = 5.0
+LOG_FORMAT = "%(asctime)-15s %(levelname)-8s %(name)s.%(funcName)s @ %(threadName)s : %(message)s"
+
+class QueueHandler(logging.Handler):
+    """Handler putting records on a queue.
+
+    Message and exception text are rendered before enqueueing, so records
+    do not keep references to objects which can change before they are written.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Renders record message and exception text.
+
+        Returns record ready to be handled by another thread."""
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(Thread):
+    """Thread passing records from a queue to handlers until stopped."""
+
+    def __init__(self, queue, handlers):
+        Thread.__init__(self)
+        self.name = 'dnsproxy-log'
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Writes out queued records and stops the thread."""
+        try:
+            self.queue.put(None, timeout = STOP_TIMEOUT)
+        except Full:
+            pass
+        self.join(STOP_TIMEOUT)
+        for handler in self.handlers:
+            handler.close()
+
+class LogShipper(object):
+    """Ships records of a logger to a rotating log file and console through QueueHandler and QueueListener.
+
+    Call shipper.configure(level, max_bytes, backup_count) to apply logging configuration.
+    Call shipper.restart() in a forked process, which does not inherit the listener thread.
+    """
+
+    def __init__(self, logger, filename, level = DEFAULT_LEVEL, max_bytes = DEFAULT_MAX_BYTES,
+                 backup_count = DEFAULT_BACKUP_COUNT, queue_size = DEFAULT_QUEUE_SIZE):
+        self.logger = logger
+        self.filename = filename
+        self.level = level
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue_size = queue_size
+        self.formatter = logging.Formatter(LOG_FORMAT)
+        self.handler = None
+        self.listener = None
+        self.start()
+        atexit.register(self.stop)
+
+    def start(self):
+        """Creates handlers, queue and listener thread and attaches the queue handler to the logger."""
+        fileHandler = logging.handlers.RotatingFileHandler(self.filename, maxBytes = self.max_bytes, backupCount = self.backup_count)
+        fileHandler.setFormatter(self.formatter)
+        consoleHandler = logging.StreamHandler()
+        consoleHandler.setFormatter(self.formatter)
+        queue = Queue(self.queue_size)
+        self.handler = QueueHandler(queue)
+        self.listener = QueueListener(queue, [fileHandler, consoleHandler])
+        self.listener.start()
+        self.logger.setLevel(getLogLevelNumber(self.level))
+        self.logger.addHandler(self.handler)
+
+    def stop(self):
+        """Detaches the queue handler and stops the listener after it wrote out queued records."""
+        if self.handler is None:
+            return
+        self.logger.removeHandler(self.handler)
+        self.listener.stop()
+        self.handler = None
+        self.listener = None
+
+    def restart(self):
+        """Replaces queue and listener, e.g. in a forked process. Queued records are discarded."""
+        if self.handler is not None:
+            self.logger.removeHandler(self.handler)
+            self.handler = None
+        self.start()
+
+    def configure(self, level = DEFAULT_LEVEL, max_bytes = DEFAULT_MAX_BYTES, backup_count = DEFAULT_BACKUP_COUNT):
+        """Sets logger level and log file rotation, restarting the listener if rotation changes."""
+        self.level = level
+        self.logger.setLevel(getLogLevelNumber(level))
+        if (max_bytes, backup_count) != (self.max_bytes, self.backup_count):
+            self.max_bytes = max_bytes
+            self.backup_count = backup_count
+            self.stop()
+            self.start()
+
+    def stats(self):
+        """Returns dict with number of queued and dropped records."""
+        if self.handler is None:
+            return dict(queued = 0, dropped = 0)
+        return dict(
+            queued = self.handler.queue.qsize(),
+            dropped = self.handler.dropped)
@@ -0,0 +1,284 @@
+"""DNS proxy metrics module.
+
+Counters and histograms recorded on the serving path. Every thread writes
+only to its own shard, so recording takes no lock; shards are summed when
+metrics are read and shards of exited threads are folded into one. Snapshots
+are nested dicts, so snapshots of worker processes can be merged like the rest
+of the server stats."""
+
+from threading import Lock, local, current_thread
+from weakref import ref
+from collections import defaultdict
+from bisect import bisect_left
+import time
+import logging
+
+module_logger = logging.getLogger('dnsproxy.metrics')
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+GAUGE = 'gauge'
+
+QUERIES = 'dnsproxy_queries_total'
+DROPPED = 'dnsproxy_dropped_total'
+REPLY_SECONDS = 'dnsproxy_reply_seconds'
+UPSTREAM_RTT_SECONDS = 'dnsproxy_upstream_rtt_seconds'
+RATE_LIMITED = 'dnsproxy_rate_limited_total'
+STAGE_SECONDS = 'dnsproxy_stage_seconds'
+
+DEFINITIONS = {
+    QUERIES : (COUNTER, 'Queries received by strategy and rule.', ('strategy', 'rule')),
+    DROPPED : (COUNTER, 'Requests and replies dropped by reason.', ('reason',)),
+    REPLY_SECONDS : (HISTOGRAM, 'Time from receiving a query to sending its reply.', ()),
+    UPSTREAM_RTT_SECONDS : (HISTOGRAM, 'Upstream server round trip time.', ('upstream',)),
+    RATE_LIMITED : (COUNTER, 'UDP queries and replies over rate limits by action taken.', ('action',)),
+    STAGE_SECONDS : (HISTOGRAM, 'Time spent in each stage of handling a query, recorded when stage timing is enabled.', ('stage',)),
+}
+
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+BUCKET_LABELS = tuple(repr(bound) for bound in BUCKETS) + ('+Inf',)
+
+def key(name, *labels):
+    """Returns series key of metric with given label values, in the order given by DEFINITIONS.
+
+    Keys are meant to be built once and reused by Metrics.count and Metrics.observe calls."""
+    return (name, labels)
+
+DROPPED_MALFORMED = key(DROPPED, 'malformed')
+DROPPED_SEND_ERROR = key(DROPPED, 'send_error')
+DROPPED_TCP_LIMIT = key(DROPPED, 'tcp_limit')
+REPLY_LATENCY = key(REPLY_SECONDS)
+LIMITED_QUERY = key(RATE_LIMITED, 'drop_query')
+LIMITED_REPLY = key(RATE_LIMITED, 'drop_reply')
+LIMITED_SLIP = key(RATE_LIMITED, 'slip')
+STAGE_PARSE = key(STAGE_SECONDS, 'parse')
+STAGE_MATCH = key(STAGE_SECONDS, 'match')
+STAGE_HANDLE = key(STAGE_SECONDS, 'handle')
+STAGE_UPSTREAM = key(STAGE_SECONDS, 'upstream')
+STAGE_LOG = key(STAGE_SECONDS, 'log')
+STAGE_PACK = key(STAGE_SECONDS, 'pack')
+STAGE_SEND = key(STAGE_SECONDS, 'send')
+
+class Shard(object):
+    """Metrics written by one thread."""
+
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = {}
+
+    def merge(self, shard):
+        """Adds values of another shard to this one."""
+        for key, value in dict(shard.counters).items():
+            self.counters[key] += value
+        for key, histogram in dict(shard.histograms).items():
+            total = self.histograms.get(key)
+            if total is None:
+                self.histograms[key] = list(histogram)
+            else:
+                for bucket, value in enumerate(list(histogram)):
+                    total[bucket] += value
+
+class Metrics(object):
+    """Registry of counters and histograms with per-thread shards.
+
+    Call metrics.count(key) and metrics.observe(key, value) on the serving path
+    with a series key from key(name, *labels). Call metrics.snapshot() to obtain current values.
+    Shards of threads which exited are merged into retired by snapshot(), so that short-lived
+    threads do not keep adding shards to sum.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.local = local()
+        self.shards = []
+        self.retired = Shard()
+
+    def shard(self):
+        """Returns shard of the calling thread, registering it on first use."""
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = Shard()
+            self.local.shard = shard
+            with self.lock:
+                self.shards.append((ref(current_thread()), shard))
+            return shard
+
+    def retire(self):
+        """Merges shards of exited threads into a new retired shard. Must be called with lock held."""
+        live = []
+        dead = []
+        for entry in self.shards:
+            thread = entry[0]()
+            if thread is not None and thread.isAlive():
+                live.append(entry)
+            else:
+                dead.append(entry[1])
+        if not dead:
+            return
+        retired = Shard()
+        retired.merge(self.retired)
+        for shard in dead:
+            retired.merge(shard)
+        self.retired = retired
+        self.shards = live
+
+    def count(self, key, value = 1):
+        """Increments counter series."""
+        try:
+            self.local.shard.counters[key] += value
+        except AttributeError:
+            self.shard().counters[key] += value
+
+    def observe(self, key, value):
+        """Records value in histogram series."""
+        try:
+            histograms = self.local.shard.histograms
+        except AttributeError:
+            histograms = self.shard().histograms
+        try:
+            histogram = histograms[key]
+        except KeyError:
+            histogram = histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        histogram[bisect_left(BUCKETS, value)] += 1
+        histogram[-1] += value
+
+    def snapshot(self):
+        """Sums all shards.
+
+        Returns dict with counters and histograms dicts keyed by metric name and label string,
+        histograms are dicts of per-bucket (not cumulative) counts, sum and count."""
+        with self.lock:
+            self.retire()
+            shards = [self.retired] + [shard for thread, shard in self.shards]
+        counters = {}
+        histograms = {}
+        for shard in shards:
+            for (name, labels), value in dict(shard.counters).items():
+                series = counters.setdefault(name, {})
+                labels = label_string(name, labels)
+                series[labels] = series.get(labels, 0) + value
+            for (name, labels), histogram in dict(shard.histograms).items():
+                histogram = list(histogram)
+                series = histograms.setdefault(name, {})
+                merged = series.setdefault(label_string(name, labels), dict(
+                    buckets = dict((bucket, 0) for bucket in BUCKET_LABELS), sum = 0.0, count = 0))
+                for bucket, count in zip(BUCKET_LABELS, histogram):
+                    merged['buckets'][bucket] += count
+                merged['sum'] += histogram[-1]
+                merged['count'] += sum(histogram[:-1])
+        return dict(counters = counters, histograms = histograms)
+
+def escape(value):
+    """Returns label value escaped for Prometheus text format."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def label_string(name, labels):
+    """Returns Prometheus label list (without braces) for label values of given metric."""
+    names = DEFINITIONS[name][2] if name in DEFINITIONS else ()
+    return ','.join('{label}="{value}"'.format(label = label, value = escape(value)) for label, value in zip(names, labels))
+
+def series(name, labels, value):
+    """Returns one Prometheus sample line."""
+    if labels:
+        return '{name}{{{labels}}} {value}'.format(name = name, labels = labels, value = value)
+    return '{name} {value}'.format(name = name, value = value)
+
+def header(name, kind, help):
+    return ['# HELP {name} {help}'.format(name = name, help = help), '# TYPE {name} {kind}'.format(name = name, kind = kind)]
+
+def render_prometheus(stats):
+    """Renders server stats (with metrics snapshot under 'metrics') in Prometheus text exposition format.
+
+    Returns text."""
+    lines = []
+    snapshot = stats.get('metrics', {})
+    for name, values in sorted(snapshot.get('counters', {}).items()):
+        kind, help, label_names = DEFINITIONS.get(name, (COUNTER, name, ()))
+        lines.extend(header(name, kind, help))
+        lines.extend(series(name, labels, value) for labels, value in sorted(values.items()))
+    for name, values in sorted(snapshot.get('histograms', {}).items()):
+        kind, help, label_names = DEFINITIONS.get(name, (HISTOGRAM, name, ()))
+        lines.extend(header(name, kind, help))
+        for labels, histogram in sorted(values.items()):
+            cumulative = 0
+            for bucket in BUCKET_LABELS:
+                cumulative += histogram['buckets'][bucket]
+                bucket_labels = ','.join(part for part in (labels, 'le="{le}"'.format(le = bucket)) if part)
+                lines.append(series(name + '_bucket', bucket_labels, cumulative))
+            lines.append(series(name + '_sum', labels, histogram['sum']))
+            lines.append(series(name + '_count', labels, histogram['count']))
+    cache = stats.get('cache', {})
+    for stat, name, kind, help in (
+            ('hits', 'dnsproxy_cache_hits_total', COUNTER, 'Forwarded queries answered from cache.'),
+            ('misses', 'dnsproxy_cache_misses_total', COUNTER, 'Forwarded queries not found in cache.'),
+            ('evictions', 'dnsproxy_cache_evictions_total', COUNTER, 'Cache entries evicted to make room.'),
+            ('size', 'dnsproxy_cache_entries', GAUGE, 'Cached answers.')):
+        if stat in cache:
+            lines.extend(header(name, kind, help))
+            lines.append(series(name, '', cache[stat]))
+    inflight = stats.get('inflight', {})
+    if 'coalesced' in inflight:
+        lines.extend(header('dnsproxy_coalesced_total', COUNTER, 'Queries which waited for an identical query in flight.'))
+        lines.append(series('dnsproxy_coalesced_total', '', inflight['coalesced']))
+    upstream = stats.get('upstream', {})
+    if 'hedges' in upstream:
+        lines.extend(header('dnsproxy_upstream_hedges_total', COUNTER, 'Queries also sent to another upstream server.'))
+        lines.append(series('dnsproxy_upstream_hedges_total', '', upstream['hedges']))
+    for stat, name, help in (
+            ('queries', 'dnsproxy_upstream_queries_total', 'Queries sent to upstream server.'),
+            ('failures', 'dnsproxy_upstream_failures_total', 'Failed upstream queries.')):
+        servers = upstream.get('servers', {})
+        if servers:
+            lines.extend(header(name, COUNTER, help))
+            lines.extend(series(name, 'upstream="{server}"'.format(server = escape(server)), values.get(stat, 0))
+                         for server, values in sorted(servers.items()))
+    return '\n'.join(lines) + '\n'
+
+class StageClock(object):
+    """Times successive stages of handling one query.
+
+    Call clock.lap(key) at the end of each stage to record the time since the previous lap
+    (or since the clock was created) in histogram series key."""
+
+    __slots__ = ('mark',)
+
+    def __init__(self):
+        self.mark = time.time()
+
+    def lap(self, key):
+        now = time.time()
+        metrics.observe(key, now - self.mark)
+        self.mark = now
+
+class NullClock(object):
+    """Stage clock recording nothing, used when stage timing is disabled."""
+
+    __slots__ = ()
+
+    def lap(self, key):
+        pass
+
+NULL_CLOCK = NullClock()
+
+class RateMeter(object):
+    """Computes rate of a growing total between successive calls."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.total = None
+        self.time = None
+
+    def rate(self, total):
+        """Returns change of total per second since the previous call, 0 on the first one."""
+        now = time.time()
+        with self.lock:
+            previous_total, previous_time = self.total, self.time
+            self.total, self.time = total, now
+        if previous_total is None or now <= previous_time:
+            return 0.0
+        return max(0, total - previous_total) / (now - previous_time)
+
+metrics = Metrics()
@@ -0,0 +1,94 @@
+"""DNS proxy sampling profiler module.
+
+SamplingProfiler periodically records the call stacks of all threads of the
+process for a fixed window and counts identical stacks. The result is written
+in the collapsed stack format read by flamegraph.pl and speedscope, one line
+per stack: thread;module:function;module:function count.
+Stacks are sampled from a separate thread with sys._current_frames(), so
+serving threads are not instrumented and run at full speed between samples."""
+
+from threading import Thread, Lock, current_thread, enumerate as threads
+from collections import defaultdict
+import sys
+import time
+import logging
+
+module_logger = logging.getLogger('dnsproxy.profiler')
+
+DEFAULT_SECONDS = 10.0
+MAX_SECONDS = 300.0
+DEFAULT_INTERVAL = 0.005
+MIN_INTERVAL = 0.001
+MAX_DEPTH = 100
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is requested while another one is being taken."""
+
+def frame_name(frame):
+    """Returns module:function name of stack frame."""
+    code = frame.f_code
+    return '{module}:{function}'.format(module = frame.f_globals.get('__name__', code.co_filename), function = code.co_name)
+
+def collapse(thread_name, frame):
+    """Returns collapsed stack of frame, outermost call first, rooted at thread name."""
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    names.append(thread_name)
+    names.reverse()
+    return ';'.join(name.replace(';', ':').replace(' ', '_') for name in names)
+
+class SamplingProfiler(object):
+    """Takes wall-clock profiles of all threads of the process, one at a time.
+
+    Call profiler.profile(seconds, interval) to sample stacks every interval seconds
+    for seconds and obtain the collapsed stacks text; it blocks for the whole window
+    and raises ProfilerBusy while another profile is being taken.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('dnsproxy.profiler.SamplingProfiler')
+        self.lock = Lock()
+
+    def profile(self, seconds = DEFAULT_SECONDS, interval = DEFAULT_INTERVAL):
+        """Samples stacks of all threads for seconds (at most MAX_SECONDS).
+
+        Returns collapsed stacks text, the most frequent stacks first."""
+        seconds = min(max(0, seconds), MAX_SECONDS)
+        interval = max(MIN_INTERVAL, interval)
+        if not self.lock.acquire(False):
+            raise ProfilerBusy('a profile is already being taken')
+        try:
+            counts = defaultdict(int)
+            sampler = Thread(name = 'dnsproxy-profiler', target = self.sample, args = (counts, seconds, interval, current_thread().ident))
+            sampler.daemon = True
+            self.logger.info('profiling for {seconds} seconds every {interval} seconds'.format(seconds = seconds, interval = interval))
+            sampler.start()
+            sampler.join()
+        finally:
+            self.lock.release()
+        return render_collapsed(counts)
+
+    def sample(self, counts, seconds, interval, caller):
+        """Sampler thread main: counts collapsed stacks of other threads until seconds passed.
+
+        The sampler and the caller thread waiting for it are not counted."""
+        own = (current_thread().ident, caller)
+        deadline = time.time() + seconds
+        samples = 0
+        while time.time() < deadline:
+            names = dict((thread.ident, thread.name) for thread in threads())
+            for ident, frame in sys._current_frames().items():
+                if ident in own:
+                    continue
+                counts[collapse(names.get(ident, 'thread-{ident}'.format(ident = ident)), frame)] += 1
+            samples += 1
+            time.sleep(interval)
+        self.logger.info('profile done, {samples} samples of {stacks} distinct stacks'.format(samples = samples, stacks = len(counts)))
+
+def render_collapsed(counts):
+    """Returns collapsed stacks text of dict of stack counts."""
+    lines = ['{stack} {count}'.format(stack = stack, count = count)
+             for stack, count in sorted(counts.items(), key = lambda item: -item[1])]
+    return '\n'.join(lines) + '\n' if lines else ''
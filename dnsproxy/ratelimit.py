@@ -0,0 +1,151 @@
+"""DNS proxy rate limiting module.
+
+RateLimiter limits UDP queries per client network and, with response
+rate limiting (RRL), identical responses per client network, so that
+a noisy or spoofing client can neither monopolize the serving thread nor
+use the proxy to amplify traffic towards a victim. Token buckets are kept
+in BucketTable, a fixed-size table backed by arrays, so memory stays the
+same however many addresses a flood comes from."""
+
+from array import array
+from wire import HEADER_SIZE, RCODE_MASK, WireError, skip_name, truncated
+from metrics import metrics, LIMITED_QUERY, LIMITED_REPLY, LIMITED_SLIP
+import socket
+import struct
+import time
+import logging
+
+module_logger = logging.getLogger('dnsproxy.ratelimit')
+
+DEFAULT_TABLE_SIZE = 65536
+DEFAULT_SLIP = 2
+WAYS = 4
+IPV4_PREFIX_BYTES = 3
+IPV6_PREFIX_BYTES = 7
+ALLOW = 0
+DROP = 1
+SLIP = 2
+
+class BucketTable(object):
+    """Fixed-size table of token buckets with approximate LRU eviction.
+
+    Keys are hashed into sets of WAYS slots; a key missing from its set takes the slot
+    used least recently, so a flood of new keys only evicts buckets of its own sets.
+    Keys are identified by their hash alone, a rare collision shares a bucket.
+    Not thread-safe, meant to be used by the thread serving UDP.
+    """
+
+    def __init__(self, size = DEFAULT_TABLE_SIZE):
+        self.sets = max(1, size // WAYS)
+        self.size = self.sets * WAYS
+        self.hashes = array('l', [0]) * self.size
+        self.tokens = array('d', [0.0]) * self.size
+        self.stamps = array('d', [0.0]) * self.size
+        self.limited = array('L', [0]) * self.size
+        self.evictions = 0
+
+    def slot(self, key, burst, now):
+        """Finds slot of key's bucket, replacing the least recently used bucket of its set if key has none.
+
+        Returns slot index."""
+        hashed = hash(key)
+        first = (hashed % self.sets) * WAYS
+        oldest = first
+        for slot in range(first, first + WAYS):
+            if self.hashes[slot] == hashed and self.stamps[slot]:
+                return slot
+            if self.stamps[slot] < self.stamps[oldest]:
+                oldest = slot
+        if self.stamps[oldest]:
+            self.evictions += 1
+        self.hashes[oldest] = hashed
+        self.tokens[oldest] = burst
+        self.stamps[oldest] = now
+        self.limited[oldest] = 0
+        return oldest
+
+    def take(self, key, rate, burst, now):
+        """Takes a token from key's bucket, refilled at rate tokens per second up to burst.
+
+        Returns (taken, slot) tuple."""
+        slot = self.slot(key, burst, now)
+        tokens = min(burst, self.tokens[slot] + (now - self.stamps[slot]) * rate)
+        self.stamps[slot] = now
+        if tokens < 1:
+            self.tokens[slot] = tokens
+            return (False, slot)
+        self.tokens[slot] = tokens - 1
+        self.limited[slot] = 0
+        return (True, slot)
+
+    def __len__(self):
+        return sum(1 for stamp in self.stamps if stamp)
+
+def client_prefix(addr):
+    """Returns packed network part (/24 for IPv4, /56 for IPv6) of client address tuple."""
+    host = addr[0]
+    if ':' in host:
+        return socket.inet_pton(socket.AF_INET6, host)[:IPV6_PREFIX_BYTES]
+    return socket.inet_aton(host)[:IPV4_PREFIX_BYTES]
+
+class RateLimiter(object):
+    """Query and response rate limits per client network.
+
+    query_rate is the number of queries per second accepted from a network,
+    response_rate the number of identical responses (same name and response code) per second
+    sent to it; 0 disables the limit. Of the responses over the limit every slip-th one
+    is sent truncated, so that legitimate clients behind a spoofed address retry over TCP (0 never).
+
+    Call limiter.allow_query(addr) before handling a query and limiter.filter_reply(reply, query, addr)
+    to obtain what is to be sent instead of its reply.
+    """
+
+    def __init__(self, query_rate = 0, response_rate = 0, slip = DEFAULT_SLIP, table_size = DEFAULT_TABLE_SIZE):
+        self.logger = logging.getLogger('dnsproxy.ratelimit.RateLimiter')
+        self.query_rate = query_rate
+        self.response_rate = response_rate
+        self.slip = slip
+        self.table = BucketTable(table_size)
+
+    def allow_query(self, addr, now = None):
+        """Returns False if the query from addr is over the query rate limit."""
+        if not self.query_rate:
+            return True
+        taken, slot = self.table.take((client_prefix(addr),), self.query_rate, self.query_rate, now or time.time())
+        if not taken:
+            metrics.count(LIMITED_QUERY)
+        return taken
+
+    def check_response(self, addr, reply, now = None):
+        """Decides whether reply to addr is sent, dropped or sent truncated.
+
+        Returns ALLOW, DROP or SLIP."""
+        if not self.response_rate:
+            return ALLOW
+        try:
+            name_end = skip_name(memoryview(reply), HEADER_SIZE)
+        except (WireError, struct.error, IndexError):
+            return ALLOW
+        flags, = struct.unpack_from('!H', reply, 2)
+        key = (client_prefix(addr), bytes(reply[HEADER_SIZE:name_end]).lower(), flags & RCODE_MASK)
+        taken, slot = self.table.take(key, self.response_rate, self.response_rate, now or time.time())
+        if taken:
+            return ALLOW
+        self.table.limited[slot] += 1
+        if self.slip and self.table.limited[slot] % self.slip == 0:
+            return SLIP
+        return DROP
+
+    def filter_reply(self, reply, query, addr, now = None):
+        """Applies response rate limit to UDP reply to query from addr.
+
+        Returns reply, its truncated version when it slips through the limit, or None if it is dropped."""
+        action = self.check_response(addr, reply, now)
+        if action == ALLOW:
+            return reply
+        if action == SLIP:
+            metrics.count(LIMITED_SLIP)
+            return truncated(reply, query[10:12] != b'\x00\x00')
+        metrics.count(LIMITED_REPLY)
+        return None
+
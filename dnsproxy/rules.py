@@ -0,0 +1,127 @@
+"""DNS proxy rule matching module.
+
+Behaviors are compiled once per configuration change into a RuleMatcher.
+Plain domain addresses ('example.com', '*.example.com', '.example.com') are indexed
+in a reversed-label suffix trie and match the domain and all its subdomains.
+Addresses containing regular expression syntax are kept as patterns
+and matched like before ('.*' prefix, re.match on the full query name).
+Behaviors limited to a query type are skipped for queries of other types.
+Names no behavior handles are looked up in the imported blocklist, if any."""
+
+from re import compile as regex_compile
+import logging
+
+module_logger = logging.getLogger('dnsproxy.rules')
+
+PATTERN_CHARS = frozenset('*+?[](){}|^$\\')
+
+def normalize_name(name):
+    """Lowercases domain name and strips wildcard prefix and surrounding dots.
+
+    Returns normalized name, empty string for root."""
+    name = name.strip().lower()
+    if name.startswith('*.'):
+        name = name[2:]
+    return name.strip('.')
+
+def is_pattern(address):
+    """Checks whether address is a regular expression rather than a domain name.
+
+    Returns True for patterns."""
+    if address.startswith('*.'):
+        address = address[2:]
+    return any(c in PATTERN_CHARS for c in address)
+
+def reversed_labels(name):
+    """Splits normalized domain name into labels starting from the top level domain.
+
+    Returns list of labels, empty for root."""
+    if not name:
+        return []
+    labels = name.split('.')
+    labels.reverse()
+    return labels
+
+def compile_pattern(address):
+    """Compiles address pattern the same way Behavior matching always treated it.
+
+    Returns compiled regular expression."""
+    return regex_compile('.*{0}'.format(address))
+
+class RuleMatcher(object):
+    """Compiled, indexed set of behaviors keeping first-match-wins order.
+
+    Call matcher.match(name, qtype) to obtain first behavior handling name and query type
+    (any type if qtype is None), the blocklist's blocking behavior or None.
+    """
+
+    def __init__(self, behaviors = None, blocklist = None):
+        self.logger = logging.getLogger('dnsproxy.rules.RuleMatcher')
+        self.behaviors = list(behaviors or [])
+        self.blocklist = blocklist if blocklist else None
+        # trie node: [ascending indices of rules ending here, {label: child node}]
+        self.root = [[], {}]
+        self.patterns = []
+        for index, behavior in enumerate(self.behaviors):
+            self.add(index, behavior.address)
+        self.logger.debug('compiled {count} rules, {patterns} patterns'.format(
+            count = len(self.behaviors),
+            patterns = len(self.patterns)))
+
+    def __len__(self):
+        return len(self.behaviors) + (len(self.blocklist) if self.blocklist is not None else 0)
+
+    def add(self, index, address):
+        """Indexes address of rule with given position."""
+        if is_pattern(address):
+            self.patterns.append((index, compile_pattern(address)))
+            return
+        node = self.root
+        for label in reversed_labels(normalize_name(address)):
+            node = node[1].setdefault(label, [[], {}])
+        node[0].append(index)
+
+    def first_handling(self, indices, qtype, best):
+        """Finds the first of ascending rule indices lower than best whose behavior handles qtype.
+
+        Returns rule index or best."""
+        for index in indices:
+            if best is not None and index >= best:
+                break
+            if qtype is None or self.behaviors[index].handles_qtype(qtype):
+                return index
+        return best
+
+    def match_index(self, name, qtype = None):
+        """Finds position of the first rule handling name and qtype.
+
+        Returns rule index or None."""
+        best = None
+        node = self.root
+        labels = reversed_labels(normalize_name(name))
+        for label in labels:
+            if node[0]:
+                best = self.first_handling(node[0], qtype, best)
+            node = node[1].get(label)
+            if node is None:
+                break
+        else:
+            if node[0]:
+                best = self.first_handling(node[0], qtype, best)
+        for index, pattern in self.patterns:
+            if best is not None and index >= best:
+                break
+            if pattern.match(name) and (qtype is None or self.behaviors[index].handles_qtype(qtype)):
+                return index
+        return best
+
+    def match(self, name, qtype = None):
+        """Finds the first behavior handling name and qtype.
+
+        Returns behavior or None."""
+        index = self.match_index(name, qtype)
+        if index is None:
+            if self.blocklist is not None:
+                return self.blocklist.match(normalize_name(name))
+            return None
+        return self.behaviors[index]
@@ -5,43 +5,229 @@ import select
 import socket
 import sys
 from dnslib import DNSRecord
-from threading import Thread
-from dnsproxy.config import Config
-from dnsproxy.behavior import first_or_default, Behavior
+from threading import Thread, Timer, Lock, BoundedSemaphore
+from Queue import Queue
+from dnsproxy.config import Config, ENGINE_EVENTLOOP, FORWARD_PASSTHROUGH
+from dnsproxy.behavior import first_or_default, find_behavior, on_upstream_wait, Behavior
+from dnsproxy.wire import parse_question, udp_reply, WireError
+from dnsproxy.cache import ResponseCache, Prefetcher
+from dnsproxy.eventloop import EventLoopThread, TCP_BACKLOG, TCP_MAX_CONNECTIONS, TCP_IDLE_TIMEOUT, TCP_MAX_PIPELINE
+from dnsproxy.upstream import UpstreamClient
+from dnsproxy.inflight import SingleFlight
+from dnsproxy.batchio import batch_socket
+from dnsproxy.ratelimit import RateLimiter
+from dnsproxy.journal import JournalWriter, TRANSPORT_UDP, TRANSPORT_TCP, begin, cache_outcome
+from dnsproxy.workers import WorkerPool, merge_stats, reuse_port_supported
+from dnsproxy.metrics import metrics, DROPPED_MALFORMED, DROPPED_SEND_ERROR, DROPPED_TCP_LIMIT, REPLY_LATENCY
+from dnsproxy.metrics import StageClock, NULL_CLOCK, STAGE_PARSE, STAGE_MATCH, STAGE_HANDLE, STAGE_PACK, STAGE_SEND
+import struct
+import time
 import logging
 
 module_logger = logging.getLogger('dnsproxy.server')
-BUFFER_SIZE = 1024
+TCP_HANDLERS = 8
+TCP_ACCEPT_INTERVAL = 1.0
 timeout = 10
 
+class TcpConnectionThread(Thread):
+    """Reads queries of one client TCP connection (RFC 7766).
+
+    Reads length-prefixed queries until the client closes the connection or stays idle
+    for TCP_IDLE_TIMEOUT and queues them for TcpThread's handler threads, so pipelined
+    queries are resolved concurrently, up to TCP_MAX_PIPELINE of them at once.
+    Each reply is written as soon as it is ready, in any order, by the handler thread
+    which resolved it; the connection lock only guards the queue of replies, never a write."""
+
+    def __init__(self, listener, sock, addr):
+        Thread.__init__(self)
+        self.logger = logging.getLogger('dnsproxy.server.TcpConnectionThread')
+        self.listener = listener
+        self.sock = sock
+        self.addr = addr
+        self.name = 'dnsproxy-TCP-connection'
+        self.daemon = True
+        self.lock = Lock()
+        self.pipeline = BoundedSemaphore(TCP_MAX_PIPELINE)
+        self.outstanding = 0
+        self.outbox = []
+        self.writing = False
+        self.closed = False
+
+    def receive(self, size):
+        """Reads exactly size bytes, waiting longer than the idle timeout only while queries are outstanding.
+
+        Returns data or None if the connection was closed or timed out."""
+        data = b''
+        while len(data) < size:
+            try:
+                chunk = self.sock.recv(size - len(data))
+            except socket.timeout:
+                if self.outstanding or data:
+                    continue
+                return None
+            except socket.error:
+                return None
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def run(self):
+        self.sock.settimeout(TCP_IDLE_TIMEOUT)
+        try:
+            while not self.closed:
+                prefix = self.receive(2)
+                if prefix is None:
+                    break
+                length, = struct.unpack('!H', prefix)
+                message = self.receive(length)
+                if message is None:
+                    break
+                self.pipeline.acquire()
+                with self.lock:
+                    self.outstanding += 1
+                self.listener.queries.put((self, message, time.time()))
+        finally:
+            self.close()
+
+    def send(self, reply, started):
+        """Writes length-prefixed reply to a query read from this connection.
+
+        If another handler thread is writing to the connection, the reply is queued for it
+        and this thread returns at once, so a client slow to read holds up one handler thread
+        at a time, at most TCP_IDLE_TIMEOUT per write before the connection is closed."""
+        with self.lock:
+            if self.closed:
+                return
+            self.outbox.append((struct.pack('!H', len(reply)) + bytes(reply), started))
+            if self.writing:
+                return
+            self.writing = True
+        while True:
+            with self.lock:
+                replies, self.outbox = self.outbox, []
+                if not replies or self.closed:
+                    self.writing = False
+                    return
+            try:
+                self.sock.sendall(b''.join(data for data, started in replies))
+            except socket.error as err:
+                metrics.count(DROPPED_SEND_ERROR, len(replies))
+                self.logger.debug("TCP send to '{addr}' failed: {err}".format(addr = self.addr, err = err))
+                with self.lock:
+                    self.writing = False
+                self.close()
+                return
+            now = time.time()
+            for data, started in replies:
+                metrics.observe(REPLY_LATENCY, now - started)
+
+    def done(self):
+        """Marks a query read from this connection as handled."""
+        with self.lock:
+            self.outstanding -= 1
+        self.pipeline.release()
+
+    def close(self):
+        """Closes the connection, queries still being resolved are not answered."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+        self.listener.connection_closed(self)
+
 class TcpThread(Thread):
+    """Accepts TCP clients, reading each connection with its own TcpConnectionThread
+    and refusing connections above TCP_MAX_CONNECTIONS. Queries of all connections
+    are resolved by TCP_HANDLERS handler threads."""
+
     def __init__(self, server):
         Thread.__init__(self)
         self.logger = logging.getLogger('dnsproxy.server.TcpThread')
         self.active = False
         self.server = server
         self.name = 'dnsproxy-TCP'
+        self.lock = Lock()
+        self.connections = set()
+        self.queries = Queue()
         self.logger.debug('created')
 
+    def accept(self, tcpSocket):
+        rlist, wlist, xlist = select.select([tcpSocket], [], [], TCP_ACCEPT_INTERVAL)
+        if not rlist:
+            return
+        try:
+            sock, addr = tcpSocket.accept()
+        except socket.error:
+            return
+        with self.lock:
+            if len(self.connections) >= TCP_MAX_CONNECTIONS:
+                metrics.count(DROPPED_TCP_LIMIT)
+                self.logger.debug("refusing TCP connection from '{addr}', limit reached".format(addr = addr))
+                sock.close()
+                return
+            connection = TcpConnectionThread(self, sock, addr)
+            self.connections.add(connection)
+        connection.start()
+
+    def connection_closed(self, connection):
+        with self.lock:
+            self.connections.discard(connection)
+
+    def handle_queries(self):
+        """Handler thread main: resolves queued queries until None is queued."""
+        while True:
+            item = self.queries.get()
+            if item is None:
+                break
+            connection, message, started = item
+            journal = self.server.journal
+            try:
+                if journal is not None:
+                    begin()
+                    snapshot = self.server.snapshot
+                clock = self.server.stage_clock()
+                reply = self.server.handle_packet(message, connection.addr, clock)
+                if journal is not None:
+                    journal.record(message, reply, connection.addr, TRANSPORT_TCP, started, time.time() - started, snapshot, cache_outcome())
+                if reply:
+                    connection.send(reply, started)
+                    clock.lap(STAGE_SEND)
+            except Exception:
+                self.logger.exception("TCP handling for '{addr}' threw exception".format(addr = connection.addr))
+            finally:
+                connection.done()
+
     def run(self):
         self.active = True
         self.logger.info('thread started')
         tcpSocket = self.server.createTcpSocket()
-        tcpSocket.listen(1)
-        while self.active:
-            conn, addr = tcpSocket.accept()
-            data = conn.recv(BUFFER_SIZE)
-            if not data:
-                continue
-            request = DNSRecord.parse(data)
-            self.logger.debug("handling request from '{addr}'".format(addr=addr))
-            response = first_or_default(self.server.config.behaviors, request).handle(request)
-            if response:
-                tcpSocket.send(response.pack())
-            conn.close()
-        #tcpSocket.shutdown(1)
-        tcpSocket.close()
-        self.logger.info('thread stopped')
+        tcpSocket.listen(TCP_BACKLOG)
+        handlers = [Thread(name = 'dnsproxy-TCP-handler', target = self.handle_queries) for i in range(TCP_HANDLERS)]
+        for handler in handlers:
+            handler.daemon = True
+            handler.start()
+        try:
+            while self.active:
+                self.accept(tcpSocket)
+        except Exception:
+            self.logger.exception('TCP handling threw exception')
+            raise
+        finally:
+            self.server.stopTcp()
+            tcpSocket.close()
+            with self.lock:
+                connections = list(self.connections)
+            for connection in connections:
+                connection.close()
+            for handler in handlers:
+                self.queries.put(None)
+            self.logger.info('thread stopped')
 
     def stop(self):
         self.active = False
@@ -53,23 +239,61 @@ class UdpThread(Thread):
         self.active = False
         self.server = server
         self.name = 'dnsproxy-UDP'
+        self.batch = None
+        self.pending = []
         self.logger.debug('created')
 
     def receive_and_handle(self, udpSocket):
+        """Handles all datagrams waiting on the socket, up to the batch size, and sends their replies together.
+
+        Replies already built are sent before the thread waits for upstream servers,
+        so that a query forwarded upstream does not hold answers from cache or behaviors."""
         rlist, wlist, xlist = select.select([udpSocket], [], [], timeout)
         if not rlist:
             return
-        data, addr = udpSocket.recvfrom(BUFFER_SIZE)
-        request = DNSRecord.parse(data)
-        self.logger.debug("handling request from '{addr}'".format(addr=addr))
-        response = first_or_default(self.server.config.behaviors, request).handle(request)
-        if response:
-            udpSocket.sendto(response.pack(), addr)
+        limiter = self.server.limiter
+        journal = self.server.journal
+        for data, addr in self.batch.receive():
+            started = time.time()
+            if not limiter.allow_query(addr, started):
+                continue
+            if journal is not None:
+                begin()
+                snapshot = self.server.snapshot
+            try:
+                reply = self.server.handle_packet(data, addr, self.server.stage_clock())
+            except Exception:
+                self.logger.exception("UDP handling for '{addr}' threw exception".format(addr = addr))
+                reply = None
+            if journal is not None:
+                journal.record(data, reply, addr, TRANSPORT_UDP, started, time.time() - started, snapshot, cache_outcome())
+            if reply:
+                reply = limiter.filter_reply(udp_reply(reply, data), data, addr)
+            if reply:
+                self.pending.append((reply, addr, started))
+        self.flush()
+
+    def flush(self):
+        """Sends replies collected by receive_and_handle."""
+        replies = self.pending
+        if not replies:
+            return
+        self.pending = []
+        clock = self.server.stage_clock()
+        sent = self.batch.send([(reply, addr) for reply, addr, started in replies])
+        clock.lap(STAGE_SEND)
+        now = time.time()
+        for reply, addr, started in replies:
+            metrics.observe(REPLY_LATENCY, now - started)
+        for i in range(len(replies) - sent):
+            metrics.count(DROPPED_SEND_ERROR)
 
     def run(self):
         self.active = True
         self.logger.info('thread started')
         udpSocket = self.server.createUdpSocket()
+        self.batch = batch_socket(udpSocket, self.server.config.udp_batch_size)
+        on_upstream_wait(self.flush)
         try:
             while self.active:
                 try:
@@ -90,8 +314,9 @@ class UdpThread(Thread):
         self.active = False
 
 class Server:
-    def __init__(self, config = None, host = None):
+    def __init__(self, config = None, host = None, reuse_port = False):
         self.logger = logging.getLogger('dnsproxy.server.Server')
+        self.reuse_port = reuse_port
         #self.host = self.getNameservers()[0]
         if host:
             self.host = host
@@ -100,15 +325,155 @@ class Server:
         if not config:
             config = Config()
         self.config = config
+        self.publish_lock = Lock()
+        self.snapshot = config.snapshot()
+        self.prefetcher = Prefetcher()
+        self.cache = ResponseCache(config.cache_size, config.negative_cache_ttl, prefetch_hits = config.prefetch_hits,
+                                   stale_ttl = config.serve_stale, prefetcher = self.prefetcher)
+        Behavior.cache = self.cache
+        self.upstream = self.create_upstream(self.snapshot)
+        Behavior.upstream = self.upstream
+        self.limiter = self.create_limiter(self.snapshot)
+        self.inflight = SingleFlight()
+        Behavior.inflight = self.inflight
+        self.journal = self.create_journal(config)
+        self.stage_timing = config.stage_timing
+        Behavior.stage_timing = config.stage_timing
         self.udpThread = UdpThread(self)
         self.tcpThread = TcpThread(self)
+        self.eventLoopThread = EventLoopThread(self)
+        self.workerPool = None
         self.logger.debug('server created')
 
+    def create_upstream(self, snapshot):
+        """Returns UpstreamClient for upstream settings of given ConfigSnapshot."""
+        return UpstreamClient(snapshot.upstreams, snapshot.upstream_timeout, snapshot.upstream_transport,
+                              hedge_delay = snapshot.upstream_hedge_delay)
+
+    def create_limiter(self, snapshot):
+        """Returns RateLimiter for rate limits of given ConfigSnapshot."""
+        query_rate, response_rate, slip, table_size = snapshot.rate_limits
+        return RateLimiter(query_rate, response_rate, slip, table_size)
+
+    def create_journal(self, config):
+        """Returns JournalWriter for journal settings of given Config, None if journaling is disabled."""
+        if not config.journal_directory:
+            return None
+        return JournalWriter(config.journal_directory, config.journal_segment_bytes, config.journal_segments)
+
+    def is_serving(self):
+        """Checks whether this process serves DNS, without logging.
+
+        Returns True if UDP, TCP or event loop thread is running."""
+        return self.udpThread.isAlive() or self.tcpThread.isAlive() or self.eventLoopThread.isAlive()
+
     def is_alive(self):
         tcp_alive = self.tcpThread.isAlive()
         udp_alive = self.udpThread.isAlive()
-        self.logger.debug('polling alive status, tcp: {tcp}, udp: {udp}'.format(tcp=tcp_alive, udp=udp_alive))
-        return tcp_alive or udp_alive
+        loop_alive = self.eventLoopThread.isAlive()
+        workers_alive = self.workerPool is not None and self.workerPool.is_alive()
+        self.logger.debug('polling alive status, tcp: {tcp}, udp: {udp}, event loop: {loop}, workers: {workers}'.format(tcp=tcp_alive, udp=udp_alive, loop=loop_alive, workers=workers_alive))
+        return tcp_alive or udp_alive or loop_alive or workers_alive
+
+    def stage_clock(self):
+        """Returns StageClock timing the stages of a query about to be handled, NULL_CLOCK if stage timing is disabled."""
+        if self.stage_timing:
+            return StageClock()
+        return NULL_CLOCK
+
+    def handle_packet(self, data, addr, clock = NULL_CLOCK):
+        """Resolves raw request received from addr, timing its stages with clock.
+
+        Names in local zones are answered from them before behaviors are matched.
+        Block and respond behaviors answer with their pre-encoded replies, in passthrough
+        forward mode forwarded requests are relayed as well without being fully parsed.
+        Returns raw reply or None if no reply should be sent."""
+        snapshot = self.snapshot
+        behavior = None
+        try:
+            question = parse_question(data)
+        except WireError:
+            question = None
+        clock.lap(STAGE_PARSE)
+        if question is not None and snapshot.zones:
+            answered = snapshot.zones.answer_raw(data, question)
+            if answered is not None:
+                zone, reply = answered
+                metrics.count(zone.metric_key)
+                clock.lap(STAGE_HANDLE)
+                return reply
+        if question is not None:
+            behavior = find_behavior(snapshot.matcher, question.name, question.qtype)
+            metrics.count(behavior.metric_key)
+            clock.lap(STAGE_MATCH)
+            if behavior.template is not None:
+                reply = behavior.handle_raw(data, question)
+                clock.lap(STAGE_HANDLE)
+                return reply
+            if behavior.strategy == 'forward' and snapshot.forward_mode == FORWARD_PASSTHROUGH:
+                reply = behavior.forward_raw(data, question)
+                clock.lap(STAGE_HANDLE)
+                return reply
+        elif snapshot.forward_mode == FORWARD_PASSTHROUGH:
+            metrics.count(DROPPED_MALFORMED)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("dropping malformed request from '{addr}'".format(addr=addr))
+            return None
+        try:
+            request = DNSRecord.parse(data)
+        except Exception:
+            metrics.count(DROPPED_MALFORMED)
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("dropping malformed request from '{addr}'".format(addr=addr))
+            return None
+        clock.lap(STAGE_PARSE)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("handling request from '{addr}'".format(addr=addr))
+        if behavior is None:
+            behavior = first_or_default(snapshot.matcher, request)
+            metrics.count(behavior.metric_key)
+            clock.lap(STAGE_MATCH)
+        response = behavior.handle(request)
+        clock.lap(STAGE_HANDLE)
+        if response:
+            reply = response.pack()
+            clock.lap(STAGE_PACK)
+            return reply
+        return None
+
+    def stats(self):
+        """Returns serving statistics, summed over all worker processes in worker mode."""
+        if self.workerPool is not None and self.workerPool.is_alive():
+            return merge_stats(self.workerPool.stats())
+        stats = dict(cache = self.cache.stats(), prefetch = self.prefetcher.stats(), upstream = self.upstream.stats(), inflight = self.inflight.stats(),
+                     metrics = metrics.snapshot())
+        if self.journal is not None:
+            stats['journal'] = self.journal.stats()
+        return stats
+
+    def config_changed(self):
+        """Compiles changed configuration into a new snapshot and publishes it
+        to serving threads and worker processes.
+
+        Concurrent calls (website edits, file reloads) publish one at a time, in version order.
+        Requests being handled finish with the snapshot they started with."""
+        with self.publish_lock:
+            snapshot = self.config.snapshot()
+            if snapshot.upstream_settings() != self.snapshot.upstream_settings():
+                previous = self.upstream
+                self.upstream = self.create_upstream(snapshot)
+                Behavior.upstream = self.upstream
+                closer = Timer(snapshot.upstream_timeout + previous.timeout, previous.close)
+                closer.daemon = True
+                closer.start()
+            if snapshot.rate_limits != self.snapshot.rate_limits:
+                self.limiter = self.create_limiter(snapshot)
+            if snapshot.cache_settings != self.snapshot.cache_settings:
+                self.cache.configure(*snapshot.cache_settings)
+            self.snapshot = snapshot
+            self.logger.info('published configuration version {version}'.format(version = snapshot.version))
+            if self.workerPool is not None:
+                self.workerPool.publish(self.config)
 
     def startUdp(self):
         self.logger.debug('trying to start UDP thread')
@@ -132,15 +497,54 @@ class Server:
         self.tcpThread.stop()
         self.tcpThread = TcpThread(self)
 
+    def startEventLoop(self):
+        self.logger.debug('trying to start event loop thread')
+        if self.eventLoopThread.isAlive():
+            self.logger.debug('event loop thread already alive')
+        self.eventLoopThread.start()
+
+    def stopEventLoop(self):
+        self.logger.debug('trying to stop event loop thread')
+        self.eventLoopThread.stop()
+        self.eventLoopThread = EventLoopThread(self)
+
+    def startWorkers(self):
+        self.logger.debug('trying to start worker processes')
+        if self.workerPool is None:
+            self.workerPool = WorkerPool(self.config, self.host, self.config.workers)
+        self.workerPool.start()
+
+    def stopWorkers(self):
+        self.logger.debug('trying to stop worker processes')
+        if self.workerPool is not None:
+            self.workerPool.stop()
+            self.workerPool = None
+
     def start(self):
         self.logger.debug('trying to start threads')
+        if self.config.workers > 0 and not self.reuse_port:
+            if reuse_port_supported():
+                self.startWorkers()
+                return
+            self.logger.warning('SO_REUSEPORT is not supported, serving from a single process')
+        if self.config.engine == ENGINE_EVENTLOOP:
+            if self.journal is not None:
+                self.logger.warning('query journal is only written by the threads engine')
+            self.startEventLoop()
+            return
+        if self.journal is not None:
+            self.journal.start()
         self.startUdp()
-        #self.startTcp()
+        self.startTcp()
 
     def stop(self):
         self.logger.debug('trying to stop threads')
         self.stopUdp()
         self.stopTcp()
+        self.stopEventLoop()
+        self.stopWorkers()
+        if self.journal is not None:
+            self.journal.stop()
 
     def getNameservers(self):
         try:
@@ -153,6 +557,8 @@ class Server:
     def createUdpSocket(self):
         udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         udpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            udpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         udpSocket.bind((self.host, self.config.dns_port))
         self.logger.debug('UDP socket bound to {host}:{port}'.format(host=self.host, port=self.config.dns_port))
         return udpSocket
@@ -160,6 +566,8 @@ class Server:
     def createTcpSocket(self):
         tcpSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         tcpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            tcpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         tcpSocket.bind((self.host, self.config.dns_port))
         self.logger.debug('TCP socket bound to {host}:{port}'.format(host=self.host, port=self.config.dns_port))
         return tcpSocket
@@ -191,12 +599,15 @@ class DemoApp:
                 new_action = int(raw_input("> Enter action number: "))
                 if new_action == 0:
                     self.config.behaviors = [Behavior('', 'block')]
+                    self.server.config_changed()
                     print 'Action changed to 0 - blocking'
                 elif new_action == 1:
                     self.config.behaviors = [Behavior('', 'forward')]
+                    self.server.config_changed()
                     print 'Action changed to 1 - forwarding'
                 elif new_action == 2:
                     self.config.behaviors = [Behavior('', 'respond', '192.168.1.50')]
+                    self.server.config_changed()
                     print 'Action changed to 2 - spoofing (192.168.1.50)'
                 else:
                     print 'Incorrect action number, only 0, 1 and 2 are allowed'
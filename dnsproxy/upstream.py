@@ -0,0 +1,426 @@
+"""DNS proxy upstream transport module.
+
+UpstreamClient sends raw DNS queries to a group of configured upstream servers,
+picking the fastest healthy one and hedging slow queries to another server.
+UDP queries go through pools of pre-opened, connected sockets and replies
+are matched by query ID. TCP queries are pipelined over one persistent
+connection per server, replies are dispatched by query ID from a reader thread."""
+
+from threading import Thread, Lock, Event
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+from metrics import metrics, key, UPSTREAM_RTT_SECONDS
+import random
+import select
+import socket
+import struct
+import time
+import logging
+
+module_logger = logging.getLogger('dnsproxy.upstream')
+
+DEFAULT_UPSTREAM = '8.8.8.8'
+DEFAULT_PORT = 53
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_POOL_SIZE = 4
+MAX_MESSAGE_SIZE = 65535
+TRANSPORT_UDP = 'udp'
+TRANSPORT_TCP = 'tcp'
+TC_FLAG = 0x0200
+RCODE_MASK = 0x000f
+RCODE_SERVFAIL = 2
+RCODE_REFUSED = 5
+DEFAULT_HEDGE_DELAY = 0.2
+EWMA_ALPHA = 0.2
+UNHEALTHY_FAILURE_RATE = 0.5
+PROBE_INTERVAL = 10.0
+
+class UpstreamError(Exception):
+    """Upstream server did not answer."""
+    pass
+
+class UpstreamTimeout(UpstreamError):
+    """Upstream server did not answer in time."""
+    pass
+
+def parse_address(server):
+    """Parses 'host', 'host:port' or '[ipv6]:port' upstream server notation.
+
+    Returns (host, port) tuple."""
+    if server.startswith('['):
+        host, _, port = server[1:].partition(']')
+        port = port.lstrip(':')
+    elif server.count(':') == 1:
+        host, _, port = server.partition(':')
+    else:
+        host, port = server, ''
+    return (host, int(port) if port else DEFAULT_PORT)
+
+def is_truncated(reply):
+    """Returns True if reply has TC flag set."""
+    return len(reply) >= 4 and struct.unpack('!H', reply[2:4])[0] & TC_FLAG != 0
+
+def with_id(data, query_id):
+    """Returns message with transaction ID replaced."""
+    return struct.pack('!H', query_id) + data[2:]
+
+class UdpTransport(object):
+    """Pool of connected UDP sockets to one upstream server.
+
+    The server's name is resolved once, sockaddr is the resolved address replies come from."""
+
+    def __init__(self, address, pool_size = DEFAULT_POOL_SIZE):
+        self.logger = logging.getLogger('dnsproxy.upstream.UdpTransport')
+        self.address = address
+        info = socket.getaddrinfo(address[0], address[1], 0, socket.SOCK_DGRAM)[0]
+        self.family = info[0]
+        self.sockaddr = info[4]
+        self.pool = Queue()
+        for i in range(pool_size):
+            self.pool.put(self.open_socket())
+
+    def open_socket(self):
+        sock = socket.socket(self.family, socket.SOCK_DGRAM)
+        sock.connect(self.sockaddr)
+        return sock
+
+    def acquire(self, timeout):
+        """Takes socket from the pool, waiting at most timeout seconds (not at all if it is 0).
+
+        Returns socket or None if none got free in time."""
+        try:
+            if timeout <= 0:
+                return self.pool.get_nowait()
+            return self.pool.get(timeout = timeout)
+        except Empty:
+            return None
+
+    def release(self, sock):
+        """Returns socket to the pool."""
+        self.pool.put(sock)
+
+    def reset(self, sock):
+        """Replaces broken socket.
+
+        Returns new socket."""
+        sock.close()
+        return self.open_socket()
+
+    def query(self, data, timeout):
+        """Sends query and waits for the reply with the same query ID.
+
+        Returns reply message."""
+        deadline = time.time() + timeout
+        sock = self.acquire(timeout)
+        if sock is None:
+            raise UpstreamTimeout('no free socket for {addr}'.format(addr = self.address))
+        try:
+            sock.send(data)
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise UpstreamTimeout('{addr} timed out'.format(addr = self.address))
+                sock.settimeout(remaining)
+                reply = sock.recv(MAX_MESSAGE_SIZE)
+                if reply[:2] == data[:2]:
+                    return reply
+        except socket.timeout:
+            raise UpstreamTimeout('{addr} timed out'.format(addr = self.address))
+        except socket.error as err:
+            sock = self.reset(sock)
+            raise UpstreamError('{addr} failed: {err}'.format(addr = self.address, err = err))
+        finally:
+            self.release(sock)
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get().close()
+
+class TcpTransport(object):
+    """Persistent TCP connection to one upstream server with pipelined queries."""
+
+    def __init__(self, address):
+        self.logger = logging.getLogger('dnsproxy.upstream.TcpTransport')
+        self.address = address
+        self.lock = Lock()
+        self.sock = None
+        self.waiters = {}
+
+    def connect(self, timeout):
+        sock = socket.create_connection(self.address, timeout)
+        sock.settimeout(None)
+        reader = Thread(name = 'dnsproxy-upstream-TCP', target = self.read_replies, args = (sock,))
+        reader.daemon = True
+        self.sock = sock
+        reader.start()
+        self.logger.debug('connected to {addr}'.format(addr = self.address))
+
+    def query(self, data, timeout):
+        """Sends query over the shared connection and waits for its reply.
+
+        Returns reply message."""
+        waiter = [Event(), None]
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self.connect(timeout)
+                query_id = data[:2]
+                while query_id in self.waiters:
+                    query_id = struct.pack('!H', random.randint(0, 0xffff))
+                self.waiters[query_id] = waiter
+                self.sock.sendall(struct.pack('!H', len(data)) + query_id + data[2:])
+            except socket.error as err:
+                self.disconnect(self.sock)
+                raise UpstreamError('{addr} failed: {err}'.format(addr = self.address, err = err))
+        if not waiter[0].wait(timeout):
+            with self.lock:
+                self.waiters.pop(query_id, None)
+            raise UpstreamTimeout('{addr} timed out'.format(addr = self.address))
+        if waiter[1] is None:
+            raise UpstreamError('{addr} closed connection'.format(addr = self.address))
+        return data[:2] + waiter[1][2:]
+
+    def read_replies(self, sock):
+        buf = b''
+        try:
+            while True:
+                data = sock.recv(MAX_MESSAGE_SIZE)
+                if not data:
+                    break
+                buf += data
+                while len(buf) >= 2:
+                    length, = struct.unpack('!H', buf[:2])
+                    if len(buf) < 2 + length:
+                        break
+                    reply, buf = buf[2:2 + length], buf[2 + length:]
+                    with self.lock:
+                        waiter = self.waiters.pop(reply[:2], None)
+                    if waiter is not None:
+                        waiter[1] = reply
+                        waiter[0].set()
+        except socket.error:
+            pass
+        with self.lock:
+            self.disconnect(sock)
+
+    def disconnect(self, sock):
+        """Closes connection and fails its waiting queries. Must be called with lock held."""
+        if sock is None or self.sock is not sock:
+            return
+        self.sock = None
+        sock.close()
+        waiters, self.waiters = self.waiters, {}
+        for waiter in waiters.values():
+            waiter[0].set()
+
+    def close(self):
+        with self.lock:
+            self.disconnect(self.sock)
+
+class UpstreamServer(object):
+    """Upstream server with its transports and health statistics.
+
+    RTT and failure rate are exponentially weighted moving averages.
+    Servers failing too often are skipped until probe_at, then tried again.
+    Missing the hedge delay in a race won by another server counts as a failure.
+    """
+
+    def __init__(self, server, pool_size = DEFAULT_POOL_SIZE):
+        self.server = server
+        self.address = parse_address(server)
+        self.udp = UdpTransport(self.address, pool_size)
+        self.tcp = TcpTransport(self.address)
+        self.rtt = None
+        self.failure_rate = 0.0
+        self.probe_at = 0
+        self.queries = 0
+        self.answers = 0
+        self.failures = 0
+        self.rtt_total = 0.0
+        self.rtt_key = key(UPSTREAM_RTT_SECONDS, server)
+
+    def __str__(self):
+        return self.server
+
+    def success(self, rtt):
+        metrics.observe(self.rtt_key, rtt)
+        self.answers += 1
+        self.rtt_total += rtt
+        self.rtt = rtt if self.rtt is None else self.rtt + EWMA_ALPHA * (rtt - self.rtt)
+        self.failure_rate -= EWMA_ALPHA * self.failure_rate
+
+    def failure(self):
+        self.failures += 1
+        self.failure_rate += EWMA_ALPHA * (1 - self.failure_rate)
+        if self.failure_rate >= UNHEALTHY_FAILURE_RATE:
+            self.probe_at = time.time() + PROBE_INTERVAL
+
+    def healthy(self, now):
+        """Returns True if server fails rarely or is due for a probe."""
+        return self.failure_rate < UNHEALTHY_FAILURE_RATE or now >= self.probe_at
+
+    def stats(self):
+        return dict(
+            queries = self.queries,
+            answers = self.answers,
+            failures = self.failures,
+            rttTotal = self.rtt_total)
+
+class UpstreamClient(object):
+    """Group of upstream servers queried fastest healthy server first.
+
+    If the chosen server does not answer within hedge_delay seconds, the query
+    is also sent to the next server and whichever answer comes first is used.
+    Call client.query(data) to obtain raw reply, UpstreamError is raised when no server answered.
+    The query ID is replaced for the upstream exchange and restored in the returned reply.
+    """
+
+    def __init__(self, servers = None, timeout = DEFAULT_TIMEOUT, transport = TRANSPORT_UDP, pool_size = DEFAULT_POOL_SIZE, hedge_delay = DEFAULT_HEDGE_DELAY):
+        self.logger = logging.getLogger('dnsproxy.upstream.UpstreamClient')
+        self.servers = [UpstreamServer(server, pool_size) for server in (servers or [DEFAULT_UPSTREAM])]
+        self.addresses = [server.address for server in self.servers]
+        self.timeout = timeout
+        self.transport = transport
+        self.hedge_delay = hedge_delay
+        self.hedges = 0
+
+    def ranked(self):
+        """Orders servers for the next query.
+
+        Returns healthy servers by RTT (unmeasured first), then unhealthy ones by failure rate."""
+        now = time.time()
+        healthy = [server for server in self.servers if server.healthy(now)]
+        unhealthy = [server for server in self.servers if not server.healthy(now)]
+        healthy.sort(key = lambda server: server.rtt or 0)
+        unhealthy.sort(key = lambda server: server.failure_rate)
+        return healthy + unhealthy
+
+    def next_delay(self):
+        """Returns seconds to wait before sending query to the next server."""
+        if self.hedge_delay:
+            return self.hedge_delay
+        return self.timeout
+
+    def query(self, data):
+        """Sends query to the fastest healthy upstream server, hedging slow answers.
+
+        Returns raw reply with the original query ID."""
+        data = bytes(data)
+        original_id = data[:2]
+        data = with_id(data, random.randint(0, 0xffff))
+        if self.transport == TRANSPORT_TCP:
+            reply = self.query_tcp(data)
+        else:
+            reply = self.race(data)
+        return original_id + reply[2:]
+
+    def query_tcp(self, data):
+        """Sends query over TCP to servers in ranked order until one answers.
+
+        Returns raw reply."""
+        for server in self.ranked():
+            server.queries += 1
+            sent = time.time()
+            try:
+                reply = server.tcp.query(data, self.timeout)
+            except UpstreamError as err:
+                server.failure()
+                self.logger.debug('upstream query failed: {err}'.format(err = err))
+                continue
+            server.success(time.time() - sent)
+            return reply
+        raise UpstreamError('no upstream server answered')
+
+    def race(self, data):
+        """Sends query over UDP to the best server, then to the next ones
+        after each hedge delay or failure. The first good answer wins.
+        Only the first send waits for a free socket, hedges skip servers with none free,
+        so that answers to queries already sent are not left waiting.
+
+        Returns raw reply, UDP replies with TC flag are retried over TCP."""
+        candidates = self.ranked()
+        inflight = {}
+        fallback = None
+        now = time.time()
+        deadline = now + self.timeout
+        next_send = now
+        try:
+            while True:
+                now = time.time()
+                if candidates and (not inflight or now >= next_send):
+                    server = candidates.pop(0)
+                    sock = server.udp.acquire(0 if inflight else deadline - now)
+                    if sock is not None:
+                        if inflight:
+                            self.hedges += 1
+                        server.queries += 1
+                        try:
+                            sock.send(data)
+                            inflight[sock] = (server, now)
+                        except socket.error:
+                            server.failure()
+                            server.udp.release(server.udp.reset(sock))
+                        next_send = now + self.next_delay()
+                    continue
+                if not inflight or now >= deadline:
+                    break
+                wait_until = min(deadline, next_send) if candidates else deadline
+                readable, _, _ = select.select(list(inflight), [], [], max(0, wait_until - now))
+                for sock in readable:
+                    server, sent = inflight[sock]
+                    try:
+                        reply = sock.recv(MAX_MESSAGE_SIZE)
+                    except socket.error as err:
+                        self.logger.debug('{server} failed: {err}'.format(server = server, err = err))
+                        server.failure()
+                        del inflight[sock]
+                        server.udp.release(server.udp.reset(sock))
+                        continue
+                    if reply[:2] != data[:2]:
+                        continue
+                    rcode = struct.unpack('!H', reply[2:4])[0] & RCODE_MASK
+                    if rcode in (RCODE_SERVFAIL, RCODE_REFUSED):
+                        server.failure()
+                        fallback = reply
+                        del inflight[sock]
+                        server.udp.release(sock)
+                        continue
+                    server.success(time.time() - sent)
+                    del inflight[sock]
+                    server.udp.release(sock)
+                    self.penalize_late(inflight.values())
+                    if is_truncated(reply):
+                        reply = server.tcp.query(data, max(deadline - time.time(), 0.1))
+                    return reply
+        finally:
+            for sock, (server, sent) in inflight.items():
+                server.udp.release(sock)
+        for server, sent in inflight.values():
+            server.failure()
+        if fallback is not None:
+            return fallback
+        raise UpstreamTimeout('no upstream server answered')
+
+    def penalize_late(self, sent):
+        """Counts failure for servers which lost the race without answering within hedge delay.
+
+        sent is iterable of (server, time sent) pairs."""
+        if not self.hedge_delay:
+            return
+        now = time.time()
+        for server, sent_time in sent:
+            if now - sent_time >= self.hedge_delay:
+                server.failure()
+
+    def stats(self):
+        """Returns dict with hedge count and per-server query statistics."""
+        return dict(
+            hedges = self.hedges,
+            servers = dict((server.server, server.stats()) for server in self.servers))
+
+    def close(self):
+        for server in self.servers:
+            server.udp.close()
+            server.tcp.close()
@@ -4,20 +4,37 @@
 The website allows for convenient, web-based configuration access/update,
 viewing logs and starting/stopping the DNS proxy server."""
 
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, jsonify, render_template, request
 from dnsproxy.config import Config
+from dnsproxy.configstore import ConfigStore
 from dnsproxy.behavior import Behavior
+from dnsproxy.blocklist import FORMATS, FORMAT_AUTO, FILE_KEY, FORMAT_KEY
+from werkzeug.utils import secure_filename
+from dnsproxy.metrics import RateMeter, render_prometheus, QUERIES
+from dnsproxy.logindex import LogIndex, parse_level, DEFAULT_PAGE_SIZE
+from dnsproxy.logqueue import DEFAULT_FILENAME
+from dnsproxy.profiler import SamplingProfiler, ProfilerBusy, DEFAULT_SECONDS, DEFAULT_INTERVAL
+import json
+import os
+import time
 import logging
 
 module_logger = logging.getLogger('dnsproxy.website')
 
+STREAM_POLL_INTERVAL = 1.0
+STREAM_KEEPALIVE_POLLS = 15
+BLOCKLIST_DIR = 'blocklists'
+
 class WebServer(object):
-    def __init__(self, config = None, proxyserver = None):
+    def __init__(self, config = None, proxyserver = None, store = None):
         self.logger = logging.getLogger('dnsproxy.website.WebServer')
         self.logger.debug('server creation started')
         if not config:
             config = Config()
         self.config = config
+        if not store:
+            store = ConfigStore(config)
+        self.store = store
         self.proxyserver = proxyserver
         app = Flask(__name__)
         self.app = app
@@ -36,11 +53,46 @@ class WebServer(object):
         def is_proxy_alive():
             return jsonify(isAlive=proxyserver.is_alive())
 
+        @app.route('/_cache_stats')
+        def cache_stats():
+            return jsonify(results = proxyserver.stats()['cache'])
+
+        @app.route('/_upstream_stats')
+        def upstream_stats():
+            return jsonify(results = proxyserver.stats()['upstream'])
+
+        query_rate = RateMeter()
+
+        @app.route('/_metrics')
+        def metrics_json():
+            stats = proxyserver.stats()
+            queries = sum(stats['metrics']['counters'].get(QUERIES, {}).values())
+            return jsonify(results = stats, queriesPerSecond = query_rate.rate(queries))
+
+        @app.route('/metrics')
+        def metrics_prometheus():
+            return Response(render_prometheus(proxyserver.stats()), mimetype = 'text/plain; version=0.0.4')
+
+        profiler = SamplingProfiler()
+
+        @app.route('/_profile')
+        def profile():
+            seconds = request.args.get('seconds', DEFAULT_SECONDS, type=float)
+            interval = request.args.get('interval', DEFAULT_INTERVAL, type=float)
+            try:
+                stacks = profiler.profile(seconds, interval)
+            except ProfilerBusy:
+                return jsonify(result = False), 409
+            filename = 'dnsproxy-{time}.folded'.format(time = time.strftime('%Y%m%d-%H%M%S'))
+            return Response(stacks, mimetype = 'text/plain',
+                            headers = {'Content-Disposition': 'attachment; filename={file}'.format(file = filename)})
+
         @app.route('/_save_port')
         def save_port():
             config.dns_port = request.args.get('dnsPort', 0, type=int)
             self.logger.debug('saved new DNS port {port}'.format(port = config.dns_port))
-            config.to_file()
+            store.save()
+            proxyserver.config_changed()
             return jsonify(result = True)
 
         @app.route('/_load_port')
@@ -55,11 +107,12 @@ class WebServer(object):
         @app.route('/_delete_configuration')
         def delete_configuration():
             id = request.args.get('id', 0, type=int)
-            deleted = config.behaviors.pop(id)
+            deleted = config.remove_behavior(id)
             self.logger.debug("deleted behavior [{id}] {b}".format(
                              id = id,
                              b = str(deleted)))
-            config.to_file()
+            store.save()
+            proxyserver.config_changed()
             return jsonify(result = True)
 
         @app.route('/_save_configuration')
@@ -67,44 +120,95 @@ class WebServer(object):
             ip = request.args.get('ip')
             strategy = request.args.get('strategy')
             address = request.args.get('address')
-            new_behavior = Behavior(address, strategy, ip)
-            config.behaviors.append(new_behavior)
+            qtype = request.args.get('qtype', '')
+            data = request.args.get('data', '')
+            new_behavior = Behavior(address, strategy, ip, qtype = qtype, data = data)
+            index = config.add_behavior(new_behavior)
             self.logger.debug("added behavior [{id}] {b}".format(
-                             id = len(config.behaviors) - 1,
+                             id = index,
                              b = str(new_behavior)))
-            config.to_file()
+            store.save()
+            proxyserver.config_changed()
             return jsonify(result = True)
 
+        def blocklist_report():
+            blocklist = config.blocklist
+            return jsonify(results = config.blocklists, report = blocklist.report if blocklist is not None else {})
+
+        @app.route('/_load_blocklists')
+        def load_blocklists():
+            return blocklist_report()
+
+        @app.route('/_import_blocklist', methods = ['POST'])
+        def import_blocklist():
+            upload = request.files.get('file')
+            format = request.form.get('format', FORMAT_AUTO)
+            filename = secure_filename(upload.filename) if upload else ''
+            if not filename or format not in FORMATS:
+                return jsonify(result = False), 400
+            if not os.path.isdir(BLOCKLIST_DIR):
+                os.makedirs(BLOCKLIST_DIR)
+            path = os.path.join(BLOCKLIST_DIR, filename)
+            upload.save(path)
+            config.add_blocklist({FILE_KEY : path, FORMAT_KEY : format})
+            self.logger.debug("imported blocklist '{file}' ({format})".format(file = path, format = format))
+            store.save()
+            proxyserver.config_changed()
+            return blocklist_report()
+
+        @app.route('/_delete_blocklist')
+        def delete_blocklist():
+            filename = request.args.get('file', '')
+            if config.remove_blocklist(filename):
+                self.logger.debug("removed blocklist '{file}'".format(file = filename))
+                store.save()
+                proxyserver.config_changed()
+            return blocklist_report()
+
+        log_index = LogIndex(DEFAULT_FILENAME)
+
+        def log_filters():
+            level = parse_level(request.args.get('level', ''))
+            since = request.args.get('since')
+            until = request.args.get('until')
+            return (level,
+                    log_index.parse_time(since) if since else None,
+                    log_index.parse_time(until) if until else None)
+
         @app.route('/_read_logs')
         def read_logs():
-			class LogDTO:
-				def __init__(self, date, logLever, message):
-					self.date = date
-					self.logLever = logLever
-					self.message = message
-			with open('dnsapp.log','r') as f:
-				logs = []
-				for line in f:
-					i = 0;
-					date = ''
-					logLevel = ''
-					message = ''
-					for word in line.split():
-						if i == 0 and word[0].isdigit():
-							date += word
-						elif i == 1:
-							if len(word) > 4 and len(date) > 1:
-								date += ' ' + word[:-4]
-						elif i == 2 and len(date) > 1:
-							logLevel += word
-						elif len(date) > 1:
-							message += word + ' '
-						i+=1
-					if len(date) > 1:
-						logs.append({'date': date, 'logLevel': logLevel, 'message': message})
-			print logs
-			return jsonify(results = logs)
-			
+            level, since, until = log_filters()
+            entries, more = log_index.page(
+                before = request.args.get('before', None, type=int),
+                limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int),
+                level = level,
+                since = since,
+                until = until)
+            return jsonify(results = entries, more = more)
+
+        @app.route('/_stream_logs')
+        def stream_logs():
+            level, since, until = log_filters()
+            last = request.headers.get('Last-Event-ID', None, type=int)
+            if last is None:
+                last = request.args.get('after', None, type=int)
+            if last is None:
+                last = log_index.last_id()
+            def events(last):
+                idle = 0
+                while True:
+                    entries, last = log_index.after(last, level = level)
+                    for entry in entries:
+                        yield 'id: {id}\ndata: {data}\n\n'.format(id = entry['id'], data = json.dumps(entry))
+                    if entries:
+                        idle = 0
+                        continue
+                    idle += 1
+                    if idle % STREAM_KEEPALIVE_POLLS == 0:
+                        yield ': keepalive\n\n'
+                    time.sleep(STREAM_POLL_INTERVAL)
+            return Response(events(last), mimetype = 'text/event-stream', headers = {'Cache-Control': 'no-cache'})
+
         @app.route('/')
         def index():
             return render_template('index.html')
@@ -0,0 +1,215 @@
+"""DNS proxy wire format module.
+
+Helpers reading raw DNS messages (RFC 1035 4.1) through memoryview
+without building dnslib objects. Only as much is decoded as needed:
+the question for rule matching, record positions for TTL rewriting."""
+
+import struct
+
+HEADER_SIZE = 12
+POINTER_MASK = 0xc0
+QR_FLAG = 0x8000
+OPCODE_MASK = 0x7800
+AA_FLAG = 0x0400
+TC_FLAG = 0x0200
+RD_FLAG = 0x0100
+RA_FLAG = 0x0080
+RCODE_MASK = 0x000f
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+QTYPE_A = 1
+QTYPE_SOA = 6
+QTYPE_OPT = 41
+CLASS_IN = 1
+QUESTION_NAME_POINTER = b'\xc0\x0c'
+SECTION_ANSWER = 0
+SECTION_AUTHORITY = 1
+SECTION_ADDITIONAL = 2
+MIN_UDP_PAYLOAD = 512
+EDNS_PAYLOAD_SIZE = 1232
+MAX_UDP_PAYLOAD = 4096
+
+# OPT pseudo-record (RFC 6891 6.1.2) advertising EDNS_PAYLOAD_SIZE, no extended flags
+OPT_RECORD = b'\x00' + struct.pack('!HHIH', QTYPE_OPT, EDNS_PAYLOAD_SIZE, 0, 0)
+
+class WireError(ValueError):
+    """Message is malformed or not supported."""
+    pass
+
+class Question(object):
+    """Question section entry with offset of the first byte after it."""
+
+    __slots__ = ('name', 'qtype', 'qclass', 'end')
+
+    def __init__(self, name, qtype, qclass, end):
+        self.name = name
+        self.qtype = qtype
+        self.qclass = qclass
+        self.end = end
+
+    def key(self):
+        """Returns (qname, qtype, qclass) cache key, qname is lowercased."""
+        return (self.name.lower(), self.qtype, self.qclass)
+
+def header(view):
+    """Reads message header.
+
+    Returns (id, flags, qdcount, ancount, nscount, arcount) tuple."""
+    try:
+        return struct.unpack_from('!HHHHHH', view, 0)
+    except struct.error:
+        raise WireError('truncated header')
+
+def read_name(view, offset):
+    """Reads uncompressed domain name, as sent in queries.
+
+    Returns (name, offset after name) tuple, name is dotted with trailing dot."""
+    labels = []
+    while True:
+        length, = struct.unpack_from('!B', view, offset)
+        offset += 1
+        if length == 0:
+            break
+        if length & POINTER_MASK:
+            raise WireError('compressed name in question')
+        labels.append(view[offset:offset + length].tobytes())
+        offset += length
+    return ('.'.join(labels) + '.', offset)
+
+def skip_name(view, offset):
+    """Skips possibly compressed domain name.
+
+    Returns offset after name."""
+    while True:
+        length, = struct.unpack_from('!B', view, offset)
+        if length & POINTER_MASK == POINTER_MASK:
+            return offset + 2
+        offset += 1 + length
+        if length == 0:
+            return offset
+
+def parse_question(data):
+    """Decodes the only question of a query.
+
+    Returns Question, raises WireError for malformed messages or other question counts."""
+    view = memoryview(data)
+    try:
+        qdcount, = struct.unpack_from('!H', view, 4)
+        if qdcount != 1:
+            raise WireError('expected one question, got {count}'.format(count = qdcount))
+        name, offset = read_name(view, HEADER_SIZE)
+        qtype, qclass = struct.unpack_from('!HH', view, offset)
+    except struct.error:
+        raise WireError('truncated question')
+    return Question(name, qtype, qclass, offset + 4)
+
+def error_reply(data, question_end, rcode):
+    """Builds reply with given response code and no records to a raw query.
+
+    Returns reply message with the query's ID, opcode, RD flag and question."""
+    flags, = struct.unpack_from('!H', data, 2)
+    flags = (flags & (OPCODE_MASK | RD_FLAG)) | QR_FLAG | RA_FLAG | rcode
+    return bytes(data[:2]) + struct.pack('!HHHHH', flags, 1, 0, 0, 0) + bytes(data[HEADER_SIZE:question_end])
+
+def answer_record(rtype, ttl, rdata):
+    """Encodes resource record owned by the question name, which it points to.
+
+    Returns record bytes, valid in any reply carrying the question right after the header."""
+    return QUESTION_NAME_POINTER + struct.pack('!HHIH', rtype, CLASS_IN, ttl, len(rdata)) + rdata
+
+class ReplyTemplate(object):
+    """Pre-encoded reply with fixed response code and answer records.
+
+    Call template.reply(data, question_end) to complete it with a raw query's ID and question."""
+
+    __slots__ = ('flags', 'counts', 'answer')
+
+    def __init__(self, rcode, answers = (), authoritative = True):
+        self.flags = QR_FLAG | RA_FLAG | rcode
+        if authoritative:
+            self.flags |= AA_FLAG
+        self.counts = struct.pack('!HHHH', 1, len(answers), 0, 0)
+        self.answer = b''.join(answers)
+
+    def reply(self, data, question_end):
+        """Returns reply message with the query's ID, opcode, RD flag and question."""
+        flags, = struct.unpack_from('!H', data, 2)
+        flags = (flags & (OPCODE_MASK | RD_FLAG)) | self.flags
+        return b''.join((bytes(data[:2]), struct.pack('!H', flags), self.counts, bytes(data[HEADER_SIZE:question_end]), self.answer))
+
+def for_query(reply, query, question_end = None):
+    """Adapts reply obtained for another, identical query.
+
+    Returns reply with transaction ID of query and, if question_end is given, its question bytes."""
+    reply = bytearray(reply)
+    reply[0:2] = query[0:2]
+    if question_end is not None:
+        reply[HEADER_SIZE:question_end] = query[HEADER_SIZE:question_end]
+    return bytes(reply)
+
+def records(view):
+    """Walks resource records of answer, authority and additional sections.
+
+    Yields (section, rtype, ttl offset, ttl, rdata offset, rdata length) tuples."""
+    try:
+        qdcount, ancount, nscount, arcount = struct.unpack_from('!HHHH', view, 4)
+        offset = HEADER_SIZE
+        for i in range(qdcount):
+            offset = skip_name(view, offset) + 4
+        for section, count in enumerate((ancount, nscount, arcount)):
+            for i in range(count):
+                offset = skip_name(view, offset)
+                rtype, rclass, ttl, rdlength = struct.unpack_from('!HHIH', view, offset)
+                yield (section, rtype, offset + 4, ttl, offset + 10, rdlength)
+                offset += 10 + rdlength
+    except struct.error:
+        raise WireError('truncated record')
+
+def edns_payload_size(data):
+    """Finds OPT pseudo-record (RFC 6891) in additional section of a message.
+
+    Returns UDP payload size it advertises (at least 512), None if there is no OPT record."""
+    view = memoryview(data)
+    try:
+        arcount, = struct.unpack_from('!H', view, 10)
+    except struct.error:
+        raise WireError('truncated header')
+    if arcount == 0:
+        return None
+    for section, rtype, ttl_offset, ttl, rdata_offset, rdlength in records(view):
+        if section == SECTION_ADDITIONAL and rtype == QTYPE_OPT:
+            size, = struct.unpack_from('!H', view, ttl_offset - 2)
+            return max(size, MIN_UDP_PAYLOAD)
+    return None
+
+def truncated(reply, opt):
+    """Strips reply down to its header and question, with TC flag set, and OPT record if opt is True.
+
+    Returns truncated reply."""
+    view = memoryview(reply)
+    flags, qdcount = struct.unpack_from('!HH', view, 2)
+    offset = HEADER_SIZE
+    for i in range(qdcount):
+        offset = skip_name(view, offset) + 4
+    return b''.join((bytes(reply[:2]), struct.pack('!HHHHH', flags | TC_FLAG, qdcount, 0, 0, 1 if opt else 0),
+                     bytes(reply[HEADER_SIZE:offset]), OPT_RECORD if opt else b''))
+
+def udp_reply(reply, query):
+    """Fits reply to be sent over UDP to the client which sent query.
+
+    If the query carries an OPT record, an OPT record is added to replies without additional records.
+    Replies larger than the UDP payload size the client advertises (at most MAX_UDP_PAYLOAD),
+    or than 512 bytes without OPT record, are truncated, so that the client retries over TCP.
+    Returns reply to send."""
+    if len(reply) <= MIN_UDP_PAYLOAD and query[10:12] == b'\x00\x00':
+        return reply
+    try:
+        payload = edns_payload_size(query)
+        if payload is not None and reply[10:12] == b'\x00\x00':
+            reply = bytes(reply[:10]) + b'\x00\x01' + bytes(reply[HEADER_SIZE:]) + OPT_RECORD
+        limit = MIN_UDP_PAYLOAD if payload is None else min(payload, MAX_UDP_PAYLOAD)
+        if len(reply) > limit:
+            return truncated(reply, payload is not None)
+    except (WireError, struct.error):
+        pass
+    return reply
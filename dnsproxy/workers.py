@@ -0,0 +1,184 @@
+"""DNS proxy multi-process worker module.
+
+WorkerPool runs the DNS listener in several processes. Every worker binds
+the DNS port with SO_REUSEPORT, so the kernel spreads packets between them
+and the proxy is not limited to the single core a Python process can use.
+The parent supervises workers, restarts the ones that die
+and pushes configuration changes to all of them."""
+
+from multiprocessing import Process, Pipe
+from threading import Thread, Lock
+import socket
+import time
+import logging
+
+module_logger = logging.getLogger('dnsproxy.workers')
+
+SUPERVISE_INTERVAL = 1.0
+STOP_TIMEOUT = 5.0
+MSG_CONFIG = 'config'
+MSG_STATS = 'stats'
+MSG_STOP = 'stop'
+
+def reuse_port_supported():
+    """Checks whether the platform can bind several sockets to one port.
+
+    Returns True if SO_REUSEPORT is available."""
+    return hasattr(socket, 'SO_REUSEPORT')
+
+def run_worker(host, config_json, conn):
+    """Worker process main: serves DNS with its own Server and handles messages from the parent."""
+    from dnsproxy.config import Config
+    from dnsproxy.server import Server
+    from dnsproxy import log_shipper
+    log_shipper.restart()
+    logger = logging.getLogger('dnsproxy.workers.worker')
+    config = Config().from_json(config_json)
+    config.workers = 0
+    log_shipper.configure(config.log_level, config.log_max_bytes, config.log_backup_count)
+    server = Server(config, host, reuse_port = True)
+    server.start()
+    logger.info('worker started')
+    try:
+        while server.is_serving():
+            if not conn.poll(SUPERVISE_INTERVAL):
+                continue
+            message, payload = conn.recv()
+            if message == MSG_CONFIG:
+                config.from_json(payload)
+                config.workers = 0
+                log_shipper.configure(config.log_level, config.log_max_bytes, config.log_backup_count)
+                server.config_changed()
+                logger.debug('configuration updated')
+            elif message == MSG_STATS:
+                conn.send(server.stats())
+            elif message == MSG_STOP:
+                break
+    except (EOFError, IOError, KeyboardInterrupt):
+        pass
+    finally:
+        server.stop()
+        logger.info('worker stopped')
+
+class Worker(object):
+    """Worker process handle with its control pipe."""
+
+    def __init__(self, index, host, config_json):
+        self.index = index
+        self.conn, child_conn = Pipe()
+        self.process = Process(
+            name = 'dnsproxy-worker-{index}'.format(index = index),
+            target = run_worker,
+            args = (host, config_json, child_conn))
+        self.process.daemon = True
+
+    def send(self, message, payload = None):
+        """Sends message to the worker.
+
+        Returns True if it was sent."""
+        try:
+            self.conn.send((message, payload))
+            return True
+        except (IOError, EOFError, ValueError):
+            return False
+
+class WorkerPool(object):
+    """Pool of DNS serving worker processes supervised by a background thread.
+
+    Call pool.start()/pool.stop() to run or stop workers.
+    Call pool.publish(config) to push configuration to all workers.
+    """
+
+    def __init__(self, config, host, size):
+        self.logger = logging.getLogger('dnsproxy.workers.WorkerPool')
+        self.config = config
+        self.host = host
+        self.size = size
+        self.workers = []
+        self.lock = Lock()
+        self.active = False
+        self.supervisor = None
+
+    def start(self):
+        with self.lock:
+            if self.active:
+                self.logger.debug('workers already running')
+                return
+            self.active = True
+            self.workers = [self.spawn(index) for index in range(self.size)]
+        self.supervisor = Thread(name = 'dnsproxy-supervisor', target = self.supervise)
+        self.supervisor.daemon = True
+        self.supervisor.start()
+        self.logger.info('started {count} workers'.format(count = self.size))
+
+    def spawn(self, index):
+        worker = Worker(index, self.host, self.config.to_json())
+        worker.process.start()
+        return worker
+
+    def supervise(self):
+        while self.active:
+            time.sleep(SUPERVISE_INTERVAL)
+            with self.lock:
+                if not self.active:
+                    break
+                for i, worker in enumerate(self.workers):
+                    if worker.process.is_alive():
+                        continue
+                    self.logger.warning('worker {index} exited with code {code}, restarting'.format(
+                        index = worker.index,
+                        code = worker.process.exitcode))
+                    self.workers[i] = self.spawn(worker.index)
+
+    def stop(self):
+        with self.lock:
+            if not self.active:
+                return
+            self.active = False
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.send(MSG_STOP)
+        deadline = time.time() + STOP_TIMEOUT
+        for worker in workers:
+            worker.process.join(max(0, deadline - time.time()))
+            if worker.process.is_alive():
+                worker.process.terminate()
+        self.logger.info('workers stopped')
+
+    def is_alive(self):
+        with self.lock:
+            return any(worker.process.is_alive() for worker in self.workers)
+
+    def publish(self, config):
+        """Pushes configuration to all running workers."""
+        config_json = config.to_json()
+        with self.lock:
+            for worker in self.workers:
+                if not worker.send(MSG_CONFIG, config_json):
+                    self.logger.debug('worker {index} did not accept configuration'.format(index = worker.index))
+
+    def stats(self):
+        """Collects statistics from all workers.
+
+        Returns list of stats dicts, one per responding worker."""
+        results = []
+        with self.lock:
+            for worker in self.workers:
+                if not worker.send(MSG_STATS):
+                    continue
+                if worker.conn.poll(SUPERVISE_INTERVAL):
+                    results.append(worker.conn.recv())
+        return results
+
+def merge_stats(stats_list):
+    """Sums numeric values of several (nested) stats dicts.
+
+    Returns merged dict."""
+    merged = {}
+    for stats in stats_list:
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                merged[key] = merge_stats([merged.get(key, {}), value])
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
@@ -0,0 +1,332 @@
+"""DNS proxy local zones module.
+
+Zone files in RFC 1035 master file format are parsed with dnslib's ZoneParser
+into an in-memory store: records of each zone are kept in a dict keyed by
+lowercased owner name, so a query is answered with a few dict lookups however
+many records the zones hold. Zones are answered authoritatively, with
+wildcards (RFC 4592), referrals to delegated subzones with glue, CNAME chains
+within the zone and NXDOMAIN or NODATA answers carrying the zone's SOA.
+
+Server consults the zones before behaviors, queries for names outside of
+them go on to the rules. Check a zone file with:
+
+    python -m dnsproxy.zones --query www.example.com/A example.com.zone"""
+
+from dnslib import DNSRecord, DNSHeader, DNSQuestion, DNSError, RR, QTYPE, RCODE
+from wire import OPCODE_MASK, RD_FLAG, CLASS_IN, for_query
+from metrics import key, QUERIES
+from threading import Lock
+import argparse
+import copy
+import os
+import struct
+import sys
+import logging
+
+module_logger = logging.getLogger('dnsproxy.zones')
+
+FILE_KEY = 'file'
+ORIGIN_KEY = 'origin'
+ZONE_STRATEGY = 'zone'
+WILDCARD = '*'
+MAX_CNAME_CHAIN = 8
+REPLY_CACHE_SIZE = 10000
+GLUE_TYPES = (QTYPE.A, QTYPE.AAAA)
+
+def zone_name(name):
+    """Returns domain name lowercased without trailing dot, empty string for root."""
+    return str(name).lower().rstrip('.')
+
+def parent_name(name):
+    """Returns name without its first label, empty string for top level names."""
+    dot = name.find('.')
+    return name[dot + 1:] if dot >= 0 else ''
+
+class ZoneAnswer(object):
+    """Sections of an answer from a zone."""
+
+    __slots__ = ('rcode', 'answers', 'authority', 'additional', 'authoritative')
+
+    def __init__(self, rcode = RCODE.NOERROR, answers = None, authority = None, additional = None, authoritative = True):
+        self.rcode = rcode
+        self.answers = answers or []
+        self.authority = authority or []
+        self.additional = additional or []
+        self.authoritative = authoritative
+
+class Zone(object):
+    """Records of one zone keyed by owner name and type.
+
+    names holds owner names and the empty non-terminals between them and the apex,
+    cuts the names below the apex owning NS records, where subzones are delegated.
+    Call zone.answer(name, qtype) with a name from zone_name() within the zone.
+    """
+
+    def __init__(self, origin, records):
+        self.origin = zone_name(origin)
+        self.records = {}
+        self.names = set([self.origin])
+        self.cuts = set()
+        self.soa = None
+        for rr in records:
+            name = zone_name(rr.rname)
+            if name != self.origin and not name.endswith('.' + self.origin) and self.origin:
+                module_logger.warning("zone '{zone}' - ignoring record of '{name}' outside of the zone".format(zone = self.origin, name = name))
+                continue
+            self.records.setdefault(name, {}).setdefault(rr.rtype, []).append(rr)
+            if rr.rtype == QTYPE.SOA and name == self.origin:
+                self.soa = rr
+            elif rr.rtype == QTYPE.NS and name != self.origin:
+                self.cuts.add(name)
+            while name not in self.names:
+                self.names.add(name)
+                name = parent_name(name)
+        if self.soa is None:
+            raise ValueError("zone '{zone}' has no SOA record at its apex".format(zone = self.origin))
+        minimum = self.soa.rdata.times[-1]
+        self.negative_soa = copy.copy(self.soa)
+        self.negative_soa.ttl = min(self.soa.ttl, minimum)
+        self.metric_key = key(QUERIES, ZONE_STRATEGY, self.origin)
+
+    def __len__(self):
+        return sum(len(rrs) for rrsets in self.records.values() for rrs in rrsets.values())
+
+    def answer(self, name, qtype):
+        """Answers query for name (within the zone) of qtype.
+
+        Returns ZoneAnswer."""
+        cut = self.delegation(name, qtype)
+        if cut is not None:
+            return self.referral(cut)
+        answer = ZoneAnswer()
+        self.resolve(answer, name, qtype, name, MAX_CNAME_CHAIN)
+        return answer
+
+    def delegation(self, name, qtype):
+        """Finds the topmost zone cut at or above name, the cut itself is not delegated for DS queries.
+
+        Returns name of the cut or None."""
+        if not self.cuts:
+            return None
+        cut = None
+        queried = name
+        while name != self.origin and name:
+            if name in self.cuts and not (name == queried and qtype == QTYPE.DS):
+                cut = name
+            name = parent_name(name)
+        return cut
+
+    def referral(self, cut):
+        """Returns non-authoritative answer referring to name servers of delegated cut, with glue."""
+        servers = self.records[cut][QTYPE.NS]
+        glue = []
+        for server in servers:
+            rrsets = self.records.get(zone_name(server.rdata.label), {})
+            for rtype in GLUE_TYPES:
+                glue.extend(rrsets.get(rtype, ()))
+        return ZoneAnswer(authority = list(servers), additional = glue, authoritative = False)
+
+    def resolve(self, answer, name, qtype, owner, chain):
+        """Adds records of name (or its wildcard) of qtype to answer, following CNAMEs within the zone.
+        Records synthesized from a wildcard get owner as their name."""
+        rrsets = self.records.get(name)
+        if rrsets is None and name not in self.names:
+            rrsets = self.wildcard(name)
+            if rrsets is None:
+                answer.rcode = RCODE.NXDOMAIN
+                answer.authority = [self.negative_soa]
+                return
+            rrsets = dict((rtype, [self.synthesize(rr, owner) for rr in rrs]) for rtype, rrs in rrsets.items())
+        rrsets = rrsets or {}
+        if qtype == QTYPE.ANY:
+            records = [rr for rtype, rrs in sorted(rrsets.items()) for rr in rrs]
+        else:
+            records = rrsets.get(qtype)
+        if records:
+            answer.answers.extend(records)
+            return
+        cnames = rrsets.get(QTYPE.CNAME)
+        if cnames:
+            answer.answers.extend(cnames)
+            target = zone_name(cnames[0].rdata.label)
+            if chain > 0 and self.contains(target) and self.delegation(target, qtype) is None:
+                self.resolve(answer, target, qtype, target, chain - 1)
+            return
+        answer.authority = [self.negative_soa]
+
+    def wildcard(self, name):
+        """Finds records of the wildcard at the closest existing ancestor of name.
+
+        Returns dict of records by type or None."""
+        encloser = parent_name(name)
+        while encloser not in self.names:
+            if not encloser:
+                return None
+            encloser = parent_name(encloser)
+        return self.records.get(WILDCARD + '.' + encloser if encloser else WILDCARD)
+
+    def synthesize(self, rr, owner):
+        """Returns copy of wildcard record rr owned by owner."""
+        synthesized = copy.copy(rr)
+        synthesized.rname = owner
+        return synthesized
+
+    def contains(self, name):
+        """Checks whether name is the apex or below it."""
+        return not self.origin or name == self.origin or name.endswith('.' + self.origin)
+
+class ZoneStore(object):
+    """Zones loaded from files, found by the longest origin enclosing a query name.
+
+    Call store.answer_raw(data, question) to answer a raw query, None means the name
+    is not in any zone. Encoded replies are remembered (up to REPLY_CACHE_SIZE of them)
+    and only get the query's ID, flags and question.
+    """
+
+    def __init__(self, zones = ()):
+        self.logger = logging.getLogger('dnsproxy.zones.ZoneStore')
+        self.zones = dict((zone.origin, zone) for zone in zones)
+        self.sources = ()
+        self.lock = Lock()
+        self.replies = {}
+
+    def __len__(self):
+        return len(self.zones)
+
+    def find_zone(self, name):
+        """Finds zone of name from zone_name().
+
+        Returns Zone or None."""
+        if not self.zones:
+            return None
+        while True:
+            zone = self.zones.get(name)
+            if zone is not None or not name:
+                return zone
+            name = parent_name(name)
+
+    def answer(self, name, qtype):
+        """Answers query for name of qtype.
+
+        Returns (Zone, ZoneAnswer) tuple or None if name is not in any zone."""
+        name = zone_name(name)
+        zone = self.find_zone(name)
+        if zone is None:
+            return None
+        return (zone, zone.answer(name, qtype))
+
+    def answer_raw(self, data, question):
+        """Answers raw query from zones.
+
+        Returns (Zone, raw reply) tuple or None if the question is not of class IN or its name is not in any zone."""
+        if not self.zones or question.qclass != CLASS_IN:
+            return None
+        name = zone_name(question.name)
+        zone = self.find_zone(name)
+        if zone is None:
+            return None
+        cache_key = (name, question.qtype, question.end)
+        reply = self.replies.get(cache_key)
+        if reply is None:
+            reply = self.encode(question, zone.answer(name, question.qtype))
+            with self.lock:
+                if len(self.replies) >= REPLY_CACHE_SIZE:
+                    self.replies.clear()
+                self.replies[cache_key] = reply
+        reply = bytearray(for_query(reply, data, question.end))
+        flags, query_flags = struct.unpack_from('!H', reply, 2)[0], struct.unpack_from('!H', data, 2)[0]
+        struct.pack_into('!H', reply, 2, (flags & ~(OPCODE_MASK | RD_FLAG)) | (query_flags & (OPCODE_MASK | RD_FLAG)))
+        return (zone, bytes(reply))
+
+    def encode(self, question, answer):
+        """Returns raw reply to question with sections of ZoneAnswer answer."""
+        reply = DNSRecord(DNSHeader(qr = 1, aa = int(answer.authoritative), ra = 1, rcode = answer.rcode),
+                          q = DNSQuestion(question.name, question.qtype, question.qclass))
+        for rr in answer.answers:
+            reply.add_answer(rr)
+        for rr in answer.authority:
+            reply.add_auth(rr)
+        for rr in answer.additional:
+            reply.add_ar(rr)
+        return bytes(reply.pack())
+
+def source_signature(source):
+    """Returns (file, origin, modification time, size) of zone source from configuration."""
+    filename = source[FILE_KEY]
+    try:
+        stat = os.stat(filename)
+        changed = (stat.st_mtime, stat.st_size)
+    except OSError:
+        changed = (None, None)
+    return (filename, source.get(ORIGIN_KEY, '')) + changed
+
+def load_zone(filename, origin = ''):
+    """Parses zone file, origin is used for relative names until the file sets $ORIGIN.
+
+    Returns Zone, raises EnvironmentError, ValueError or DNSError if the file cannot be loaded."""
+    with open(filename) as file:
+        records = RR.fromZone(file.read(), origin = origin)
+    if not origin:
+        soa = [rr for rr in records if rr.rtype == QTYPE.SOA]
+        if not soa:
+            raise ValueError("zone file '{file}' has no SOA record".format(file = filename))
+        origin = str(soa[0].rname)
+    return Zone(origin, records)
+
+def load_zones(sources, previous = None):
+    """Loads zone sources from configuration ({"file": ..., "origin": ...} dicts), skipping those failing to load.
+
+    Returns previous ZoneStore if none of the sources changed since it was loaded, new ZoneStore otherwise."""
+    signature = tuple(source_signature(source) for source in sources)
+    if previous is not None and previous.sources == signature:
+        return previous
+    zones = []
+    for filename, origin, mtime, size in signature:
+        try:
+            zone = load_zone(filename, origin)
+        except (EnvironmentError, ValueError, IndexError, DNSError) as err:
+            module_logger.error("failed to load zone file '{file}': {err}".format(file = filename, err = err))
+            continue
+        module_logger.info("loaded zone '{zone}' with {count} records from '{file}'".format(zone = zone.origin, count = len(zone), file = filename))
+        zones.append(zone)
+    store = ZoneStore(zones)
+    store.sources = signature
+    return store
+
+def main(argv = None):
+    """Loads zone files given on command line, prints their sizes and answers queries.
+
+    Returns exit status, 1 if a zone could not be loaded."""
+    parser = argparse.ArgumentParser(prog = 'python -m dnsproxy.zones', description = 'Loads zone files and answers queries from them.')
+    parser.add_argument('files', nargs = '+', metavar = 'FILE')
+    parser.add_argument('--origin', default = '', help = 'origin of relative names before $ORIGIN')
+    parser.add_argument('--query', metavar = 'NAME[/TYPE]', action = 'append', default = [], help = 'print answer to query, type defaults to A')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    logging.getLogger('dnsproxy').setLevel(logging.WARNING)
+    zones = []
+    status = 0
+    for filename in args.files:
+        try:
+            zone = load_zone(filename, args.origin)
+        except (EnvironmentError, ValueError, IndexError, DNSError) as err:
+            print "{file}: {err}".format(file = filename, err = err)
+            status = 1
+            continue
+        print '{zone:32} {count:>10} records {cuts:>6} delegations'.format(zone = zone.origin or '.', count = len(zone), cuts = len(zone.cuts))
+        zones.append(zone)
+    store = ZoneStore(zones)
+    for query in args.query:
+        name, _, rtype = query.partition('/')
+        result = store.answer(name, QTYPE.reverse[(rtype or 'A').upper()])
+        if result is None:
+            print '{name} not in any zone'.format(name = name)
+            continue
+        zone, answer = result
+        print ';; {name} {rtype} {rcode}{aa}'.format(name = name, rtype = (rtype or 'A').upper(), rcode = RCODE[answer.rcode], aa = ' aa' if answer.authoritative else '')
+        for section, records in (('ANSWER', answer.answers), ('AUTHORITY', answer.authority), ('ADDITIONAL', answer.additional)):
+            for rr in records:
+                print '{section:10} {rr}'.format(section = section, rr = rr.toZone())
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
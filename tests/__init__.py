@@ -0,0 +1 @@
+"""DNS proxy tests, run with python -m pytest from the repository root."""
@@ -0,0 +1,57 @@
+"""Tests of blocklist parsing, building and matching."""
+
+from dnsproxy.blocklist import BlocklistLoader, ListParser, write_compiled, map_compiled
+from dnsproxy.blocklist import FORMAT_HOSTS, FORMAT_ADBLOCK, FORMAT_RPZ
+
+def build(*names):
+    return BlocklistLoader().load(names).build()
+
+def test_match_walks_parent_domains():
+    blocklist = build('ads.example.com')
+    assert blocklist.match('ads.example.com') is blocklist.behavior
+    assert blocklist.match('a.b.ads.example.com') is blocklist.behavior
+    assert blocklist.match('example.com') is None
+    assert blocklist.match('badads.example.com') is None
+    assert blocklist.match('ads.example.com.evil.org') is None
+
+def test_match_stops_above_second_level():
+    blocklist = build('example.com')
+    assert blocklist.match('www.example.com') is blocklist.behavior
+    assert blocklist.match('com') is None
+    assert blocklist.match('other.com') is None
+
+def test_empty_blocklist_matches_nothing():
+    assert build().match('example.com') is None
+
+def test_build_drops_subdomains_of_blocked_domains():
+    blocklist = build('example.com', 'ads.example.com', 'x.ads.example.com', 'example.com', 'tracker.org')
+    assert sorted(blocklist) == ['example.com', 'tracker.org']
+    assert blocklist.report['duplicates'] == 1
+    assert blocklist.report['redundant'] == 2
+
+def test_parse_formats():
+    assert ListParser(FORMAT_HOSTS).parse('0.0.0.0 Ads.Example.com tracker.org # comment') == ['ads.example.com', 'tracker.org']
+    assert ListParser(FORMAT_HOSTS).parse('127.0.0.1 localhost') == []
+    assert ListParser(FORMAT_ADBLOCK).parse('||ads.example.com^') == ['ads.example.com']
+    assert ListParser(FORMAT_ADBLOCK).parse('||example.com/path^') == []
+    rpz = ListParser(FORMAT_RPZ)
+    assert rpz.parse('$ORIGIN rpz.example.') == []
+    assert rpz.parse('ads.example.com CNAME .') == ['ads.example.com']
+    assert rpz.parse('*.tracker.org CNAME .') == ['tracker.org']
+    assert rpz.parse('allowed.example.com CNAME rpz-passthru.') == []
+
+def test_auto_format_and_invalid_entries():
+    parser = ListParser()
+    assert parser.parse('# header') == []
+    assert parser.parse('ads.example.com') == ['ads.example.com']
+    assert parser.parse('not a domain!') == []
+    assert parser.parse('localhost') == []
+    assert parser.invalid == 3
+
+def test_compiled_table_matches_like_built_one(tmpdir):
+    filename = str(tmpdir.join('blocklist.bin'))
+    write_compiled(build('ads.example.com', 'tracker.org'), filename)
+    blocklist = map_compiled(filename)
+    assert len(blocklist) == 2
+    assert blocklist.match('x.ads.example.com') is blocklist.behavior
+    assert blocklist.match('example.com') is None
@@ -0,0 +1,123 @@
+"""Tests of the response cache TTL rewriting, expiry and eviction."""
+
+from dnslib import DNSRecord, RR, A, SOA, QTYPE, RCODE
+from dnsproxy import cache
+from dnsproxy.cache import ResponseCache, STALE_ANSWER_TTL
+import pytest
+
+class Clock(object):
+    """Stands in for the time module in dnsproxy.cache, moved forward by tests."""
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, 'time', clock)
+    return clock
+
+def answer(name = 'example.com', ttls = (300,), rcode = RCODE.NOERROR):
+    request = DNSRecord.question(name)
+    request.header.rcode = rcode
+    response = request.reply()
+    for index, ttl in enumerate(ttls):
+        response.add_answer(RR(name, rdata = A('192.0.2.{index}'.format(index = index + 1)), ttl = ttl))
+    return request, response
+
+def test_lookup_rewrites_ttls(clock):
+    responses = ResponseCache()
+    request, response = answer(ttls = (300, 120))
+    responses.store(request, response)
+    clock.now += 100
+    request.header.id = 4321
+    cached = responses.lookup(request)
+    assert cached.header.id == 4321
+    assert [rr.ttl for rr in cached.rr] == [200, 20]
+    assert [str(rr.rdata) for rr in cached.rr] == ['192.0.2.1', '192.0.2.2']
+
+def test_hit_keeps_letter_case_of_question():
+    responses = ResponseCache()
+    request, response = answer('www.Example.com')
+    responses.store(request, response)
+    request = DNSRecord.question('WwW.eXaMpLe.CoM')
+    cached = responses.lookup(request)
+    assert str(cached.q.qname) == 'WwW.eXaMpLe.CoM.'
+    assert str(DNSRecord.parse(cached.pack()).q.qname) == 'WwW.eXaMpLe.CoM.'
+    assert [str(rr.rdata) for rr in cached.rr] == ['192.0.2.1']
+
+def test_lookup_wire_copies_query_id():
+    responses = ResponseCache()
+    request, response = answer()
+    responses.store(request, response)
+    query = DNSRecord.question('example.com')
+    query.header.id = 999
+    data = bytes(query.pack())
+    reply = responses.lookup_wire(cache.cache_key(query.q), data, len(data))
+    assert DNSRecord.parse(reply).header.id == 999
+
+def test_entry_expires_with_lowest_ttl(clock):
+    responses = ResponseCache()
+    request, response = answer(ttls = (300, 120))
+    responses.store(request, response)
+    clock.now += 119
+    assert responses.lookup(request) is not None
+    clock.now += 1
+    assert responses.lookup(request) is None
+    assert len(responses) == 0
+    assert responses.stats()['expirations'] == 1
+
+def test_expired_entry_served_stale(clock):
+    responses = ResponseCache(stale_ttl = 60)
+    request, response = answer(ttls = (120,))
+    responses.store(request, response)
+    clock.now += 150
+    assert responses.lookup(request) is None
+    stale = responses.lookup(request, stale = True)
+    assert [rr.ttl for rr in stale.rr] == [STALE_ANSWER_TTL]
+    clock.now += 30
+    assert responses.lookup(request, stale = True) is None
+
+def test_negative_answers_use_soa_minimum_or_negative_ttl(clock):
+    responses = ResponseCache(negative_ttl = 60)
+    request, response = answer('missing.example.com', ttls = (), rcode = RCODE.NXDOMAIN)
+    responses.store(request, response)
+    clock.now += 59
+    assert responses.lookup(request).header.rcode == RCODE.NXDOMAIN
+    clock.now += 1
+    assert responses.lookup(request) is None
+    response.add_auth(RR('example.com', QTYPE.SOA, rdata = SOA('ns.example.com', 'admin.example.com', (1, 3600, 600, 86400, 10)), ttl = 3600))
+    responses.store(request, response)
+    clock.now += 10
+    assert responses.lookup(request) is None
+
+def test_servfail_and_zero_ttl_not_stored():
+    responses = ResponseCache()
+    request, response = answer(rcode = RCODE.SERVFAIL)
+    responses.store(request, response)
+    request, response = answer('zero.example.com', ttls = (0,))
+    responses.store(request, response)
+    assert len(responses) == 0
+
+def test_least_recently_used_entry_evicted():
+    responses = ResponseCache(max_size = 2)
+    first, second, third = [answer(name) for name in ('a.example.com', 'b.example.com', 'c.example.com')]
+    responses.store(*first)
+    responses.store(*second)
+    assert responses.lookup(first[0]) is not None
+    responses.store(*third)
+    assert responses.lookup(first[0]) is not None
+    assert responses.lookup(second[0]) is None
+    assert responses.stats()['evictions'] == 1
+
+def test_configure_evicts_above_new_size():
+    responses = ResponseCache(max_size = 10)
+    for index in range(5):
+        request, response = answer('{index}.example.com'.format(index = index))
+        responses.store(request, response)
+    responses.configure(3, 30, 5, 120)
+    assert len(responses) == 3
+    assert (responses.max_size, responses.negative_ttl, responses.prefetch_hits, responses.stale_ttl) == (3, 30, 5, 120)
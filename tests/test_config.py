@@ -0,0 +1,31 @@
+"""Tests of publishing configuration snapshots to the server."""
+
+from dnsproxy.config import Config
+from dnsproxy.server import Server
+from threading import Thread
+
+def test_concurrent_changes_publish_newest_snapshot():
+    config = Config()
+    server = Server(config, '127.0.0.1')
+    def change(index):
+        with config.lock:
+            config.upstream_timeout = 1 + index
+        server.config_changed()
+    threads = [Thread(target = change, args = (index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert server.snapshot.version == config.version
+    assert server.snapshot.upstream_timeout == config.upstream_timeout
+    assert server.upstream.timeout == config.upstream_timeout
+    server.upstream.close()
+
+def test_change_applies_cache_settings():
+    config = Config()
+    server = Server(config, '127.0.0.1')
+    config.cache_size = 5
+    config.negative_cache_ttl = 30
+    server.config_changed()
+    assert (server.cache.max_size, server.cache.negative_ttl) == (5, 30)
+    server.upstream.close()
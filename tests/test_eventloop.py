@@ -0,0 +1,81 @@
+"""Tests of the event loop engine forwarding queries upstream."""
+
+from dnslib import DNSRecord, RR, A, RCODE
+from dnsproxy.config import Config, ENGINE_EVENTLOOP, FORWARD_PASSTHROUGH, FORWARD_REBUILD
+from dnsproxy.server import Server
+from threading import Thread
+import socket
+import pytest
+
+UPSTREAM_HOST = 'localhost'
+
+class Upstream(object):
+    """UDP server on the address UPSTREAM_HOST resolves to, answering A queries with 192.0.2.1."""
+
+    def __init__(self):
+        family, socktype, proto, canonname, sockaddr = socket.getaddrinfo(UPSTREAM_HOST, 0, 0, socket.SOCK_DGRAM)[0]
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.bind(sockaddr)
+        self.port = self.sock.getsockname()[1]
+        thread = Thread(target = self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(512)
+            except socket.error:
+                return
+            request = DNSRecord.parse(data)
+            reply = request.reply()
+            reply.add_answer(RR(request.q.qname, rdata = A('192.0.2.1'), ttl = 60))
+            self.sock.sendto(reply.pack(), addr)
+
+    def close(self):
+        self.sock.close()
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def ask(port, query, attempts = 20):
+    """Sends query to the proxy until it answers, the proxy binds its socket after starting.
+
+    Returns raw reply."""
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(0.5)
+    try:
+        for attempt in range(attempts):
+            client.sendto(query, ('127.0.0.1', port))
+            try:
+                return client.recv(512)
+            except socket.timeout:
+                pass
+    finally:
+        client.close()
+    raise AssertionError('proxy did not answer')
+
+@pytest.mark.parametrize('forward_mode', [FORWARD_REBUILD, FORWARD_PASSTHROUGH])
+def test_forwards_to_upstream_given_by_hostname(forward_mode):
+    upstream = Upstream()
+    config = Config()
+    config.dns_port = free_port()
+    config.engine = ENGINE_EVENTLOOP
+    config.forward_mode = forward_mode
+    config.upstreams = ['{host}:{port}'.format(host = UPSTREAM_HOST, port = upstream.port)]
+    config.upstream_timeout = 2
+    server = Server(config, '127.0.0.1')
+    server.start()
+    loop = server.eventLoopThread
+    try:
+        reply = DNSRecord.parse(ask(config.dns_port, DNSRecord.question('www.example.com').pack()))
+    finally:
+        server.stop()
+        loop.join()
+        upstream.close()
+    assert reply.header.rcode == RCODE.NOERROR
+    assert [str(rr.rdata) for rr in reply.rr] == ['192.0.2.1']
@@ -0,0 +1,39 @@
+"""Tests of per-thread metrics shards."""
+
+from dnsproxy.metrics import Metrics, key, QUERIES, REPLY_SECONDS
+from threading import Thread
+
+QUERY = key(QUERIES, 'forward', '')
+LATENCY = key(REPLY_SECONDS)
+
+def test_snapshot_sums_threads():
+    metrics = Metrics()
+    def record():
+        metrics.count(QUERY)
+        metrics.observe(LATENCY, 0.003)
+    threads = [Thread(target = record) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    record()
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'][QUERIES]['strategy="forward",rule=""'] == 5
+    histogram = snapshot['histograms'][REPLY_SECONDS]['']
+    assert histogram['count'] == 5
+    assert histogram['buckets']['0.005'] == 5
+
+def test_shards_of_exited_threads_are_retired():
+    metrics = Metrics()
+    for round in range(3):
+        threads = [Thread(target = metrics.count, args = (QUERY,)) for i in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        snapshot = metrics.snapshot()
+        assert snapshot['counters'][QUERIES]['strategy="forward",rule=""'] == 50 * (round + 1)
+        assert len(metrics.shards) == 0
+    metrics.count(QUERY)
+    assert len(metrics.shards) == 1
+    assert metrics.snapshot()['counters'][QUERIES]['strategy="forward",rule=""'] == 151
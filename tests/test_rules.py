@@ -0,0 +1,68 @@
+"""Tests of rule matching precedence."""
+
+from dnslib import DNSRecord, QTYPE
+from dnsproxy.behavior import Behavior, first_or_default, DEFAULT_BEHAVIOR
+from dnsproxy.blocklist import BlocklistLoader
+from dnsproxy.rules import RuleMatcher
+
+def matcher(*addresses):
+    return RuleMatcher([Behavior(address, 'block') for address in addresses])
+
+def matched(rules, name):
+    behavior = rules.match(name)
+    return behavior.address if behavior is not None else None
+
+def test_domain_matches_itself_and_subdomains():
+    rules = matcher('example.com')
+    assert matched(rules, 'example.com.') == 'example.com'
+    assert matched(rules, 'www.Example.COM.') == 'example.com'
+    assert matched(rules, 'badexample.com.') is None
+    assert matched(rules, 'example.org.') is None
+
+def test_first_rule_wins_regardless_of_specificity():
+    rules = matcher('example.com', 'www.example.com')
+    assert matched(rules, 'www.example.com.') == 'example.com'
+    rules = matcher('www.example.com', 'example.com')
+    assert matched(rules, 'www.example.com.') == 'www.example.com'
+    assert matched(rules, 'mail.example.com.') == 'example.com'
+
+def test_wildcard_and_leading_dot_forms():
+    rules = matcher('*.example.com', '.example.org')
+    assert matched(rules, 'a.b.example.com.') == '*.example.com'
+    assert matched(rules, 'example.org.') == '.example.org'
+
+def test_patterns_keep_position_among_domains():
+    rules = matcher('ads[0-9]+\\.example\\.com', 'example.com')
+    assert matched(rules, 'ads12.example.com.') == 'ads[0-9]+\\.example\\.com'
+    assert matched(rules, 'www.example.com.') == 'example.com'
+    rules = matcher('example.com', 'ads[0-9]+\\.example\\.com')
+    assert matched(rules, 'ads12.example.com.') == 'example.com'
+
+def test_empty_address_matches_everything_last():
+    rules = RuleMatcher([Behavior('example.com', 'block'), Behavior('', 'forward')])
+    assert rules.match('example.com.').strategy == 'block'
+    assert rules.match('other.org.').strategy == 'forward'
+
+def test_rules_limited_to_qtype_skipped_for_other_types():
+    rules = RuleMatcher([Behavior('example.com', 'respond', data = '::1', qtype = 'AAAA'),
+                         Behavior('example.com', 'block')])
+    assert rules.match('example.com.', QTYPE.AAAA).strategy == 'respond'
+    assert rules.match('example.com.', QTYPE.ANY).strategy == 'respond'
+    assert rules.match('example.com.', QTYPE.A).strategy == 'block'
+    assert rules.match('example.com.').strategy == 'respond'
+
+def test_behaviors_take_precedence_over_blocklist():
+    blocklist = BlocklistLoader().load(['ads.example.com', 'tracker.org']).build()
+    rules = RuleMatcher([Behavior('ads.example.com', 'forward')], blocklist)
+    assert rules.match('ads.example.com.').strategy == 'forward'
+    assert rules.match('x.tracker.org.') is blocklist.behavior
+    assert rules.match('example.com.') is None
+    assert len(rules) == 3
+
+def test_unmatched_names_share_default_forwarding_behavior():
+    rules = matcher('example.com')
+    first = first_or_default(rules, DNSRecord.question('www.example.org'))
+    assert first is DEFAULT_BEHAVIOR
+    assert first_or_default(rules, DNSRecord.question('other.net')) is first
+    assert first_or_default([], DNSRecord.question('other.net')) is first
+    assert first.strategy == 'forward'
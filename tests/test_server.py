@@ -0,0 +1,60 @@
+"""Tests of writing TCP replies from handler threads."""
+
+from dnsproxy.server import TcpConnectionThread
+from threading import Thread, Event
+import socket
+import struct
+import time
+
+class Listener(object):
+    def connection_closed(self, connection):
+        pass
+
+class SlowSocket(object):
+    """Socket whose first sendall blocks until released."""
+
+    def __init__(self):
+        self.release = Event()
+        self.written = []
+
+    def sendall(self, data):
+        if not self.written:
+            self.written.append(None)
+            self.release.wait()
+        self.written.append(data)
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+def framed(reply):
+    return struct.pack('!H', len(reply)) + reply
+
+def test_reply_queued_while_another_thread_writes():
+    sock = SlowSocket()
+    connection = TcpConnectionThread(Listener(), sock, ('127.0.0.1', 53000))
+    writer = Thread(target = connection.send, args = (b'first', time.time()))
+    writer.start()
+    while not sock.written:
+        time.sleep(0.001)
+    started = time.time()
+    connection.send(b'second', time.time())
+    connection.send(bytearray(b'third'), time.time())
+    assert time.time() - started < 0.5
+    sock.release.set()
+    writer.join()
+    assert sock.written[1:] == [framed(b'first'), framed(b'second') + framed(b'third')]
+    assert not connection.writing and not connection.outbox
+
+class FailingSocket(SlowSocket):
+    def sendall(self, data):
+        raise socket.error('connection reset')
+
+def test_failed_write_closes_connection():
+    connection = TcpConnectionThread(Listener(), FailingSocket(), ('127.0.0.1', 53000))
+    connection.send(b'reply', time.time())
+    assert connection.closed and not connection.writing
+    connection.send(b'late', time.time())
+    assert not connection.outbox
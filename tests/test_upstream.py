@@ -0,0 +1,65 @@
+"""Tests of upstream server selection and hedging."""
+
+from dnslib import DNSRecord
+from dnsproxy.upstream import UpstreamClient
+from threading import Thread
+import socket
+import time
+import pytest
+
+class SlowServer(object):
+    """UDP server answering every query with an empty NOERROR reply after delay seconds."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = '127.0.0.1:{port}'.format(port = self.sock.getsockname()[1])
+        thread = Thread(target = self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(512)
+            except socket.error:
+                return
+            time.sleep(self.delay)
+            self.sock.sendto(data[:2] + b'\x81\x80' + data[4:], addr)
+
+    def close(self):
+        self.sock.close()
+
+@pytest.fixture
+def servers():
+    started = []
+    def start(delay):
+        server = SlowServer(delay)
+        started.append(server)
+        return server
+    yield start
+    for server in started:
+        server.close()
+
+def query():
+    return bytes(DNSRecord.question('example.com').pack())
+
+def test_answer_from_primary(servers):
+    client = UpstreamClient([servers(0).address], timeout = 2)
+    reply = DNSRecord.parse(client.query(query()))
+    assert reply.header.qr == 1
+    assert client.stats()['hedges'] == 0
+    client.close()
+
+def test_hedge_without_free_socket_does_not_delay_primary_answer(servers):
+    primary, hedge = servers(0.15), servers(0)
+    client = UpstreamClient([primary.address, hedge.address], timeout = 3, pool_size = 1, hedge_delay = 0.1)
+    busy = client.servers[1].udp.acquire(0)
+    started = time.time()
+    client.query(query())
+    elapsed = time.time() - started
+    client.servers[1].udp.release(busy)
+    client.close()
+    assert elapsed < 0.15 + 0.1
+    assert client.stats()['hedges'] == 0
@@ -0,0 +1,62 @@
+"""Tests of raw query decoding and reply building."""
+
+from dnslib import DNSRecord, EDNS0, QTYPE, RCODE
+from dnsproxy.wire import parse_question, error_reply, WireError
+import struct
+import pytest
+
+def query(name = 'www.Example.com', qtype = 'AAAA', id = 0x1234):
+    request = DNSRecord.question(name, qtype)
+    request.header.id = id
+    return bytes(request.pack())
+
+def test_parse_question():
+    data = query()
+    question = parse_question(data)
+    assert question.name == 'www.Example.com.'
+    assert question.qtype == QTYPE.AAAA
+    assert question.qclass == 1
+    assert question.end == len(data)
+    assert question.key() == ('www.example.com.', QTYPE.AAAA, 1)
+
+def test_parse_question_ignores_additional_records():
+    request = DNSRecord.question('example.com')
+    request.add_ar(EDNS0(udp_len = 1232))
+    data = bytes(request.pack())
+    assert parse_question(data).end == len(query('example.com', 'A'))
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'\x12\x34\x01\x00\x00\x01',
+    query()[:-3],
+    query()[:4] + struct.pack('!H', 2) + query()[6:],
+    query()[:4] + struct.pack('!H', 0) + query()[6:],
+])
+def test_parse_question_rejects_malformed(data):
+    with pytest.raises(WireError):
+        parse_question(data)
+
+def test_parse_question_rejects_compressed_name():
+    data = query()[:12] + b'\xc0\x0c' + struct.pack('!HH', 1, 1)
+    with pytest.raises(WireError):
+        parse_question(data)
+
+def test_error_reply():
+    data = query()
+    question = parse_question(data)
+    reply = DNSRecord.parse(error_reply(data, question.end, RCODE.SERVFAIL))
+    assert reply.header.id == 0x1234
+    assert reply.header.qr == 1
+    assert reply.header.rd == 1
+    assert reply.header.ra == 1
+    assert reply.header.rcode == RCODE.SERVFAIL
+    assert str(reply.q.qname) == 'www.Example.com.'
+    assert reply.q.qtype == QTYPE.AAAA
+    assert not reply.rr and not reply.auth and not reply.ar
+
+def test_error_reply_keeps_opcode_and_drops_other_flags():
+    data = bytearray(query())
+    struct.pack_into('!H', data, 2, 0x2000 | 0x0400 | 0x0010)
+    reply = error_reply(bytes(data), parse_question(bytes(data)).end, RCODE.REFUSED)
+    flags, = struct.unpack_from('!H', reply, 2)
+    assert flags == 0x8000 | 0x2000 | 0x0080 | RCODE.REFUSED
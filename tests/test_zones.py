@@ -0,0 +1,108 @@
+"""Tests of zone file loading and answers from local zones."""
+
+from dnslib import DNSRecord, QTYPE, RCODE
+from dnsproxy.wire import parse_question
+from dnsproxy.zones import ZoneStore, load_zone, load_zones
+import pytest
+
+ZONE = """$ORIGIN example.com.
+$TTL 3600
+@       IN SOA ns1.example.com. admin.example.com. ( 1 7200 900 1209600 300 )
+        IN NS  ns1
+ns1     IN A   192.0.2.53
+www     IN A   192.0.2.1
+        IN A   192.0.2.2
+        IN AAAA 2001:db8::1
+alias   IN CNAME www
+outside IN CNAME www.example.org.
+*.dyn   IN A   192.0.2.99
+a.b.c   IN TXT "deep"
+sub     IN NS  ns.sub
+ns.sub  IN A   192.0.2.54
+"""
+
+@pytest.fixture
+def zone_file(tmpdir):
+    path = tmpdir.join('example.com.zone')
+    path.write(ZONE)
+    return str(path)
+
+@pytest.fixture
+def store(zone_file):
+    return ZoneStore([load_zone(zone_file)])
+
+def answered(store, name, qtype):
+    zone, answer = store.answer(name, qtype)
+    return answer
+
+def test_load_zone(zone_file):
+    zone = load_zone(zone_file)
+    assert zone.origin == 'example.com'
+    assert len(zone) == 12
+    assert zone.cuts == set(['sub.example.com'])
+    assert 'c.example.com' in zone.names and 'b.c.example.com' in zone.names
+    assert zone.negative_soa.ttl == 300
+
+def test_load_zone_without_soa_fails(tmpdir):
+    path = tmpdir.join('broken.zone')
+    path.write('$ORIGIN broken.com.\nwww IN A 192.0.2.1\n')
+    with pytest.raises(ValueError):
+        load_zone(str(path))
+
+def test_load_zones_skips_failing_and_reuses_unchanged(zone_file, tmpdir):
+    sources = [dict(file = zone_file), dict(file = str(tmpdir.join('missing.zone')))]
+    zones = load_zones(sources)
+    assert len(zones) == 1
+    assert load_zones(sources, zones) is zones
+
+def test_answers_records_of_type(store):
+    answer = answered(store, 'WWW.example.com.', QTYPE.A)
+    assert answer.rcode == RCODE.NOERROR and answer.authoritative
+    assert [str(rr.rdata) for rr in answer.answers] == ['192.0.2.1', '192.0.2.2']
+    assert len(answered(store, 'www.example.com', QTYPE.ANY).answers) == 3
+
+def test_nodata_and_nxdomain_carry_soa(store):
+    nodata = answered(store, 'ns1.example.com', QTYPE.AAAA)
+    assert nodata.rcode == RCODE.NOERROR and not nodata.answers
+    assert [rr.rtype for rr in nodata.authority] == [QTYPE.SOA]
+    empty_non_terminal = answered(store, 'b.c.example.com', QTYPE.A)
+    assert empty_non_terminal.rcode == RCODE.NOERROR and not empty_non_terminal.answers
+    missing = answered(store, 'missing.example.com', QTYPE.A)
+    assert missing.rcode == RCODE.NXDOMAIN
+    assert missing.authority[0].ttl == 300
+
+def test_cname_followed_within_zone_only(store):
+    answer = answered(store, 'alias.example.com', QTYPE.A)
+    assert [rr.rtype for rr in answer.answers] == [QTYPE.CNAME, QTYPE.A, QTYPE.A]
+    answer = answered(store, 'outside.example.com', QTYPE.A)
+    assert [rr.rtype for rr in answer.answers] == [QTYPE.CNAME]
+
+def test_wildcard_synthesizes_owner(store):
+    answer = answered(store, 'host.dyn.example.com', QTYPE.A)
+    assert [(str(rr.rname), str(rr.rdata)) for rr in answer.answers] == [('host.dyn.example.com.', '192.0.2.99')]
+    assert answered(store, 'host.other.example.com', QTYPE.A).rcode == RCODE.NXDOMAIN
+
+def test_delegation_refers_with_glue(store):
+    answer = answered(store, 'www.sub.example.com', QTYPE.A)
+    assert not answer.authoritative and not answer.answers
+    assert [rr.rtype for rr in answer.authority] == [QTYPE.NS]
+    assert [str(rr.rdata) for rr in answer.additional] == ['192.0.2.54']
+
+def test_names_outside_zones_not_answered(store):
+    assert store.answer('example.org', QTYPE.A) is None
+    assert store.answer('com', QTYPE.A) is None
+
+def test_answer_raw_gets_query_id_and_flags(store):
+    request = DNSRecord.question('www.example.com', 'A')
+    request.header.id = 4242
+    data = bytes(request.pack())
+    zone, reply = store.answer_raw(data, parse_question(data))
+    assert zone.origin == 'example.com'
+    response = DNSRecord.parse(reply)
+    assert response.header.id == 4242 and response.header.rd == 1 and response.header.aa == 1
+    assert len(response.rr) == 2
+    request.header.id = 7
+    request.header.rd = 0
+    data = bytes(request.pack())
+    response = DNSRecord.parse(store.answer_raw(data, parse_question(data))[1])
+    assert response.header.id == 7 and response.header.rd == 0